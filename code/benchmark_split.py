@@ -0,0 +1,336 @@
+#! /usr/bin/env python
+
+# benchmark_split
+'''
+Benchmarks for the splitting and splicing hot paths, run on synthetic
+multiview videos so the numbers are comparable between commits and machines.
+
+It builds a throwaway project (sqlite_setup plus a fake calibration), writes
+a synthetic five-view video with OpenCV, then times:
+
+    - flip_legacy       the old per-frame crop (astype + view_flipper + contiguous copy)
+    - view_plan         the compiled view_plan crop
+    - iter_views        decode + crop through the streaming generator
+    - splice            crop_and_splice's original per-frame splice (splice_frame)
+    - splice_plan       the same splice with a precompiled splice_plan
+    - split_serial      video_split_sql, one thread
+    - split_pipelined   video_split_sql, threaded decode/encode
+    - split_segments    video_split_sql, parallel frame ranges (if ffmpeg is around)
+
+Each case runs in its own process so peak RSS is per case. The case's own
+process and its largest child (segment workers, ffmpeg) are reported
+separately, since they peak at different times. Results go to a
+JSON file, and --compare checks them against an earlier run:
+
+    python benchmark_split.py -o new.json --compare old.json --threshold 0.1
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+import cv2
+from concurrent.futures import ProcessPoolExecutor
+
+from project_setup import sqlite_setup
+import multiview_utils
+from multiview_calibration_preparation import splice_layout, splice_frame, splice_plan
+from video_writers import load_encoder_config
+from calibration_codec import encode as encode_calibration
+
+try:
+    import resource # not on windows
+except ImportError:
+    resource = None
+
+
+CASES = ['flip_legacy', 'view_plan', 'iter_views', 'splice', 'splice_plan', 'split_serial', 'split_pipelined', 'split_segments']
+
+# the splice cases always do a gamma lookup, so the numbers stay comparable whatever config.toml says
+SPLICE_TRANSFORMS = {'default': dict(multiview_utils.DEFAULT_TRANSFORMS, splice_gamma=.6)}
+
+
+
+def synthetic_bounds(width:int, height:int):
+    '''
+    five-view mirror box layout for a width x height frame: a center view,
+    with north/south above and below it and west/east on either side.
+    Boundaries are [top, left, bottom, right] like the calibration table
+    '''
+    side_w, side_h = width // 6, height // 5 # thickness of the mirror views
+    margin = 4
+    return {'North': [margin, 2*side_w, side_h, width - 2*side_w],
+            'South': [height - side_h, 2*side_w, height - margin, width - 2*side_w],
+            'West': [side_h + margin, margin, height - side_h - margin, side_w],
+            'East': [side_h + margin, width - side_w, height - side_h - margin, width - margin],
+            'Center': [side_h + margin, 2*side_w, height - side_h - margin, width - 2*side_w]}
+
+
+
+def make_video(video_path:str, width:int, height:int, n_frames:int, fps:float = 30, seed:int = 0):
+    '''
+    write a synthetic multiview video: textured views on a black background,
+    with a blob moving around so the encoder has something to do
+    '''
+    rng = np.random.default_rng(seed)
+    bounds = synthetic_bounds(width, height)
+    texture = cv2.GaussianBlur(rng.integers(0, 255, (height, width, 3), dtype=np.uint8), (7,7), 0)
+
+    # only the views have anything in them
+    background = np.zeros((height, width, 3), dtype=np.uint8)
+    for bound in bounds.values():
+        background[bound[0]:bound[2], bound[1]:bound[3]] = texture[bound[0]:bound[2], bound[1]:bound[3]]
+
+    vid_write = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    for i_frame in range(n_frames):
+        frame = np.roll(background, i_frame % 16, axis=1)
+        center = (int(width/2 + width/6*np.cos(i_frame/20)), int(height/2 + height/6*np.sin(i_frame/20)))
+        cv2.circle(frame, center, max(height//20, 4), (255,255,255), -1)
+        vid_write.write(frame)
+    vid_write.release()
+
+    return bounds
+
+
+
+def make_project(project_dir:str, width:int, height:int, n_frames:int):
+    '''
+    throwaway project: sqlite file, one mouse, one session video and
+    a calibration with the synthetic boundaries
+    '''
+    video_dir = os.path.join(project_dir, 'videos', 'bench_mouse')
+    os.makedirs(video_dir, exist_ok=True)
+    sqlite_setup(project_dir=project_dir)
+
+    video_name = 'bench_mouse_20240101_120000_chochip.mp4'
+    video_path = os.path.join(video_dir, video_name)
+    bounds = make_video(video_path, width, height, n_frames)
+
+    sql_path = os.path.join(project_dir, 'project_tracking.sqlite3')
+    con = sqlite3.connect(sql_path)
+    cur = con.cursor()
+    cur.execute('INSERT INTO mouse (id) VALUES (?)', ('bench_mouse',))
+    cur.execute('INSERT INTO session (mouse_id, time, task) VALUES (?, ?, ?)', ('bench_mouse', '2024-01-01T12:00:00', 'chochip'))
+    cur.execute('INSERT INTO videos (name, session_id) VALUES (?, ?)', (video_name, cur.lastrowid))
+    cur.execute('INSERT INTO calibration (name, time, boundary) VALUES (?, ?, ?)',
+                ('calib_20240101_.mp4', '2024-01-01', encode_calibration(bounds)))
+    con.commit()
+    con.close()
+
+    return sql_path, video_path
+
+
+
+def _peak_rss_mb():
+    '''
+    (peak resident memory of this process, largest peak of any of its finished
+    children) in MB. The two happen at different times, so adding them up
+    wouldn't be a peak of anything
+    '''
+    if resource is None:
+        return None, None
+    scale = 1 if sys.platform == 'darwin' else 1024 # macOS reports bytes, linux KB
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 1e6)
+
+
+
+def _summarize(latencies:list, n_frames:int, seconds:float):
+    # fps and latency percentiles for a case
+    result = {'frames':n_frames, 'seconds':seconds, 'fps':n_frames/seconds if seconds > 0 else None}
+    if latencies:
+        latencies = np.array(latencies) * 1e3
+        result['latency_ms'] = {'mean':float(latencies.mean()), 'p50':float(np.percentile(latencies, 50)),
+                                'p90':float(np.percentile(latencies, 90)), 'p99':float(np.percentile(latencies, 99))}
+    else:
+        result['latency_ms'] = None
+    return result
+
+
+
+def _load_frames(video_path:str, max_frames:int):
+    # decode some frames up front so the in-memory cases don't time decoding
+    vid_read = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < max_frames:
+        ret, frame = vid_read.read()
+        if not ret:
+            break
+        frames.append(frame)
+    vid_read.release()
+    return frames
+
+
+
+def run_case(case:str, sql_path:str, video_path:str, encoder:dict, n_segments:int, max_frames:int):
+    '''
+    run a single benchmark case. Meant to be run in its own process
+    '''
+    bounds = multiview_utils.bound_puller(sql_path, video_path)
+    latencies = []
+
+    if case in ['flip_legacy', 'view_plan', 'splice', 'splice_plan']:
+        frames = _load_frames(video_path, max_frames)
+        if case == 'view_plan':
+            plan = multiview_utils.view_plan(bounds, frames[0].shape[:2])
+        elif case == 'splice':
+            splice_bounds = {key.lower():value for key, value in bounds.items()}
+            layout = splice_layout(splice_bounds)
+        elif case == 'splice_plan':
+            plan = splice_plan({key.lower():value for key, value in bounds.items()}, SPLICE_TRANSFORMS)
+
+        t_start = time.perf_counter()
+        for frame in frames:
+            t_frame = time.perf_counter()
+            if case == 'flip_legacy':
+                for b_name, bound in bounds.items():
+                    temp_frame = frame[bound[0]:bound[2],bound[1]:bound[3],:].astype(np.uint8)
+                    np.ascontiguousarray(multiview_utils.view_flipper(temp_frame, b_name))
+            elif case in ['view_plan', 'splice_plan']:
+                plan.apply(frame)
+            else:
+                splice_frame(frame, splice_bounds, layout, SPLICE_TRANSFORMS).astype(np.uint8)
+            latencies.append(time.perf_counter() - t_frame)
+        seconds = time.perf_counter() - t_start
+        n_frames = len(frames)
+
+    elif case == 'iter_views':
+        t_start = time.perf_counter()
+        t_frame = t_start
+        for i_frame, views in multiview_utils.iter_views(sql_path, video_path, copy=False):
+            now = time.perf_counter()
+            latencies.append(now - t_frame)
+            t_frame = now
+        seconds = time.perf_counter() - t_start
+        n_frames = len(latencies)
+
+    else: # the full splits
+        output_dir = os.path.join(os.path.dirname(sql_path), 'bench_' + case)
+        kwargs = {'pipelined':case == 'split_pipelined', 'n_segments':n_segments if case == 'split_segments' else 1}
+        t_start = time.perf_counter()
+        n_frames = multiview_utils.video_split_sql(sql_path, video_path, output_dir=output_dir, encoder=encoder, **kwargs)
+        seconds = time.perf_counter() - t_start
+        shutil.rmtree(output_dir)
+
+    result = _summarize(latencies, n_frames, seconds)
+    result['peak_rss_mb'], result['peak_child_rss_mb'] = _peak_rss_mb()
+    return result
+
+
+
+def run_benchmarks(width:int = 1280, height:int = 1024, n_frames:int = 300, cases:list = CASES,
+                   encoder:dict = None, n_segments:int = 4, work_dir:str = None):
+    '''
+    build the synthetic project and run each case in a fresh process
+
+    returns a dictionary with the run info and the results for each case
+    '''
+    if encoder is None:
+        encoder = load_encoder_config(None)
+    if shutil.which(encoder['ffmpeg']) is None and 'split_segments' in cases:
+        print('ffmpeg not found, skipping split_segments')
+        cases = [case for case in cases if case != 'split_segments']
+
+    project_dir = tempfile.mkdtemp(prefix='split_bench_', dir=work_dir)
+    try:
+        print(f'Writing a {width}x{height}, {n_frames} frame synthetic video in {project_dir}')
+        sql_path, video_path = make_project(project_dir, width, height, n_frames)
+
+        results = {}
+        for case in cases:
+            ctx = multiprocessing.get_context('spawn') # fresh process so the peak RSS is just this case
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                results[case] = pool.submit(run_case, case, sql_path, video_path, encoder, n_segments, n_frames).result()
+            latency = results[case]['latency_ms']
+            print(f"{case:>16}: {results[case]['fps']:8.1f} fps" +
+                  (f"   p50 {latency['p50']:7.2f} ms   p99 {latency['p99']:7.2f} ms" if latency else '') +
+                  (f"   peak {results[case]['peak_rss_mb']:7.1f} MB" if results[case]['peak_rss_mb'] else '') +
+                  (f"   child peak {results[case]['peak_child_rss_mb']:7.1f} MB" if results[case]['peak_child_rss_mb'] else ''))
+    finally:
+        shutil.rmtree(project_dir)
+
+    return {'info':_run_info(width, height, n_frames, encoder, n_segments), 'results':results}
+
+
+
+def _run_info(width:int, height:int, n_frames:int, encoder:dict, n_segments:int):
+    # what we need to know to compare runs
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {'commit':commit, 'time':time.strftime('%Y-%m-%dT%H:%M:%S'), 'host':platform.node(),
+            'python':platform.python_version(), 'opencv':cv2.__version__, 'numpy':np.__version__,
+            'cpus':os.cpu_count(), 'width':width, 'height':height, 'frames':n_frames,
+            'encoder':encoder, 'n_segments':n_segments}
+
+
+
+def compare_results(new:dict, old:dict, threshold:float = 0.1):
+    '''
+    compare two benchmark runs. A case regressed if its fps dropped, or its
+    p90 latency went up, by more than the threshold (as a fraction)
+
+    returns a list of the cases that regressed
+    '''
+    regressions = []
+    print(f"{'case':>16}  {'old fps':>9}  {'new fps':>9}  {'change':>7}")
+    for case, new_result in new['results'].items():
+        if case not in old['results']:
+            continue
+        old_result = old['results'][case]
+        change = new_result['fps'] / old_result['fps'] - 1
+        regressed = change < -threshold
+        if new_result['latency_ms'] and old_result['latency_ms']:
+            regressed |= new_result['latency_ms']['p90'] > old_result['latency_ms']['p90'] * (1 + threshold)
+        print(f"{case:>16}  {old_result['fps']:9.1f}  {new_result['fps']:9.1f}  {change:+7.1%}" + ('  REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(case)
+
+    return regressions
+
+
+
+if __name__ == '__main__':
+    description = '''
+                Benchmarks the video splitting and splicing code on synthetic
+                multiview videos, and optionally compares against an earlier run.
+                '''
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--width', help='frame width [default = 1280]', type=int, default=1280)
+    parser.add_argument('--height', help='frame height [default = 1024]', type=int, default=1024)
+    parser.add_argument('--frames', help='number of frames [default = 300]', type=int, default=300)
+    parser.add_argument('--cases', help='cases to run [default = all]', nargs='+', choices=CASES, default=CASES)
+    parser.add_argument('--segments', help='number of segments for split_segments [default = 4]', type=int, default=4)
+    parser.add_argument('--config', help='config.toml with the [encoder] settings to use', default=None)
+    parser.add_argument('--work_dir', help='where to put the throwaway project [default = system temp]', default=None)
+    parser.add_argument('-o','--output', help='json file for the results', default=None)
+    parser.add_argument('--compare', help='earlier results json to compare against', default=None)
+    parser.add_argument('--threshold', help='allowed slowdown before it counts as a regression [default = 0.1]', type=float, default=0.1)
+    args = parser.parse_args()
+
+    run = run_benchmarks(width=args.width, height=args.height, n_frames=args.frames, cases=args.cases,
+                         encoder=load_encoder_config(args.config), n_segments=args.segments, work_dir=args.work_dir)
+
+    if args.output:
+        with open(args.output, 'w') as fid:
+            json.dump(run, fid, indent=2)
+        print(f'Saved results to {args.output}')
+
+    if args.compare:
+        with open(args.compare, 'r') as fid:
+            old_run = json.load(fid)
+        regressions = compare_results(run, old_run, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} case(s) regressed by more than {args.threshold:.0%}: {", ".join(regressions)}')
+            sys.exit(1)
@@ -0,0 +1,189 @@
+#! /usr/bin/env python
+
+# boundary_detection
+'''
+Find the view boundaries of a mirror box calibration video without anyone
+having to draw them.
+
+A handful of frames get sampled across the video, and we build up maps of
+the mean brightness and how much each pixel changes over time. The views
+are bright and busy, the dividers between them are dark and flat, so
+thresholding the combined map and pulling out the connected components
+gives one blob per view. (Edge maps look tempting, but the strongest edges
+are the borders of the views -- right on top of the dividers -- so they
+end up gluing neighboring views together.) The blob nearest the middle
+of the frame is Center, and the rest get North/South/East/West from where
+they sit relative to it.
+
+    bounds, confidence = detect_boundaries('calib_20240101_.mp4')
+    # {'North': [top, left, bottom, right], ...}, 0.93
+
+The confidence (0 to 1) is low if we didn't find exactly five clean,
+rectangular views that sit where they should, so the caller can hand
+those videos off to the interactive bound_creator.
+'''
+
+import numpy as np
+import cv2
+from typing import List
+from multiview_utils import read_frames_at
+from instrumentation import get_metrics
+
+
+# where each view sits relative to Center, as (x, y) directions
+VIEW_DIRECTIONS = {'north':(0, -1), 'south':(0, 1), 'east':(1, 0), 'west':(-1, 0)}
+
+
+
+def detect_boundaries(video_path:str, view_names:List[str] = ['North','South','East','West','Center'],
+                      n_samples:int = 24, work_width:int = 640, min_area:float = 0.01):
+    '''
+    arguments:
+        - video_path        calibration video
+        - view_names        names of the views. They have to be Center plus North/South/East/West
+        - n_samples         number of frames to look at, spread evenly across the video [default = 24]
+        - work_width        frames get shrunk to this width for the maps [default = 640]
+        - min_area          smallest view we'll consider, as a fraction of the frame [default = 0.01]
+
+    returns ({view_name: [top, left, bottom, right]}, confidence). the boundaries are None if
+    nothing usable turned up
+    '''
+    metrics = get_metrics()
+    with metrics.timer('boundary_sample'):
+        maps = activity_maps(video_path, n_samples, work_width)
+    if maps is None:
+        return None, 0.0
+    score, scale = maps
+
+    with metrics.timer('boundary_components'):
+        components = view_components(score, min_area)
+        bounds, confidence = assign_views(components, score.shape, view_names)
+    if bounds is None:
+        return None, 0.0
+
+    # back to full resolution
+    bounds = {name:[int(round(b/scale)) for b in bound] for name, bound in bounds.items()}
+
+    return bounds, confidence
+
+
+
+def activity_maps(video_path:str, n_samples:int = 24, work_width:int = 640):
+    '''
+    mean brightness and temporal variation of a video, each scaled to 0-1
+    and averaged into a single map at work_width wide
+
+    returns (score map, scale factor from the original frame), or None if
+    we couldn't read any frames
+    '''
+    vid_read = cv2.VideoCapture(video_path)
+    frame_count = int(vid_read.get(cv2.CAP_PROP_FRAME_COUNT))
+    if frame_count <= 0:
+        vid_read.release()
+        return None
+    frame_indices = np.linspace(0, frame_count - 1, min(n_samples, frame_count)).astype(int)
+
+    mean, mean_sq = None, None
+    n_frames = 0
+    for i_frame, frame in read_frames_at(vid_read, frame_indices):
+        if mean is None:
+            scale = min(1.0, work_width / frame.shape[1])
+            size = (int(round(frame.shape[1]*scale)), int(round(frame.shape[0]*scale)))
+            mean, mean_sq = [np.zeros(size[::-1], dtype=np.float64) for i in range(2)]
+
+        gray = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), size, interpolation=cv2.INTER_AREA).astype(np.float64)
+        mean += gray
+        mean_sq += gray**2
+        n_frames += 1
+    vid_read.release()
+
+    if n_frames == 0:
+        return None
+
+    mean /= n_frames
+    variation = np.sqrt(np.maximum(mean_sq/n_frames - mean**2, 0))
+
+    score = (_unit_scale(mean) + _unit_scale(variation)) / 2
+    return score, scale
+
+
+def _unit_scale(image:np.array):
+    # stretch to 0-1, ignoring the extreme pixels
+    low, high = np.percentile(image, [1, 99])
+    if high <= low:
+        return np.zeros_like(image)
+    return np.clip((image - low)/(high - low), 0, 1)
+
+
+
+def view_components(score:np.array, min_area:float = 0.01):
+    '''
+    threshold the score map and split it into blobs. Thin bridges between
+    views get opened up first, then holes inside each blob get filled in (a
+    closing would bridge narrow dividers)
+
+    returns a list of (area, (top, left, bottom, right), (centroid x, centroid y))
+    from largest to smallest
+    '''
+    mask = cv2.threshold((score*255).astype(np.uint8), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+
+    k = max(3, int(min(score.shape)*0.01) | 1)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (k, k))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+    contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0]
+    cv2.drawContours(mask, contours, -1, 255, cv2.FILLED)
+
+    n_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=4)
+    components = []
+    for i_label in range(1, n_labels): # 0 is the background
+        left, top, width, height, area = stats[i_label]
+        if area < min_area*mask.size:
+            continue
+        components.append((int(area), (int(top), int(left), int(top + height), int(left + width)), tuple(centroids[i_label])))
+
+    return sorted(components, key=lambda component: -component[0])
+
+
+
+def assign_views(components:list, shape:tuple, view_names:List[str]):
+    '''
+    name the five biggest components and score how much we trust it:
+        - did we find exactly five views (a 6th big blob counts against us)
+        - how rectangular they are
+        - how cleanly each side view sits in its direction from Center
+
+    returns ({view_name: [top, left, bottom, right]}, confidence), or (None, 0) if
+    we can't name them
+    '''
+    names = {name.lower():name for name in view_names}
+    if sorted(names.keys()) != sorted(list(VIEW_DIRECTIONS.keys()) + ['center']) or len(components) < 5:
+        return None, 0.0
+
+    views = components[:5]
+    count_score = 1.0 if len(components) == 5 else 1.0 - components[5][0]/components[4][0]
+    rect_score = np.mean([area / ((bound[2]-bound[0])*(bound[3]-bound[1])) for area, bound, centroid in views])
+
+    # center is the one nearest the middle of the frame
+    middle = np.array([shape[1]/2, shape[0]/2])
+    i_center = int(np.argmin([np.linalg.norm(np.array(centroid) - middle) for area, bound, centroid in views]))
+    center = np.array(views[i_center][2])
+    bounds = {names['center']:list(views[i_center][1])}
+
+    # then give each direction to the side view that points that way the most
+    sides = [view for i_view, view in enumerate(views) if i_view != i_center]
+    offsets = [(np.array(centroid) - center) / max(np.linalg.norm(np.array(centroid) - center), 1e-9) for area, bound, centroid in sides]
+    alignment = np.array([[offset @ np.array(direction) for direction in VIEW_DIRECTIONS.values()] for offset in offsets])
+
+    direction_scores = []
+    for i_pick in range(4):
+        i_side, i_direction = np.unravel_index(np.argmax(alignment), alignment.shape)
+        direction_scores.append(max(alignment[i_side, i_direction], 0))
+        bounds[names[list(VIEW_DIRECTIONS.keys())[i_direction]]] = list(sides[i_side][1])
+        alignment[i_side, :] = -np.inf
+        alignment[:, i_direction] = -np.inf
+
+    # cos of the angle off the expected direction, pushed down hard as it drifts
+    direction_score = np.min(direction_scores)**4
+    confidence = float(np.clip(count_score * rect_score * direction_score, 0, 1))
+
+    return bounds, confidence
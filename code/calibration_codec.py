@@ -0,0 +1,215 @@
+#! /usr/bin/env python
+
+# calibration_codec
+'''
+Compact binary format for the blob columns of the calibration table
+(boundary, intrinsic and extrinsic).
+
+A blob is a small header followed by one entry per array:
+
+    header      b'MVCB', format version (uint8), number of entries (uint16)
+    entry       name length (uint8), name (utf-8, nested keys joined with '/'),
+                dtype length (uint8), numpy dtype string (eg '<f8'),
+                ndim (uint8), shape (uint32 each), raw little-endian data
+
+Strings get the dtype 'str' and None gets 'none'. Decoding is a single pass
+of struct.unpack_from and np.frombuffer, so the arrays come back with their
+original dtype and shape (read-only, straight out of the blob) instead of
+being parsed out of text.
+
+Rows written before this as json still decode, and migrate_calibrations
+rewrites them in the new format:
+
+    python calibration_codec.py project_tracking.sqlite3
+
+Very old rows pickled with boundary.pkl_it() are refused unless you ask for
+them with --allow_pickle, and even then they go through an unpickler that
+only knows how to rebuild numpy arrays, so a tampered database can't run
+code. Only do that for a database you made yourself.
+'''
+
+import io
+import json
+import math
+import pickle
+import struct
+import argparse
+import numpy as np
+from functools import lru_cache
+from project_db import get_project_db
+
+
+MAGIC = b'MVCB'
+VERSION = 1
+BLOB_COLUMNS = ['boundary', 'intrinsic', 'extrinsic']
+
+_HEADER = struct.Struct('<4sBH')
+
+# everything a pickled dictionary of numpy arrays needs, and nothing else
+_PICKLE_GLOBALS = {('numpy', 'ndarray'), ('numpy', 'dtype'), ('_codecs', 'encode'),
+                   ('numpy.core.multiarray', '_reconstruct'), ('numpy.core.multiarray', 'scalar'),
+                   ('numpy._core.multiarray', '_reconstruct'), ('numpy._core.multiarray', 'scalar')}
+
+
+
+def encode(values:dict):
+    '''
+    dictionary (nested dictionaries allowed) of arrays, lists, numbers,
+    strings or None -> bytes
+    '''
+    entries = list(_flatten(values))
+    parts = [_HEADER.pack(MAGIC, VERSION, len(entries))]
+    for name, value in entries:
+        name = name.encode()
+        if value is None:
+            dtype, shape, data = 'none', (), b''
+        elif isinstance(value, str):
+            data = value.encode()
+            dtype, shape = 'str', (len(data),)
+        else:
+            array = np.asarray(value)
+            if array.dtype.kind not in 'biuf':
+                raise TypeError(f'Can\'t encode {name.decode()} with dtype {array.dtype}')
+            array = array.astype(array.dtype.newbyteorder('<'), copy=False)
+            dtype, shape, data = array.dtype.str, array.shape, np.ascontiguousarray(array).tobytes()
+
+        dtype = dtype.encode()
+        parts.append(struct.pack(f'<B{len(name)}sB{len(dtype)}sB{len(shape)}I', len(name), name, len(dtype), dtype,
+                                 len(shape), *shape))
+        parts.append(data)
+
+    return b''.join(parts)
+
+
+def _flatten(values:dict, prefix:str = ''):
+    # (path, value) for everything in a nested dictionary
+    for key, value in values.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f'{prefix}{key}/')
+        else:
+            yield f'{prefix}{key}', value
+
+
+
+def is_encoded(blob):
+    return isinstance(blob, (bytes, memoryview)) and bytes(blob[:4]) == MAGIC
+
+
+def decode(blob, allow_pickle:bool = False):
+    '''
+    bytes -> nested dictionary of read-only arrays (strings and None come back
+    as themselves). Old json rows get decoded too, and None/empty blobs give
+    None. Pickled rows raise a ValueError unless allow_pickle is set
+    '''
+    if blob is None or len(blob) == 0:
+        return None
+    if not is_encoded(blob):
+        return _decode_legacy(blob, allow_pickle)
+
+    blob = bytes(blob)
+    magic, version, n_entries = _HEADER.unpack_from(blob, 0)
+    if version > VERSION:
+        raise ValueError(f'Calibration blob version {version} is newer than this code understands ({VERSION})')
+
+    values = {}
+    offset = _HEADER.size
+    for i_entry in range(n_entries):
+        name_len = blob[offset]
+        name = blob[offset+1:offset+1+name_len].decode()
+        offset += 1 + name_len
+        dtype_len = blob[offset]
+        dtype = blob[offset+1:offset+1+dtype_len].decode()
+        offset += 1 + dtype_len
+        ndim = blob[offset]
+        shape = struct.unpack_from(f'<{ndim}I', blob, offset+1)
+        offset += 1 + 4*ndim
+
+        if dtype == 'none':
+            value = None
+        elif dtype == 'str':
+            value = blob[offset:offset+shape[0]].decode()
+            offset += shape[0]
+        else:
+            dtype = _dtype(dtype)
+            count = math.prod(shape)
+            value = np.frombuffer(blob, dtype=dtype, count=count, offset=offset).reshape(shape)
+            offset += count*dtype.itemsize
+
+        # back into the nested dictionaries
+        keys = name.split('/')
+        level = values
+        for key in keys[:-1]:
+            level = level.setdefault(key, {})
+        level[keys[-1]] = value
+
+    return values
+
+
+@lru_cache(maxsize=None)
+def _dtype(dtype_str:str):
+    # np.dtype() is surprisingly slow, and there are only a few of them
+    return np.dtype(dtype_str)
+
+
+def _decode_legacy(blob, allow_pickle:bool = False):
+    # json text, or (only if asked for) a pickled dictionary from boundary.pkl_it()
+    if isinstance(blob, (bytes, memoryview)):
+        blob = bytes(blob)
+        try:
+            return json.loads(blob)
+        except ValueError:
+            if not allow_pickle:
+                raise ValueError('Calibration blob is neither the binary format nor json. If it was pickled by an '
+                                 'old version, convert it with: python calibration_codec.py --allow_pickle <sql_path>')
+            return {key:np.array(value).tolist() for key, value in _restricted_loads(blob).items()}
+    return json.loads(blob)
+
+
+class _restricted_unpickler(pickle.Unpickler):
+    # refuses any global that isn't part of rebuilding a numpy array
+    def find_class(self, module:str, name:str):
+        if (module, name) not in _PICKLE_GLOBALS:
+            raise pickle.UnpicklingError(f'Refusing to unpickle {module}.{name} from a calibration blob')
+        return super().find_class(module, name)
+
+
+def _restricted_loads(blob:bytes):
+    values = _restricted_unpickler(io.BytesIO(blob)).load()
+    if not isinstance(values, dict):
+        raise pickle.UnpicklingError(f'Expected a pickled dictionary, got {type(values).__name__}')
+    return values
+
+
+
+def migrate_calibrations(sql_path:str, columns:list = BLOB_COLUMNS, allow_pickle:bool = False):
+    '''
+    rewrite any calibration blobs that aren't in the binary format yet.
+    Safe to run more than once. returns the number of values rewritten.
+    Pickled blobs are only read (with a restricted unpickler) if allow_pickle is set
+    '''
+    db = get_project_db(sql_path)
+
+    updates = []
+    for row in db.calibration_blobs(columns):
+        rowid, blobs = row[0], row[1:]
+        for column, blob in zip(columns, blobs):
+            if blob is None or is_encoded(blob):
+                continue
+            decoded = decode(blob, allow_pickle)
+            updates.append((column, None if decoded is None else encode(decoded), rowid))
+
+    db.set_calibration_blobs(updates)
+
+    return len(updates)
+
+
+
+# arg parsing to run from the command line or just call straight
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the calibration table to the binary blob format')
+    parser.add_argument('sql_path', help='project sqlite file')
+    parser.add_argument('--allow_pickle', '--allow-pickle', help='also convert rows pickled by old versions '
+                        '(only numpy arrays are unpickled -- still, only use this on databases you trust)', action='store_true')
+    args = parser.parse_args()
+
+    print(f'Converted {migrate_calibrations(args.sql_path, allow_pickle=args.allow_pickle)} calibration values')
@@ -0,0 +1,348 @@
+#! /usr/bin/env python
+
+# calibration_engine
+'''
+Intrinsic and extrinsic calibration of each view from a ChArUco calibration
+video, saved into the intrinsic/extrinsic columns of the calibration table.
+
+    - the video gets split into views with its boundaries from the calibration
+      table, the same way video_split_sql does it, so the calibration lives in
+      the same (flipped) image space as the split videos
+    - frames where the board hardly moved get skipped, so detection time
+      depends on how much the board moves rather than how long the video is
+    - ChArUco corners get detected on the remaining frames in a pool of
+      processes, each one seeking through its own share of the frames
+    - each view gets its own intrinsics (pinhole or fisheye), and every view's
+      pose relative to Center comes from the frames where both see the board
+
+The board comes from the [calibration] section of the project config.toml.
+This needs the cv2.aruco.CharucoDetector API (opencv 4.7 or later).
+
+    python calibration_engine.py project_tracking.sqlite3 calib_20240101_.mp4 -j 8
+'''
+
+import os
+import argparse
+import numpy as np
+import cv2
+import toml
+from typing import List
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiview_utils import bound_puller, view_plan, load_transform_config, read_frames_at
+from calibration_codec import encode as encode_calibration
+from instrumentation import get_metrics, enable_metrics, flush_metrics
+from project_db import get_project_db
+
+
+# what we use if config.toml doesn't say otherwise
+DEFAULT_BOARD = {
+    'board_type': 'charuco',
+    'board_size': [6, 6],               # squares across and down
+    'board_marker_bits': 6,             # 6x6 bit markers
+    'board_marker_dict_number': 250,    # markers in the dictionary
+    'board_marker_length': 8,           # mm
+    'board_square_side_length': 10,     # mm
+    'fisheye': False,
+}
+
+REFERENCE_VIEW = 'Center' # extrinsics are relative to this one
+
+
+
+def load_board_config(config_path:str = None):
+    '''
+    read the [calibration] section of a config.toml, filling in anything
+    missing with the defaults
+    '''
+    settings = dict(DEFAULT_BOARD)
+    if config_path is not None and os.path.exists(config_path):
+        settings.update(toml.load(config_path).get('calibration', {}))
+
+    return settings
+
+
+def make_board(settings:dict):
+    '''
+    cv2.aruco.CharucoBoard for the board settings
+    '''
+    if settings['board_type'] != 'charuco':
+        raise ValueError(f'Only charuco boards are supported, not {settings["board_type"]}')
+
+    bits, number = int(settings['board_marker_bits']), int(settings['board_marker_dict_number'])
+    dict_name = f'DICT_{bits}X{bits}_{number}'
+    if not hasattr(cv2.aruco, dict_name):
+        raise ValueError(f'No aruco dictionary {dict_name}')
+
+    aruco_dict = cv2.aruco.getPredefinedDictionary(getattr(cv2.aruco, dict_name))
+    return cv2.aruco.CharucoBoard(tuple(settings['board_size']), float(settings['board_square_side_length']),
+                                  float(settings['board_marker_length']), aruco_dict)
+
+
+
+def calibrate_video(sql_path:str, video_path:str, config_path:str = None, n_workers:int = None,
+                    motion_threshold:float = 0.005, stride:int = 2, max_frames:int = 400,
+                    max_calib_frames:int = 60, min_corners:int = 8, write:bool = True):
+    '''
+    calibrate every view of a calibration video and save it in its calibration row
+
+    arguments:
+        - sql_path          project sqlite file. The video's boundaries have to be in the calibration table already
+        - video_path        ChArUco calibration video
+        - config_path       config.toml with the [calibration] settings. if None, uses the one next to the sql file
+        - n_workers         number of processes for the detection. if None, uses the number of cpus
+        - motion_threshold  fraction of thumbnail pixels that have to change before a frame counts as new [default = 0.005]
+        - stride            only look at every stride-th frame for motion [default = 2]
+        - max_frames        most frames to run detection on [default = 400]
+        - max_calib_frames  most frames per view that go into the intrinsic solve [default = 60]
+        - min_corners       fewest ChArUco corners for a detection to count [default = 8]
+        - write             save the results in the calibration table [default = True]
+
+    returns {'intrinsic': {view: ...}, 'extrinsic': {view: ...}}, or -1 if the video
+    has no boundaries
+    '''
+    metrics = get_metrics()
+    if config_path is None:
+        config_path = os.path.join(os.path.dirname(os.path.abspath(sql_path)), 'config.toml')
+    settings = load_board_config(config_path)
+
+    boundaries = bound_puller(sql_path, video_path, is_calib=True)
+    if boundaries == -1:
+        return -1
+
+    # frames where the board moved
+    with metrics.timer('select_moving_frames'):
+        frames = select_moving_frames(video_path, motion_threshold, stride, max_frames)
+    print(f'{os.path.split(video_path)[-1]}: detecting the board on {len(frames)} frames')
+
+    # detect in parallel -- each worker gets a contiguous run of frames so its seeks stay short
+    detections = {view:{} for view in boundaries}
+    chunks = [chunk for chunk in np.array_split(np.array(frames, dtype=int), n_workers or os.cpu_count() or 1) if len(chunk)]
+    with metrics.timer('detect_charuco'):
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(_detect_worker, video_path, boundaries, config_path, settings, chunk.tolist(), min_corners)
+                       for chunk in chunks]
+            for future in as_completed(futures):
+                for view, view_detections in future.result().items():
+                    detections[view].update(view_detections)
+
+    # sizes of each view after splitting
+    vid_read = cv2.VideoCapture(video_path)
+    frame_shape = (int(vid_read.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(vid_read.get(cv2.CAP_PROP_FRAME_WIDTH)))
+    vid_read.release()
+    image_sizes = view_plan(boundaries, frame_shape, load_transform_config(config_path)).frame_sizes()
+
+    board = make_board(settings)
+    with metrics.timer('intrinsics'):
+        intrinsic = {view:solve_intrinsics(board, detections[view], image_sizes[view], settings['fisheye'], max_calib_frames)
+                     for view in boundaries}
+    with metrics.timer('extrinsics'):
+        extrinsic = solve_extrinsics(board, detections, intrinsic)
+
+    for view in boundaries:
+        if intrinsic[view] is None:
+            print(f'    {view}: not enough board detections to calibrate')
+        else:
+            message = f'    {view}: {intrinsic[view]["n_frames"]} frames, reprojection error {intrinsic[view]["rms"]:.3f} px'
+            if extrinsic.get(view) is not None and view != REFERENCE_VIEW:
+                message += f', {extrinsic[view]["n_frames"]} frames shared with {REFERENCE_VIEW}'
+            print(message)
+
+    if write:
+        with metrics.timer('sql_write'):
+            write_calibration(sql_path, video_path, intrinsic, extrinsic)
+
+    return {'intrinsic':intrinsic, 'extrinsic':extrinsic}
+
+
+
+def select_moving_frames(video_path:str, motion_threshold:float = 0.005, stride:int = 2, max_frames:int = 400,
+                         thumb_width:int = 160, pixel_threshold:int = 10):
+    '''
+    frame indices where the picture changed enough from the last frame we
+    kept -- more than motion_threshold of the thumbnail pixels changed by more
+    than pixel_threshold. The board is only a small part of the frame, so this
+    works better than the mean difference. Every frame still gets grab()bed,
+    but only every stride-th one gets decoded and compared, and only on a
+    small grayscale thumbnail. If more than max_frames are left we take an
+    even spread of them
+    '''
+    vid_read = cv2.VideoCapture(video_path)
+    kept = []
+    last = None
+    i_frame = 0
+    frame = None
+    while vid_read.grab():
+        if i_frame % stride == 0:
+            ret, frame = vid_read.retrieve(frame)
+            if ret:
+                scale = thumb_width / frame.shape[1]
+                thumb = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                if last is None or (cv2.absdiff(thumb, last) > pixel_threshold).mean() > motion_threshold:
+                    kept.append(i_frame)
+                    last = thumb
+        i_frame += 1
+    vid_read.release()
+
+    if len(kept) > max_frames:
+        kept = [kept[i] for i in np.linspace(0, len(kept) - 1, max_frames).astype(int)]
+
+    return kept
+
+
+
+def _detect_worker(video_path:str, boundaries:dict, config_path:str, settings:dict, frames:List[int], min_corners:int):
+    '''
+    split the frames into views and find the ChArUco corners in each one
+
+    returns {view: {frame index: (corners (n, 2), ids (n,))}}
+    '''
+    detector = cv2.aruco.CharucoDetector(make_board(settings))
+    vid_read = cv2.VideoCapture(video_path)
+    plan = view_plan(boundaries, (int(vid_read.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(vid_read.get(cv2.CAP_PROP_FRAME_WIDTH))),
+                     load_transform_config(config_path))
+    gray = {view:np.empty(buffer.shape[:2], dtype=np.uint8) for view, buffer in plan.buffers.items()}
+
+    detections = {view:{} for view in boundaries}
+    try:
+        for i_frame, frame in read_frames_at(vid_read, frames):
+            for view, image in plan.apply(frame).items():
+                cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=gray[view])
+                corners, ids = detector.detectBoard(gray[view])[:2]
+                if ids is not None and len(ids) >= min_corners:
+                    detections[view][i_frame] = (corners.reshape(-1, 2), ids.reshape(-1))
+    finally:
+        vid_read.release()
+        flush_metrics() # pool workers exit without running atexit
+
+    return detections
+
+
+
+def solve_intrinsics(board, detections:dict, image_size:tuple, fisheye:bool = False, max_calib_frames:int = 60):
+    '''
+    camera matrix and distortion for a single view from its detections.
+    Uses an even spread of at most max_calib_frames frames
+
+    returns a dictionary of plain lists and numbers, or None if there weren't enough detections
+    '''
+    frames = sorted(detections.keys())
+    if len(frames) > max_calib_frames:
+        frames = [frames[i] for i in np.linspace(0, len(frames) - 1, max_calib_frames).astype(int)]
+
+    object_points, image_points = [], []
+    for i_frame in frames:
+        corners, ids = detections[i_frame]
+        obj, img = board.matchImagePoints(corners.reshape(-1, 1, 2), ids.reshape(-1, 1))
+        if obj is None or len(obj) < 6 or board.checkCharucoCornersCollinear(ids.reshape(-1, 1)):
+            continue
+        object_points.append(obj.reshape(-1, 1, 3).astype(np.float64 if fisheye else np.float32)) # fisheye wants doubles, the rest floats
+        image_points.append(img.reshape(-1, 1, 2).astype(np.float64 if fisheye else np.float32))
+    if len(object_points) < 4:
+        return None
+
+    if fisheye:
+        flags = cv2.fisheye.CALIB_RECOMPUTE_EXTRINSIC | cv2.fisheye.CALIB_FIX_SKEW
+        criteria = (cv2.TERM_CRITERIA_COUNT + cv2.TERM_CRITERIA_EPS, 100, 1e-6)
+        rms, camera_matrix, dist_coeffs, rvecs, tvecs = cv2.fisheye.calibrate(object_points, image_points, tuple(image_size),
+                                                                            None, None, flags=flags, criteria=criteria)
+    else:
+        rms, camera_matrix, dist_coeffs, rvecs, tvecs = cv2.calibrateCamera(object_points, image_points, tuple(image_size), None, None)
+
+    return {'model':'fisheye' if fisheye else 'pinhole', 'image_size':list(image_size), 'rms':float(rms),
+            'n_frames':len(object_points), 'camera_matrix':camera_matrix.tolist(), 'dist_coeffs':dist_coeffs.ravel().tolist()}
+
+
+
+def solve_extrinsics(board, detections:dict, intrinsic:dict, reference:str = REFERENCE_VIEW):
+    '''
+    pose of every view relative to the reference view (x_view = R x_reference + t),
+    averaged over the frames where both of them saw the board
+
+    returns {view: {'rvec', 'tvec', 'n_frames', 'rotation_spread'}} (None for views we couldn't place)
+    '''
+    if intrinsic.get(reference) is None:
+        return {view:None for view in detections}
+
+    reference_poses = _board_poses(board, detections[reference], intrinsic[reference])
+    extrinsic = {}
+    for view in detections:
+        if view == reference:
+            extrinsic[view] = {'rvec':[0.0, 0.0, 0.0], 'tvec':[0.0, 0.0, 0.0], 'n_frames':len(reference_poses), 'rotation_spread':0.0}
+            continue
+        if intrinsic[view] is None:
+            extrinsic[view] = None
+            continue
+
+        # board -> view and board -> reference give reference -> view for each shared frame
+        view_poses = _board_poses(board, detections[view], intrinsic[view])
+        shared = sorted(set(view_poses) & set(reference_poses))
+        if not shared:
+            extrinsic[view] = None
+            continue
+        rotations, translations = [], []
+        for i_frame in shared:
+            r_view, t_view = view_poses[i_frame]
+            r_ref, t_ref = reference_poses[i_frame]
+            rotations.append(r_view @ r_ref.T)
+            translations.append(t_view - rotations[-1] @ t_ref)
+
+        # closest rotation to the average, and the median translation
+        u, s, vt = np.linalg.svd(np.mean(rotations, axis=0))
+        rotation = u @ np.diag([1, 1, np.linalg.det(u @ vt)]) @ vt
+        spread = np.degrees(np.median([np.linalg.norm(cv2.Rodrigues(r @ rotation.T)[0]) for r in rotations]))
+        extrinsic[view] = {'rvec':cv2.Rodrigues(rotation)[0].ravel().tolist(),
+                           'tvec':np.median(translations, axis=0).ravel().tolist(),
+                           'n_frames':len(shared), 'rotation_spread':float(spread)}
+
+    return extrinsic
+
+
+def _board_poses(board, detections:dict, intrinsic:dict):
+    # rotation matrix and translation of the board in each frame, from the view's point of view
+    camera_matrix = np.array(intrinsic['camera_matrix'])
+    dist_coeffs = np.array(intrinsic['dist_coeffs'])
+
+    poses = {}
+    for i_frame, (corners, ids) in detections.items():
+        obj, img = board.matchImagePoints(corners.reshape(-1, 1, 2), ids.reshape(-1, 1))
+        if obj is None or len(obj) < 6 or board.checkCharucoCornersCollinear(ids.reshape(-1, 1)):
+            continue
+        if intrinsic['model'] == 'fisheye': # undistort first, then it's a plain pinhole problem
+            img = cv2.fisheye.undistortPoints(img.reshape(-1, 1, 2).astype(np.float64), camera_matrix, dist_coeffs, P=camera_matrix)
+            ret, rvec, tvec = cv2.solvePnP(obj, img, camera_matrix, None)
+        else:
+            ret, rvec, tvec = cv2.solvePnP(obj, img, camera_matrix, dist_coeffs)
+        if ret:
+            poses[i_frame] = (cv2.Rodrigues(rvec)[0], tvec.reshape(3, 1))
+
+    return poses
+
+
+
+def write_calibration(sql_path:str, video_path:str, intrinsic:dict, extrinsic:dict):
+    '''
+    save the intrinsics and extrinsics in the calibration video's row
+    '''
+    get_project_db(sql_path).set_calibration(video_path, encode_calibration(intrinsic), encode_calibration(extrinsic))
+
+
+
+# arg parsing to run from the command line or just call straight
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calibrate each view of ChArUco calibration videos')
+    parser.add_argument('sql_path', help='project sqlite file')
+    parser.add_argument('videos', nargs='+', help='calibration videos (their boundaries need to be in the calibration table)')
+    parser.add_argument('--config', help='config.toml with the [calibration] settings', default=None)
+    parser.add_argument('-j','--workers', type=int, help='number of worker processes', default=None)
+    parser.add_argument('--max_frames', type=int, help='most frames to run detection on', default=400)
+    parser.add_argument('--motion', type=float, help='fraction of the frame that has to change for it to be used', default=0.005)
+    parser.add_argument('--metrics', help='write timing metrics to this JSON-lines file', default=None)
+    args = parser.parse_args()
+
+    if args.metrics:
+        enable_metrics(args.metrics)
+
+    for video in args.videos:
+        if calibrate_video(args.sql_path, video, args.config, n_workers=args.workers,
+                           motion_threshold=args.motion, max_frames=args.max_frames) == -1:
+            print(f'No boundaries for {video} -- run multiview_calibration_preparation on it first')
@@ -0,0 +1,315 @@
+#! /usr/bin/env python
+
+# frame_selection
+'''
+Pick label frames that cover as much of the behavior as possible, instead
+of picking them at random.
+
+Each video gets streamed once into a thumbnail_sampler, which keeps small
+grayscale thumbnails of evenly spaced frames in a fixed size buffer (so
+memory doesn't depend on how long the video is). The thumbnails from all of
+the videos get reduced with an incremental PCA, then mini-batch k-means
+picks the frames closest to each cluster center -- first a pool of
+candidates for each video, then the final set across all of the videos.
+
+    selected = select_frames(video_paths, num_frames=200)
+    # {video_path: [frame indices]}
+
+The sampler can also sit in an existing decode loop:
+
+    sampler = thumbnail_sampler()
+    for i_frame, frame in ...:
+        sampler.add(i_frame, frame)
+'''
+
+import os
+import zlib
+import numpy as np
+import cv2
+from typing import List
+from instrumentation import get_metrics
+
+
+
+class thumbnail_sampler():
+    '''
+    keeps thumbnails of every stride-th frame, and when the buffer fills up
+    drops every other one and doubles the stride. The thumbnails we keep are
+    always evenly spread over the frames we've seen so far, and there are
+    never more than capacity of them
+    '''
+    def __init__(self, size:tuple = (32, 24), capacity:int = 2048):
+        self.size = tuple(size) # (width, height), same as cv2.resize
+        self.capacity = int(capacity) - int(capacity) % 2 # even, so halving always works out
+        self.stride = 1
+        self.n_kept = 0
+        self.indices = np.empty(self.capacity, dtype=np.int64)
+        self.thumbs = np.empty((self.capacity, self.size[0]*self.size[1]), dtype=np.uint8)
+        self.gray = np.empty(self.size[::-1], dtype=np.uint8) # scratch image
+
+    def wants(self, i_frame:int):
+        # would this frame get kept? if not, the decode loop can just grab() past it
+        return i_frame % self.stride == 0
+
+    def add(self, i_frame:int, frame:np.array):
+        if not self.wants(i_frame):
+            return False
+
+        # make room if we have to
+        if self.n_kept == self.capacity:
+            self._decimate()
+            if not self.wants(i_frame):
+                return False
+
+        small = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        else:
+            self.gray[:] = small
+        self.thumbs[self.n_kept] = self.gray.ravel()
+        self.indices[self.n_kept] = i_frame
+        self.n_kept += 1
+        return True
+
+    def samples(self):
+        # (frame indices, thumbnails) of everything we've kept
+        return self.indices[:self.n_kept], self.thumbs[:self.n_kept]
+
+    def _decimate(self):
+        # keep every other thumbnail (the ones still on the doubled stride)
+        self.stride *= 2
+        keep = np.flatnonzero(self.indices[:self.n_kept] % self.stride == 0)
+        self.indices[:len(keep)] = self.indices[keep]
+        self.thumbs[:len(keep)] = self.thumbs[keep]
+        self.n_kept = len(keep)
+
+
+
+def sample_video(video_path:str, sampler:thumbnail_sampler = None):
+    '''
+    run a whole video through a thumbnail sampler. Frames the sampler
+    doesn't want only get grab()ed, not decoded into BGR
+    '''
+    if sampler is None:
+        sampler = thumbnail_sampler()
+
+    metrics = get_metrics()
+    vid_read = cv2.VideoCapture(video_path)
+    i_frame = 0
+    frame = None
+    while True:
+        with metrics.timer('grab'):
+            ret = vid_read.grab()
+        if not ret:
+            break
+        if sampler.wants(i_frame):
+            with metrics.timer('decode'):
+                ret, frame = vid_read.retrieve(frame)
+            if ret:
+                with metrics.timer('thumbnail'):
+                    sampler.add(i_frame, frame)
+        i_frame += 1
+        metrics.progress('frames')
+    vid_read.release()
+
+    return sampler
+
+
+
+class incremental_pca():
+    '''
+    PCA fit a batch at a time (same update as Ross et al. 2008 / sklearn's
+    IncrementalPCA), so we never need all of the thumbnails at once
+    '''
+    def __init__(self, n_components:int = 16):
+        self.n_components = n_components
+        self.n_samples = 0
+        self.mean = None
+        self.components = None # (n_components, n_features)
+        self.singular_values = None
+
+    def partial_fit(self, data:np.array):
+        data = np.asarray(data, dtype=np.float64)
+        n_new = data.shape[0]
+        if n_new == 0:
+            return self
+
+        batch_mean = data.mean(axis=0)
+        if self.mean is None:
+            stacked = data - batch_mean
+            mean = batch_mean
+        else:
+            # old components, new centered data and the shift of the mean
+            n_total = self.n_samples + n_new
+            mean = (self.n_samples*self.mean + n_new*batch_mean) / n_total
+            correction = np.sqrt(self.n_samples*n_new / n_total) * (self.mean - batch_mean)
+            stacked = np.vstack([self.singular_values[:, None]*self.components, data - batch_mean, correction])
+
+        _, singular_values, vt = np.linalg.svd(stacked, full_matrices=False)
+        n_keep = min(self.n_components, len(singular_values))
+        self.components = vt[:n_keep]
+        self.singular_values = singular_values[:n_keep]
+        self.mean = mean
+        self.n_samples += n_new
+        return self
+
+    def transform(self, data:np.array):
+        return (np.asarray(data, dtype=np.float64) - self.mean) @ self.components.T
+
+
+
+def minibatch_kmeans(data:np.array, n_clusters:int, batch_size:int = 256, n_iter:int = 100, seed:int = 0):
+    '''
+    mini-batch k-means (Sculley 2010) with k-means++ starting centers
+
+    returns (centers, labels)
+    '''
+    data = np.asarray(data, dtype=np.float64)
+    n_clusters = min(n_clusters, len(data))
+    rng = np.random.default_rng(seed)
+
+    # k-means++ -- each new center is picked in proportion to its squared distance from the others
+    centers = np.empty((n_clusters, data.shape[1]))
+    centers[0] = data[rng.integers(len(data))]
+    dist = ((data - centers[0])**2).sum(axis=1)
+    for i_center in range(1, n_clusters):
+        if dist.sum() > 0:
+            centers[i_center] = data[rng.choice(len(data), p=dist/dist.sum())]
+        else: # everything left is a duplicate
+            centers[i_center] = data[rng.integers(len(data))]
+        dist = np.minimum(dist, ((data - centers[i_center])**2).sum(axis=1))
+
+    # nudge the centers toward random batches, with a per-center learning rate
+    counts = np.zeros(n_clusters)
+    batch_size = min(batch_size, len(data))
+    for i_iter in range(n_iter):
+        batch = data[rng.choice(len(data), batch_size, replace=False)]
+        nearest = _nearest(batch, centers)
+        batch_counts = np.bincount(nearest, minlength=n_clusters)
+        batch_sums = np.zeros_like(centers)
+        np.add.at(batch_sums, nearest, batch)
+        counts += batch_counts
+        moved = batch_counts > 0
+        centers[moved] += (batch_sums[moved] - batch_counts[moved, None]*centers[moved]) / counts[moved, None]
+
+    return centers, _nearest(data, centers)
+
+
+def _nearest(data:np.array, centers:np.array):
+    # index of the closest center for each row of data
+    dist = (data**2).sum(axis=1)[:, None] - 2*data @ centers.T + (centers**2).sum(axis=1)[None, :]
+    return dist.argmin(axis=1)
+
+
+
+def most_diverse(features:np.array, n_select:int, seed:int = 0):
+    '''
+    cluster the features into n_select groups and take the row closest to
+    each center. returns the (sorted) row indices
+    '''
+    if n_select >= len(features):
+        return np.arange(len(features))
+
+    centers, labels = minibatch_kmeans(features, n_select, seed=seed)
+    selected = []
+    for i_center, center in enumerate(centers):
+        members = np.flatnonzero(labels == i_center)
+        if len(members) == 0:
+            continue
+        selected.append(members[((features[members] - center)**2).sum(axis=1).argmin()])
+
+    # empty clusters can leave us short, so fill in with whichever of the rows we
+    # haven't picked is farthest from what we have (duplicate rows are all 0 away)
+    selected = [int(index) for index in dict.fromkeys(selected)]
+    remaining = np.setdiff1d(np.arange(len(features)), selected)
+    dist = np.full(len(remaining), np.inf)
+    for index in selected:
+        dist = np.minimum(dist, ((features[remaining] - features[index])**2).sum(axis=1))
+    while len(selected) < n_select:
+        farthest = int(dist.argmax())
+        selected.append(int(remaining[farthest]))
+        remaining, dist = np.delete(remaining, farthest), np.delete(dist, farthest)
+        dist = np.minimum(dist, ((features[remaining] - features[selected[-1]])**2).sum(axis=1))
+
+    return np.sort(np.array(selected))
+
+
+
+def select_frames(video_paths:List[str], num_frames:int, oversample:int = 4, n_components:int = 16,
+                  size:tuple = (32, 24), capacity:int = 2048, seed:int = 0):
+    '''
+    pick num_frames label frames spread across the videos
+
+    arguments:
+        - video_paths       videos to choose from
+        - num_frames        total number of frames to pick
+        - oversample        each video puts forward oversample times its share of candidates
+                            for the final round [default = 4]
+        - n_components      PCA dimensions to cluster in [default = 16]
+        - size              (width, height) of the thumbnails [default = (32, 24)]
+        - capacity          most thumbnails kept for a single video [default = 2048]
+        - seed              random seed, so the same videos always give the same frames [default = 0]
+
+    returns {video_path: sorted list of frame indices}
+    '''
+    metrics = get_metrics()
+
+    # thumbnails for each video, one video at a time so only one sampler is ever full
+    samples = {}
+    pca = incremental_pca(n_components)
+    for video_path in video_paths:
+        with metrics.timer('sample_video'):
+            indices, thumbs = sample_video(video_path, thumbnail_sampler(size, capacity)).samples()
+        if len(indices) == 0:
+            print(f'Couldn\'t read any frames from {video_path}')
+            continue
+        with metrics.timer('pca'):
+            pca.partial_fit(thumbs)
+        samples[video_path] = (indices.copy(), thumbs.copy())
+
+    # the best candidates from each video
+    root = common_root(video_paths)
+    per_vid = int(np.ceil(num_frames*oversample / max(len(samples), 1)))
+    candidates = [] # (video_path, frame index)
+    features = []
+    for video_path, (indices, thumbs) in samples.items():
+        with metrics.timer('cluster'):
+            video_features = pca.transform(thumbs)
+            keep = most_diverse(video_features, per_vid, seed=video_seed(video_path, seed, root))
+        candidates += [(video_path, int(indices[i])) for i in keep]
+        features.append(video_features[keep])
+
+    # then the best of those across the whole set
+    selected = {video_path:[] for video_path in video_paths}
+    if candidates:
+        with metrics.timer('cluster'):
+            keep = most_diverse(np.vstack(features), num_frames, seed=seed)
+        for i_candidate in keep:
+            video_path, i_frame = candidates[i_candidate]
+            selected[video_path].append(i_frame)
+
+    return {video_path:sorted(frames) for video_path, frames in selected.items()}
+
+
+def common_root(video_paths:List[str]):
+    # the deepest directory all of the videos are under
+    if len(video_paths) == 0:
+        return None
+    return os.path.commonpath([os.path.dirname(os.path.abspath(video_path)) for video_path in video_paths])
+
+
+def video_key(video_path:str, root:str = None):
+    '''
+    a name for a video that's unique within a set of videos: its path below
+    root (with / between directories), or just the file name if there's no root.
+    Videos from different days often have the same file name, so anything
+    that has to tell them apart should pass the root (see common_root)
+    '''
+    if root is None:
+        return os.path.basename(video_path)
+    return os.path.relpath(os.path.abspath(video_path), root).replace(os.sep, '/')
+
+
+def video_seed(video_path:str, seed:int, root:str = None):
+    # a seed for each video that doesn't depend on the order they come in
+    return zlib.crc32(video_key(video_path, root).encode()) ^ seed
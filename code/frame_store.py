@@ -0,0 +1,156 @@
+#! /usr/bin/env python
+
+# frame_store
+'''
+Chunked, memory-mapped frame storage for the split views.
+
+Each view is a directory of .npy chunks (chunk_frames frames each) plus a
+small index.json with the frame shape, fps and which frames live in which
+chunk. Reading a frame is just indexing into an np.memmap -- no decoding
+and no copy -- so random access for labeling and training is cheap.
+
+    store = frame_store('session_North.frames')
+    frame = store[12345]
+
+frame_store_writer has the same write()/release() interface as the video
+writers, so it's available as the "npy" encoder backend.
+'''
+
+import os
+import json
+import shutil
+import numpy as np
+from bisect import bisect_right
+from typing import List
+
+
+INDEX_NAME = 'index.json'
+
+
+
+class frame_store_writer():
+    # write frames into memory mapped npy chunks
+    def __init__(self, path:str, fps:float, frame_size:tuple, chunk_frames:int = 1000):
+        self.path = path
+        self.fps = fps
+        self.shape = (int(frame_size[1]), int(frame_size[0]), 3) # (height, width, 3)
+        self.chunk_frames = int(chunk_frames)
+
+        self.chunks = [] # list of the chunk info for the index
+        self.chunk = None # the memmap we're currently filling
+        self.i_chunk = 0 # frames in the current chunk
+
+        # start from scratch
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+    def write(self, frame:np.array):
+        if frame.shape != self.shape:
+            raise ValueError(f'{self.path}: expected {self.shape} frames, got {frame.shape}')
+
+        # new chunk if we need one
+        if self.chunk is None or self.i_chunk == self.chunk_frames:
+            self._close_chunk()
+            chunk_name = f'chunk_{len(self.chunks):05d}.npy'
+            self.chunk = np.lib.format.open_memmap(os.path.join(self.path, chunk_name), mode='w+', dtype=np.uint8,
+                                                   shape=(self.chunk_frames,) + self.shape)
+            start = self.chunks[-1]['start'] + self.chunks[-1]['frames'] if self.chunks else 0
+            self.chunks.append({'file':chunk_name, 'start':start, 'frames':0})
+            self.i_chunk = 0
+
+        self.chunk[self.i_chunk] = frame
+        self.i_chunk += 1
+        self.chunks[-1]['frames'] = self.i_chunk
+
+    def release(self):
+        if self.path is None: # already closed
+            return
+        self._close_chunk()
+        _write_index(self.path, self.shape, self.fps, self.chunk_frames, self.chunks)
+        self.path = None
+
+    def _close_chunk(self):
+        # flush the current chunk, trimming it down if it isn't full
+        if self.chunk is None:
+            return
+        self.chunk.flush()
+        if self.i_chunk < self.chunk_frames:
+            chunk_path = os.path.join(self.path, self.chunks[-1]['file'])
+            trimmed = np.array(self.chunk[:self.i_chunk])
+            del self.chunk
+            np.save(chunk_path, trimmed)
+        self.chunk = None
+
+
+
+class frame_store():
+    '''
+    lazy reader for a frame store directory. Only the index gets read when
+    it's opened; each chunk is memory mapped the first time it's needed.
+    Indexing with an int gives a read-only view into the memmap.
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        with open(os.path.join(path, INDEX_NAME), 'r') as fid:
+            index = json.load(fid)
+
+        self.shape = tuple(index['shape'])
+        self.fps = index['fps']
+        self.frame_count = index['frame_count']
+        self.chunk_files = [chunk['file'] for chunk in index['chunks']]
+        self.chunk_starts = [chunk['start'] for chunk in index['chunks']]
+        self._chunks = {} # memmaps we've already opened
+
+    def __len__(self):
+        return self.frame_count
+
+    def __getitem__(self, i_frame):
+        if isinstance(i_frame, slice):
+            return np.stack([self[i] for i in range(*i_frame.indices(self.frame_count))])
+        if i_frame < 0:
+            i_frame += self.frame_count
+        if not 0 <= i_frame < self.frame_count:
+            raise IndexError(f'frame {i_frame} out of range for {self.frame_count} frames')
+
+        i_chunk = bisect_right(self.chunk_starts, i_frame) - 1
+        return self.chunk(i_chunk)[i_frame - self.chunk_starts[i_chunk]]
+
+    def chunk(self, i_chunk:int):
+        # memory map a chunk the first time we need it
+        if i_chunk not in self._chunks:
+            self._chunks[i_chunk] = np.load(os.path.join(self.path, self.chunk_files[i_chunk]), mmap_mode='r')
+        return self._chunks[i_chunk]
+
+
+
+def concat_frame_stores(store_paths:List[str], out_path:str):
+    '''
+    join frame stores end to end by moving their chunks into a new store
+    (no frames get copied), then remove the originals
+    '''
+    if os.path.exists(out_path):
+        shutil.rmtree(out_path)
+    os.makedirs(out_path)
+
+    chunks = []
+    for store_path in store_paths:
+        with open(os.path.join(store_path, INDEX_NAME), 'r') as fid:
+            index = json.load(fid)
+        for chunk in index['chunks']:
+            chunk_name = f'chunk_{len(chunks):05d}.npy'
+            os.replace(os.path.join(store_path, chunk['file']), os.path.join(out_path, chunk_name))
+            start = chunks[-1]['start'] + chunks[-1]['frames'] if chunks else 0
+            chunks.append({'file':chunk_name, 'start':start, 'frames':chunk['frames']})
+        shutil.rmtree(store_path)
+
+    _write_index(out_path, index['shape'], index['fps'], index['chunk_frames'], chunks)
+
+
+
+def _write_index(path:str, shape:tuple, fps:float, chunk_frames:int, chunks:list):
+    # the json index that sits next to the chunks
+    index = {'version':1, 'shape':list(shape), 'dtype':'uint8', 'fps':fps, 'chunk_frames':chunk_frames,
+             'frame_count':sum([chunk['frames'] for chunk in chunks]), 'chunks':chunks}
+    with open(os.path.join(path, INDEX_NAME), 'w') as fid:
+        json.dump(index, fid, indent=1)
@@ -0,0 +1,219 @@
+#! /usr/bin/env python
+
+# instrumentation
+'''
+Lightweight timers and counters for the pipeline scripts.
+
+Metrics are off unless enable_metrics() gets called (the scripts do that
+with --metrics) or the PIPELINE_METRICS environment variable points at a
+file. While they're off every call hits a do-nothing recorder, so leaving
+the timers in the frame loops costs next to nothing.
+
+    metrics = get_metrics()
+    with metrics.timer('decode'):
+        ret, frame = vid_read.read()
+    metrics.progress('split')
+
+When it's on we get:
+    - total time and number of calls for each named timer
+    - counters
+    - a progress line with the live fps every few seconds
+    - a JSON-lines file with progress, events and a summary at the end of the run
+
+Worker processes get their own recorder writing to the same file, and
+every record carries the pid. Pool workers never get to run atexit, so each
+worker task ends with flush_metrics(), which writes the process' summary so
+far -- the last summary from each pid has its totals.
+'''
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+
+
+ENV_VAR = 'PIPELINE_METRICS'
+
+
+
+class _null_timer():
+    # context manager that does nothing
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _null_timer()
+
+
+
+class null_recorder():
+    # stand-in recorder for when metrics are turned off
+    enabled = False
+
+    def timer(self, name:str):
+        return _NULL_TIMER
+
+    def count(self, name:str, n:int = 1):
+        pass
+
+    def progress(self, name:str, n:int = 1):
+        pass
+
+    def event(self, name:str, **fields):
+        pass
+
+    def totals(self):
+        return {}
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+
+class _timer():
+    # adds the time spent inside the with block to a recorder
+    __slots__ = ('recorder', 'name', 't_start')
+
+    def __init__(self, recorder, name:str):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.t_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder.add_time(self.name, time.perf_counter() - self.t_start)
+        return False
+
+
+
+class metrics_recorder():
+    '''
+    keeps named timers and counters for a run, prints a progress line
+    every progress_every seconds and writes records to a JSON-lines file
+    '''
+    enabled = True
+
+    def __init__(self, path:str = None, progress_every:float = 5.0):
+        if path is None:
+            path = f'metrics_{time.strftime("%Y%m%d_%H%M%S")}_{os.getpid()}.jsonl'
+        self.path = path
+        self.pid = os.getpid()
+        self.progress_every = progress_every
+
+        self.times = {} # name -> seconds
+        self.calls = {} # name -> number of times the timer ran
+        self.counts = {} # name -> counter
+        self.t_start = time.perf_counter()
+        self.t_progress = {} # name -> (time, count) of the last progress line
+        self.lock = threading.Lock() # the pipelined split times things from several threads
+
+        self.fid = open(path, 'a', buffering=1) # line buffered, so records from each process stay whole
+        self.event('start', argv=sys.argv)
+
+    def timer(self, name:str):
+        return _timer(self, name)
+
+    def add_time(self, name:str, seconds:float):
+        with self.lock:
+            self.times[name] = self.times.get(name, 0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def count(self, name:str, n:int = 1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def progress(self, name:str, n:int = 1):
+        # count n more items (usually frames), and print the rate if it's been a while
+        self.count(name, n)
+        now = time.perf_counter()
+        t_last, n_last = self.t_progress.get(name, (self.t_start, 0))
+        if now - t_last < self.progress_every:
+            return
+
+        total = self.counts[name]
+        rate = (total - n_last) / (now - t_last)
+        self.t_progress[name] = (now, total)
+        print(f'[{name}] {total} done, {rate:.1f}/s ({total/(now - self.t_start):.1f}/s overall)')
+        self.event('progress', counter=name, total=total, rate=rate)
+
+    def event(self, name:str, **fields):
+        # write a single record to the metrics file
+        record = {'event':name, 'time':time.time(), 'elapsed':time.perf_counter() - self.t_start, 'pid':os.getpid()}
+        record.update(fields)
+        self.fid.write(json.dumps(record, default=str) + '\n')
+
+    def totals(self):
+        # everything we've recorded so far
+        with self.lock:
+            return {'timers':{name:{'seconds':self.times[name], 'calls':self.calls[name]} for name in self.times},
+                    'counts':dict(self.counts)}
+
+    def flush(self):
+        # write a summary of everything so far (running totals, so the last one counts)
+        if self.fid.closed:
+            return
+        self.event('summary', **self.totals())
+
+    def close(self):
+        if self.fid.closed:
+            return
+        self.flush()
+        self.fid.close()
+
+
+
+_recorder = null_recorder()
+
+def get_metrics():
+    '''
+    the recorder for this process. A forked worker gets a fresh recorder
+    pointed at the same file, instead of sharing its parent's
+    '''
+    global _recorder
+    if _recorder.enabled and _recorder.pid != os.getpid():
+        _recorder = metrics_recorder(_recorder.path, _recorder.progress_every)
+    return _recorder
+
+
+def enable_metrics(path:str = None, progress_every:float = 5.0):
+    '''
+    turn on metrics for this process (and any worker processes it starts),
+    writing to a JSON-lines file at path
+    '''
+    global _recorder
+    _recorder.close()
+    _recorder = metrics_recorder(path, progress_every)
+    os.environ[ENV_VAR] = os.path.abspath(_recorder.path) # so spawned workers turn them on too
+    atexit.register(_recorder.close)
+    return _recorder
+
+
+def flush_metrics():
+    '''
+    write this process' summary now. Pool workers call it at the end of each
+    task, since they exit without running atexit
+    '''
+    get_metrics().flush()
+
+
+def disable_metrics():
+    global _recorder
+    _recorder.close()
+    _recorder = null_recorder()
+    os.environ.pop(ENV_VAR, None)
+
+
+
+# turn them on if the environment asks for it
+if os.environ.get(ENV_VAR):
+    _recorder = metrics_recorder(os.environ[ENV_VAR])
+    atexit.register(_recorder.close)
@@ -15,9 +15,18 @@ import cv2, glob, random, argparse, time
 from typing import List
 from pprint import pprint
 from matplotlib import pyplot as plt
-import sqlite3
 import json # turning the dictionaries etc into something clean for sqlite
 import pickle
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from video_writers import load_encoder_config, open_writer
+from multiview_utils import date_from_name, gamma_lut, bound_puller, read_frames_at, load_transform_config, view_transforms
+from frame_selection import select_frames, video_seed, video_key, common_root
+from boundary_detection import detect_boundaries
+from calibration_engine import calibrate_video, make_board, DEFAULT_BOARD
+from calibration_codec import encode as encode_calibration
+from instrumentation import get_metrics, enable_metrics, flush_metrics
+from project_db import get_project_db, file_fingerprint, fingerprint_files
 
 # file explorer
 from tkinter import Tk
@@ -61,6 +70,10 @@ class boundary():
 
         return json.dumps(json_dict) # swap to json
 
+    def encode(self):
+        # compact binary blob for the calibration table (see calibration_codec)
+        return encode_calibration({key:np.asarray(value, dtype=np.int32).ravel() for key, value in self.bounds.items()})
+
 class drag_drawing():
     # class to keep the images and x/y values for the dragging interface
     def __init__(self):
@@ -83,11 +96,11 @@ class calibration_data():
 # class to keep track of all of the chAruco board stuff
 class chAruco_board():
 
-    def __init__(self):
-        # initialize.
-        aruco_dict = cv2.aruco.Dictionary_get(cv2.aruco.DICT_6x6_250)
-        board = cv2.aruco.CharucoBoard_create(6,6,1,.8,aruco_dict)
-        imboard = board.draw((2000,2000))
+    def __init__(self, settings:dict = None):
+        # initialize from the [calibration] settings (see calibration_engine)
+        board = make_board(settings or DEFAULT_BOARD)
+        aruco_dict = board.getDictionary()
+        imboard = board.generateImage((2000,2000))
 
         # save in the structure
         self.aruco_dict = aruco_dict
@@ -98,7 +111,9 @@ class chAruco_board():
 
 
 def multiview_calibration_preparation(input_vids:List[str] = None, sql_path:str = None,
-                                      view_names:List[str] = ['North','South','East','West','Center']):
+                                      view_names:List[str] = ['North','South','East','West','Center'],
+                                      auto:bool = True, min_confidence:float = 0.8, interactive:bool = True,
+                                      calibrate:bool = False):
     '''
     Create bounding boxes and get calibration matrices using a calibration video.
     Then store the calibration in the base sqlite table
@@ -110,26 +125,64 @@ def multiview_calibration_preparation(input_vids:List[str] = None, sql_path:str
     These bounding boxes and calibration matrices can then be applied to the mirror box
     recordings from the same day 
 
+    With auto on, the boundaries get found automatically (see boundary_detection),
+    and the user only has to draw them for videos where the detection's confidence
+    is under min_confidence. With interactive off, those videos get skipped instead,
+    so this can run without a display.
+
+    With calibrate on, each new calibration video also gets its intrinsics and
+    extrinsics worked out from the ChArUco board (see calibration_engine).
+
     '''
 
     # select the videos
     if (input_vids is None) or not any([path.exists(vid) for vid in input_vids]) :
+        if not interactive:
+            print('No calibration videos to work on')
+            return
         input_vids = select_vids(path.split(sql_path)[0])
     
+    metrics = get_metrics()
     insert_len = 0
-    for vid in input_vids:
-        # check if video is already in SQL 
-        if vid_in_table(vid, sql_path):
-            continue
-
-        # pull out boundaries for each video 
-        vid_bounds = bound_creator(vid = vid, view_names=view_names)
+    skipped = []
+
+    # check which videos are already in SQL, all at once and by content, so renamed copies get caught too
+    with metrics.timer('vid_in_table'):
+        new_vids = new_calibration_videos(input_vids, sql_path)
+
+    for vid, fingerprint in new_vids:
+        # pull out boundaries for each video -- automatically if we can
+        vid_bounds = None
+        if auto:
+            with metrics.timer('detect_boundaries'):
+                detected, confidence = detect_boundaries(vid, view_names)
+            print(f'{path.split(vid)[-1]}: detected boundaries with confidence {confidence:.2f}')
+            metrics.event('detect_boundaries', video=vid, confidence=confidence, bounds=detected)
+            if confidence >= min_confidence:
+                vid_bounds = boundary(view_names)
+                for view in view_names:
+                    vid_bounds.set_bounds(np.array(detected[view]))
+
+        if vid_bounds is None:
+            if not interactive:
+                skipped.append(vid)
+                continue
+            with metrics.timer('bound_creator'):
+                vid_bounds = bound_creator(vid = vid, view_names=view_names)
         
         # write to sql
-        sql_write(sql_path, vid_bounds, vid)
+        with metrics.timer('sql_write'):
+            sql_write(sql_path, vid_bounds, vid, fingerprint)
+        if calibrate:
+            calibrate_video(sql_path, vid)
         insert_len += 1
+        metrics.progress('calibrations_inserted')
 
-    print(f'{len(input_vids) - insert_len} videos already in calibration table; inserted {insert_len} new entries')
+    print(f'{len(input_vids) - insert_len - len(skipped)} videos already in calibration table; inserted {insert_len} new entries')
+    if skipped:
+        print(f'Skipped {len(skipped)} videos where the boundaries need to be drawn by hand:')
+        for vid in skipped:
+            print(f'    {vid}')
 
 
 def select_vids(project_dir):
@@ -233,146 +286,113 @@ def draw_mask(event, x, y, flags, params):
 
 
 # write view bounds and matrices for each view to the sqlite database
-def sql_write(sqlite_path:str, view_bounds:boundary, vid_name:str):
-    # connect to the sqlite db    
-    sql_conn = sqlite3.connect(sqlite_path)
-    sql_cur = sql_conn.cursor()
-
+def sql_write(sqlite_path:str, view_bounds:boundary, vid_name:str, fingerprint:str = None):
     vid_relative = os.path.split(vid_name)[-1]
 
-    # format the sql insertion
-    sql_query = '''INSERT INTO calibration (name, boundary) VALUES (?, ?) ;'''
-
-    # sql_cur.execute(sql_query, (vid_relative, view_bounds.pkl_it()))
-    sql_cur.execute(sql_query, (vid_relative, view_bounds.jsonify()))
-    sql_conn.commit()
+    if fingerprint is None:
+        fingerprint = file_fingerprint(vid_name)
 
-    sql_conn.close()
+    # the date comes from the _YYYYmmdd_ in the filename
+    get_project_db(sqlite_path).add_calibration(vid_relative, date_from_name(vid_relative), view_bounds.encode(), fingerprint)
 
 
-def crop_and_splice(video_paths, project_dir, num_frames):
+def crop_and_splice(video_paths, project_dir, num_frames, sql_path:str = None, labels_only:bool = False,
+                    selection:str = 'random', view_names:List[str] = ['North','South','East','West','Center'],
+                    config_path:str = None):
     '''
-    
-    
+    Splice the views of each video into a single frame for labeling, and save
+    num_frames random frames (spread across the videos) as pngs, along with
+    where each view ended up in boundaries.txt
+
+    arguments:
+        - video_paths       videos to pull label frames from
+        - project_dir       where the pngs, boundaries.txt and spliced videos go
+        - num_frames        total number of label frames
+        - sql_path          project sqlite file to pull the view boundaries from. if None, or the
+                            video doesn't have a calibration, they get drawn by hand
+        - labels_only       only decode the label frames and skip writing the spliced videos
+        - selection         'random', or 'diverse' to cluster thumbnails of the videos and pick
+                            frames that are as different from each other as possible (see frame_selection)
+        - view_names        views to draw if we have to draw them
+        - config_path       config.toml with the [encoder] and [views] settings. if None, uses the one
+                            next to the sql file (or in project_dir if there's no sql file)
     '''
+    # the directory should already exist, but just in case...
+    if not path.exists(project_dir):
+        makedirs(project_dir)
+
     # need to track the bounding boxes for the lambda function
     bound_fid = open(path.join(project_dir,'boundaries.txt'), 'w+')
+    if config_path is None:
+        config_path = _project_config(sql_path, project_dir)
+    encoder = load_encoder_config(config_path) # encoder settings from the project config
+    transforms = load_transform_config(config_path) # and the splice gamma for each view
+
+    # how many label frames do we want per video?
+    frames_rem = num_frames
+    per_vid = int(np.ceil(num_frames/len(video_paths)))
+
+    metrics = get_metrics()
+
+    # pick the most varied frames up front
+    if selection == 'diverse':
+        with metrics.timer('select_frames'):
+            diverse_frames = select_frames([video_path for video_path in video_paths if path.exists(video_path)], num_frames)
 
-    
     # for each video ....
     for i_video, video_path in enumerate(video_paths):
-        # locations of views
-        bounds = bound_creator(video_path)
-    
-        # get the widths and heighths of each view 
-        # debating changing all of the xyxy to xywh...
-        width_subs = {key:(bounds[key][3]-bounds[key][1]) for key in bounds.keys()}
-        height_subs = {key:(bounds[key][2]-bounds[key][0]) for key in bounds.keys()}
-    
-        # the width will be the west and east image widths plus the largest width of north, center, and south
-        width = width_subs['west'] + width_subs['east']
-        width += max([width_subs['north'],width_subs['center'],width_subs['south']])
-
-        # the height will be the west and east image heights plus the largest height of north, center, and south
-        height = height_subs['north'] + height_subs['south']
-        height += max([height_subs['west'],height_subs['center'],height_subs['east']])
-
-        # locations of each view within the frame
-        target_corner = dict()
-        # west
-        target_corner['west'] = [int((height - height_subs['west'])/2), 0]
-        # east
-        target_corner['east'] = [int((height - height_subs['east'])/2), width-width_subs['east']]
-        # north
-        target_corner['north'] = [0, int((width - width_subs['north'])/2)]
-        # center
-        target_corner['center'] = [int((height-height_subs['center'])/2), int((width-width_subs['center'])/2)]
-        #south
-        target_corner['south'] = [height - height_subs['south'], int((width - width_subs['south'])/2)]
-
-
-        # the directory should already exist, but just in case...
-        if not path.exists(project_dir):
-            makedirs(project_dir)
-
-        # how many label frames do we want per video?
-        frames_rem = num_frames
-        per_vid = int(np.ceil(num_frames/len(video_paths)))
-
         print(f'Cropping video {i_video+1} of {len(video_paths)}')
 
         # check to make sure the video exists. If not, print to console and skip
         if not path.exists(video_path):
             print(f'Couldn\'t find {video_path}. Continuing to next video.')
+            continue
 
-        # open a video reader and writer for the splitting
+        # locations of views
+        bounds = video_bounds(video_path, sql_path, view_names)
+    
+        # where each view goes in the spliced frame
+        plan = splice_plan(bounds, transforms)
+        boundary_list = plan.boundary_list()
+
+        # open a video reader for the splitting
         vid_read = cv2.VideoCapture(video_path)
         vid_dirname, vid_filename = path.split(video_path) # get the storage location and video name
         vid_basename = path.splitext(vid_filename)[0] # for the cropped video and tagging frames
-        vid_savename = path.join(project_dir,vid_basename + '_cropped.mp4') # to save the cropped file
-        vid_write = cv2.VideoWriter(vid_savename, cv2.VideoWriter_fourcc(*'mp4v'), 50, (width, height))
-
-        # get a list of frames to use -- random for now. I suppose in the future we could do K-means or PCA or something
-        label_frames = random.choices(range(int(vid_read.get(cv2.CAP_PROP_FRAME_COUNT))), k = int(np.min([per_vid, frames_rem])))
-        frames_rem -= per_vid # how many more do we need from future videos?
 
+        # get a list of frames to use
+        if selection == 'diverse':
+            label_frames = set(diverse_frames[video_path])
+        else:
+            frame_count = int(vid_read.get(cv2.CAP_PROP_FRAME_COUNT))
+            label_frames = set(random.sample(range(frame_count), k = int(np.clip(min(per_vid, frames_rem), 0, frame_count))))
+            frames_rem -= len(label_frames) # how many more do we need from future videos?
+
+        if labels_only:
+            # just hop between the label frames
+            frames = read_frames_at(vid_read, label_frames)
+            vid_write = None
+        else:
+            # go through every frame, and write out the whole spliced video
+            frames = enumerate(_read_all(vid_read))
+            vid_savename = path.join(project_dir,vid_basename + '_cropped.' + encoder['extension']) # to save the cropped file
+            vid_write = open_writer(vid_savename, 50, (plan.width, plan.height), encoder)
 
         # loop through the frames
-        i_frame = 0 # to keep track of whether we want to use this frame for labeling
-        while True:
-            # grab a frame
-            ret,frame = vid_read.read()
-
-            # if we're through the frames, leave the while loop
-            if not ret:
-                break
-
-            # skip everything but the label frames for the moment
-            # if i_frame not in label_frames:
-            #     i_frame += 1
-            #     continue
-
-            # split the frame based on the crops, then put into the video
-            fill_frame = np.zeros((height,width,3))
-            for key in bounds.keys():
-                bound = bounds[key]
-                locn = target_corner[key]
-                ws = width_subs[key]
-                hs = height_subs[key]
-                
-                # gamma correction
-                frame_temp = frame[bound[0]:(bound[0]+hs), bound[1]:(bound[1]+ws),:]
-                frame_temp = ((frame_temp/255)**.6 * 255).astype(np.uint8)
-
-                # stick the frame in there
-                fill_frame[locn[0]:(locn[0]+hs),locn[1]:(locn[1]+ws),:] = frame_temp
-
-            
+        for i_frame, frame in frames:
+            # split the frame based on the crops
+            with metrics.timer('splice'):
+                fill_frame = plan.apply(frame)
 
             # write it to the output video            
-            vid_write.write(fill_frame.astype(np.uint8)) # have to convert it to a uint
+            if vid_write is not None:
+                with metrics.timer('encode'):
+                    vid_write.write(fill_frame)
+                metrics.progress('frames')
 
             # save it if it's a frame we want to label
             if i_frame in label_frames:
-                # some additional instructions
-                l1 = 'Label each keypoint:'
-                l2 = '    - in at least 3 views'
-                l3 = '    - only once per view'
-                b1 = 'Refer to instructions'
-                b2 = 'for view layout'
-                inst_scale = 0.5
-                top_size = cv2.getTextSize(l1, cv2.FONT_HERSHEY_SIMPLEX, inst_scale,1)[0]
-                b1_size = cv2.getTextSize(b1, cv2.FONT_HERSHEY_SIMPLEX, inst_scale,1)[0]
-                b2_size = cv2.getTextSize(b2, cv2.FONT_HERSHEY_SIMPLEX, inst_scale,1)[0]
-                b1_origin = (int(fill_frame.shape[1]-(b1_size[0]+5)),int(fill_frame.shape[0] - 2*b1_size[1])) 
-                b2_origin = (int(fill_frame.shape[1]-(b2_size[0]+5)),int(fill_frame.shape[0] - 0.5*b2_size[1]))
-                cv2.putText(fill_frame, l1, (5,int(1.5*top_size[1])), cv2.FONT_HERSHEY_SIMPLEX, inst_scale, (255,255,255))
-                cv2.putText(fill_frame, l2, (5,int(3*top_size[1])), cv2.FONT_HERSHEY_SIMPLEX, inst_scale, (255,255,255))
-                cv2.putText(fill_frame, l3, (5,int(4.5*top_size[1])), cv2.FONT_HERSHEY_SIMPLEX, inst_scale, (255,255,255))
-                cv2.putText(fill_frame, b1, b1_origin, cv2.FONT_HERSHEY_SIMPLEX, inst_scale, (255,255,255))
-                cv2.putText(fill_frame, b2, b2_origin, cv2.FONT_HERSHEY_SIMPLEX, inst_scale, (255,255,255))
-
-
+                fill_frame = label_instructions(fill_frame.copy()) # the canvas gets reused, so the text can't go on it
 
                 # store it
                 im_filename = vid_basename + '_' + str(i_frame).zfill(8) + '.png'
@@ -381,45 +401,391 @@ def crop_and_splice(video_paths, project_dir, num_frames):
                 if not ret_im:
                     frames_rem += 1 # still need to store another frame
                     print(f'Unable to save image {im_filename}') # let the user know
+                    continue
 
-                boundary_list = [[target_corner[key][0],target_corner[key][1],target_corner[key][0]+height_subs[key], target_corner[key][1] + width_subs[key]] for key in target_corner.keys()]
                 bound_fid.write(f'{im_filename}: {boundary_list}\n')
 
-
-            # update the counter
-            i_frame += 1
-
         # clean everything up for this loop
         vid_read.release()
-        vid_write.release()
+        if vid_write is not None:
+            vid_write.release()
         
     # close boundary location file -- this is for all videos :)    
     bound_fid.close()
 
+
+def _read_all(vid_read):
+    # every frame of the video, in order
+    frame = None
+    while True:
+        with get_metrics().timer('decode'):
+            ret, frame = vid_read.read(frame)
+        if not ret:
+            return
+        yield frame
+
+
+def video_bounds(video_path:str, sql_path:str = None, view_names:List[str] = ['North','South','East','West','Center'],
+                 interactive:bool = True):
+    '''
+    the view boundaries for a video as {view: [top, left, bottom, right]} with
+    lowercase view names. They come from the calibration table if we can find
+    one, otherwise the user draws them (or we raise a ValueError if interactive is False)
+    '''
+    bounds = -1
+    if sql_path is not None:
+        bounds = bound_puller(sql_path, video_path)
+    if bounds == -1:
+        if not interactive:
+            raise ValueError(f'No calibration found for {video_path}')
+        bounds = bound_creator(video_path, view_names).bounds
+
+    return {key.lower():[int(b) for b in np.array(value).flatten()] for key, value in bounds.items()}
+
+
+def label_instructions(fill_frame:np.array):
+    '''
+    write the labeling instructions onto a spliced frame (in place)
+    '''
+    l1 = 'Label each keypoint:'
+    l2 = '    - in at least 3 views'
+    l3 = '    - only once per view'
+    b1 = 'Refer to instructions'
+    b2 = 'for view layout'
+    inst_scale = 0.5
+    top_size = cv2.getTextSize(l1, cv2.FONT_HERSHEY_SIMPLEX, inst_scale,1)[0]
+    b1_size = cv2.getTextSize(b1, cv2.FONT_HERSHEY_SIMPLEX, inst_scale,1)[0]
+    b2_size = cv2.getTextSize(b2, cv2.FONT_HERSHEY_SIMPLEX, inst_scale,1)[0]
+    b1_origin = (int(fill_frame.shape[1]-(b1_size[0]+5)),int(fill_frame.shape[0] - 2*b1_size[1])) 
+    b2_origin = (int(fill_frame.shape[1]-(b2_size[0]+5)),int(fill_frame.shape[0] - 0.5*b2_size[1]))
+    cv2.putText(fill_frame, l1, (5,int(1.5*top_size[1])), cv2.FONT_HERSHEY_SIMPLEX, inst_scale, (255,255,255))
+    cv2.putText(fill_frame, l2, (5,int(3*top_size[1])), cv2.FONT_HERSHEY_SIMPLEX, inst_scale, (255,255,255))
+    cv2.putText(fill_frame, l3, (5,int(4.5*top_size[1])), cv2.FONT_HERSHEY_SIMPLEX, inst_scale, (255,255,255))
+    cv2.putText(fill_frame, b1, b1_origin, cv2.FONT_HERSHEY_SIMPLEX, inst_scale, (255,255,255))
+    cv2.putText(fill_frame, b2, b2_origin, cv2.FONT_HERSHEY_SIMPLEX, inst_scale, (255,255,255))
+
+    return fill_frame
+
+
+def export_labeling_set(video_paths:List[str], project_dir:str, num_frames:int, sql_path:str,
+                        n_workers:int = None, seed:int = 0, selection:str = 'random', config_path:str = None):
+    '''
+    Parallel version of crop_and_splice(labels_only=True) for building big
+    labeling sets. Each video goes to a pool worker that seeks to its label
+    frames and writes the spliced pngs plus its own shard of the manifest.
+    The shards get merged into manifest.jsonl (one record per png) and
+    boundaries.txt once everything is done.
+
+    The frames only depend on the videos, num_frames and seed -- each video
+    gets its own seed from its path, and the frame budget gets split up front --
+    so the same inputs always give the same labeling set, however the
+    workers get scheduled.
+
+    arguments:
+        - video_paths       videos to pull label frames from
+        - project_dir       where the pngs and manifests go
+        - num_frames        total number of label frames
+        - sql_path          project sqlite file with the calibrations (the workers can't draw boundaries)
+        - n_workers         number of processes. if None, uses the number of cpus
+        - seed              random seed for the whole set [default = 0]
+        - selection         'random' or 'diverse' (see frame_selection) [default = 'random']
+        - config_path       config.toml with the [views] splice gamma. if None, uses the one next to the sql file
+
+    returns a list of per-video status dictionaries
+    '''
+    if config_path is None:
+        config_path = _project_config(sql_path, project_dir)
+    transforms = load_transform_config(config_path)
+
+    if not path.exists(project_dir):
+        makedirs(project_dir)
+    shard_dir = path.join(project_dir, '_manifest_shards')
+    if not path.exists(shard_dir):
+        makedirs(shard_dir)
+
+    # same order every time, whatever order they came in. Names (and seeds) come from each
+    # video's path below the directory they're all in, since file names repeat across days
+    video_paths = sorted([path.abspath(video_path) for video_path in video_paths if path.exists(video_path)])
+    root = common_root(video_paths)
+    metrics = get_metrics()
+
+    # how many frames (or which frames) each video gets
+    if selection == 'diverse':
+        with metrics.timer('select_frames'):
+            video_frames = select_frames(video_paths, num_frames, seed=seed)
+    else:
+        frame_counts = []
+        for video_path in video_paths:
+            vid_read = cv2.VideoCapture(video_path)
+            frame_counts.append(int(vid_read.get(cv2.CAP_PROP_FRAME_COUNT)))
+            vid_read.release()
+        video_frames = dict(zip(video_paths, split_budget(frame_counts, num_frames)))
+
+    print(f'Exporting {num_frames} label frames from {len(video_paths)} videos')
+    statuses = []
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = {pool.submit(_export_worker, video_path, project_dir, shard_dir, video_frames[video_path],
+                               sql_path, video_seed(video_path, seed, root), _video_stem(video_path, root), transforms):video_path
+                   for video_path in video_paths}
+
+        for future in as_completed(futures):
+            try:
+                status = future.result()
+            except Exception as e: # the worker itself died
+                status = {'video':futures[future], 'status':'failed', 'error':repr(e), 'frames':0, 'seconds':0}
+
+            if status['status'] == 'ok':
+                print(f"[{len(statuses)+1}/{len(video_paths)}] {status['video']}: {status['frames']} frames in {status['seconds']:.1f}s")
+            else:
+                print(f"[{len(statuses)+1}/{len(video_paths)}] {status['video']}: FAILED -- {status['error']}")
+            statuses.append(status)
+            metrics.event('label_export', **status)
+
+    # stitch the shards together in video order
+    n_images = merge_manifests([path.join(shard_dir, _video_stem(video_path, root) + '.jsonl') for video_path in video_paths],
+                               project_dir)
+    shutil.rmtree(shard_dir)
+
+    n_failed = sum([status['status'] != 'ok' for status in statuses])
+    print(f'Exported {n_images} label frames; {n_failed} of {len(statuses)} videos failed')
+
+    return statuses
+
+
+def _project_config(sql_path:str, project_dir:str):
+    # the project's config.toml lives next to its sql file. Without one, look in the output directory
+    if sql_path is not None:
+        return path.join(path.dirname(path.abspath(sql_path)), 'config.toml')
+    return path.join(project_dir, 'config.toml')
+
+
+def _export_worker(video_path:str, project_dir:str, shard_dir:str, frames, sql_path:str, seed:int, stem:str,
+                   transforms:dict = None):
+    '''
+    export the label frames for a single video inside a pool worker. frames
+    is either the list of frames to use or how many to pick at random. stem
+    names the video's pngs and manifest shard, and has to be unique in the set.
+    transforms are from load_transform_config
+    '''
+    status = {'video':video_path, 'status':'ok', 'error':None, 'frames':0, 'seconds':0}
+    t_start = time.perf_counter()
+    vid_read = cv2.VideoCapture(video_path)
+    try:
+        bounds = video_bounds(video_path, sql_path, interactive=False)
+        plan = splice_plan(bounds, transforms)
+        canvas_bounds = plan.canvas_boundaries()
+
+        # the label frames -- the seed only depends on the video, so this doesn't care which worker we're on
+        if isinstance(frames, int):
+            frame_count = int(vid_read.get(cv2.CAP_PROP_FRAME_COUNT))
+            frames = random.Random(seed).sample(range(frame_count), k = min(frames, frame_count))
+
+        with open(path.join(shard_dir, stem + '.jsonl'), 'w') as shard:
+            for i_frame, frame in read_frames_at(vid_read, frames):
+                fill_frame = label_instructions(plan.apply(frame).copy())
+
+                im_filename = stem + '_' + str(i_frame).zfill(8) + '.png'
+                if not cv2.imwrite(path.join(project_dir, im_filename), fill_frame):
+                    print(f'Unable to save image {im_filename}')
+                    continue
+
+                shard.write(json.dumps({'image':im_filename, 'video':video_path, 'frame':i_frame,
+                                        'boundaries':canvas_bounds, 'source_boundaries':bounds}) + '\n')
+                status['frames'] += 1
+
+    except Exception as e:
+        status['status'] = 'failed'
+        status['error'] = repr(e)
+    finally:
+        vid_read.release()
+    status['seconds'] = time.perf_counter() - t_start
+
+    flush_metrics() # pool workers exit without running atexit
+    return status
+
+
+def split_budget(frame_counts:List[int], num_frames:int):
+    '''
+    split num_frames between videos as evenly as we can, without asking a
+    video for more frames than it has. Leftovers go to the earliest videos
+    '''
+    budget = [0]*len(frame_counts)
+    remaining = num_frames
+    open_videos = [i_video for i_video, count in enumerate(frame_counts) if count > 0]
+    while remaining > 0 and open_videos:
+        share, extra = divmod(remaining, len(open_videos))
+        for i_open, i_video in enumerate(open_videos):
+            take = min(share + (i_open < extra), frame_counts[i_video] - budget[i_video])
+            budget[i_video] += take
+            remaining -= take
+        open_videos = [i_video for i_video in open_videos if budget[i_video] < frame_counts[i_video]]
+
+    return budget
+
+
+def merge_manifests(shard_paths:List[str], project_dir:str):
+    '''
+    join manifest shards into manifest.jsonl, and write the old style
+    boundaries.txt alongside it. returns the number of records
+    '''
+    n_records = 0
+    with open(path.join(project_dir, 'manifest.jsonl'), 'w') as manifest, \
+         open(path.join(project_dir, 'boundaries.txt'), 'w') as bound_fid:
+        for shard_path in shard_paths:
+            if not path.exists(shard_path): # that video failed
+                continue
+            with open(shard_path, 'r') as shard:
+                for line in shard:
+                    record = json.loads(line)
+                    manifest.write(line)
+                    bound_fid.write(f"{record['image']}: {list(record['boundaries'].values())}\n")
+                    n_records += 1
+
+    return n_records
+
+
+def _video_stem(video_path:str, root:str):
+    # file name stem for a video's pngs and manifest shard -- its path below root, flattened
+    return path.splitext(video_key(video_path, root))[0].replace('/', '__')
+
+
+def splice_layout(bounds:dict):
+    '''
+    work out how the views get packed into a single spliced frame:
+    west and east on the sides, north and south on the top and bottom,
+    center in the middle
+
+    returns (width, height, width_subs, height_subs, target_corner)
+    '''
+    # get the widths and heighths of each view 
+    # debating changing all of the xyxy to xywh...
+    width_subs = {key:(bounds[key][3]-bounds[key][1]) for key in bounds.keys()}
+    height_subs = {key:(bounds[key][2]-bounds[key][0]) for key in bounds.keys()}
+
+    # the width will be the west and east image widths plus the largest width of north, center, and south
+    width = width_subs['west'] + width_subs['east']
+    width += max([width_subs['north'],width_subs['center'],width_subs['south']])
+
+    # the height will be the west and east image heights plus the largest height of north, center, and south
+    height = height_subs['north'] + height_subs['south']
+    height += max([height_subs['west'],height_subs['center'],height_subs['east']])
+
+    # locations of each view within the frame
+    target_corner = dict()
+    # west
+    target_corner['west'] = [int((height - height_subs['west'])/2), 0]
+    # east
+    target_corner['east'] = [int((height - height_subs['east'])/2), width-width_subs['east']]
+    # north
+    target_corner['north'] = [0, int((width - width_subs['north'])/2)]
+    # center
+    target_corner['center'] = [int((height-height_subs['center'])/2), int((width-width_subs['center'])/2)]
+    #south
+    target_corner['south'] = [height - height_subs['south'], int((width - width_subs['south'])/2)]
+
+    return width, height, width_subs, height_subs, target_corner
+
+
+class splice_plan():
+    '''
+    splice_layout worked out once per video, with a preallocated uint8
+    canvas and the source/destination slices for each view. Splicing a
+    frame is then one gamma lookup per view, written straight into its
+    spot on the canvas -- no float copies and no allocations. The gamma
+    for each view is its splice_gamma from transforms (see
+    load_transform_config), which is separate from the split views' gamma
+
+    apply() returns the canvas, so it gets overwritten on the next call
+    '''
+    def __init__(self, bounds:dict, transforms:dict = None):
+        self.layout = splice_layout(bounds)
+        width, height, width_subs, height_subs, target_corner = self.layout
+        self.width, self.height = width, height
+        self.canvas = np.zeros((height, width, 3), dtype=np.uint8)
+
+        # (crop of the original frame, spot on the canvas, gamma table or None) for each view
+        self.copies = []
+        for key, bound in bounds.items():
+            hs, ws = height_subs[key], width_subs[key]
+            locn = target_corner[key]
+            gamma = float(view_transforms(transforms, key)['splice_gamma'])
+            self.copies.append(((slice(bound[0], bound[0]+hs), slice(bound[1], bound[1]+ws)),
+                                self.canvas[locn[0]:(locn[0]+hs), locn[1]:(locn[1]+ws)],
+                                gamma_lut(gamma) if gamma != 1.0 else None))
+
+    def canvas_boundaries(self):
+        # where each view ends up on the canvas, as {view: [top, left, bottom, right]}
+        width, height, width_subs, height_subs, target_corner = self.layout
+        return {key:[target_corner[key][0],target_corner[key][1],target_corner[key][0]+height_subs[key], target_corner[key][1] + width_subs[key]] for key in target_corner.keys()}
+
+    def boundary_list(self):
+        # the same thing as a list, the way boundaries.txt has it
+        return list(self.canvas_boundaries().values())
+
+    def apply(self, frame:np.array):
+        for (rows, cols), dst, lut in self.copies:
+            if lut is None:
+                np.copyto(dst, frame[rows, cols, :])
+            else:
+                cv2.LUT(frame[rows, cols, :], lut, dst=dst)
+        return self.canvas
+
+
+def splice_frame(frame:np.array, bounds:dict, layout:tuple, transforms:dict = None):
+    '''
+    crop the views out of a frame, gamma correct them (with the splice_gamma
+    from transforms, see load_transform_config) and put them into a new frame
+    using the splice_layout. For more than a frame or two, splice_plan
+    does the same thing much faster
+    '''
+    width, height, width_subs, height_subs, target_corner = layout
+
+    fill_frame = np.zeros((height,width,3))
+    for key in bounds.keys():
+        bound = bounds[key]
+        locn = target_corner[key]
+        ws = width_subs[key]
+        hs = height_subs[key]
+        
+        # gamma correction
+        frame_temp = cv2.LUT(frame[bound[0]:(bound[0]+hs), bound[1]:(bound[1]+ws),:],
+                             gamma_lut(float(view_transforms(transforms, key)['splice_gamma'])))
+
+        # stick the frame in there
+        fill_frame[locn[0]:(locn[0]+hs),locn[1]:(locn[1]+ws),:] = frame_temp
+
+    return fill_frame
+
         
 # check to see if a video is already in the SQL database
 def vid_in_table(vid_fn:str, sql_path:str):
     '''
     Checks to see if a video is already in the SQL database
     '''
+    return get_project_db(sql_path).calibration_exists(vid_fn)
 
-    vid_short = os.path.split(vid_fn)[-1]
 
-    con = sqlite3.connect(sql_path)
-    cur = con.cursor()
+def new_calibration_videos(vid_fns:List[str], sql_path:str):
+    '''
+    [(video, fingerprint)] for the videos that aren't in the calibration table yet.
+    Videos are matched on their content fingerprint (see project_db), plus on the
+    name for rows written before there were fingerprints. Duplicates within
+    vid_fns only get returned once
+    '''
+    fingerprints = fingerprint_files(vid_fns)
 
-    sql_query = '''SELECT name FROM calibration WHERE name = ? '''
-    # sql_query = '''SELECT name FROM calibration WHERE name = "''' + vid_short + '";'
-    params = (vid_short, )
-    # print(sql_query)
-    # cur.execute(sql_query, ('"'+vid_short+'"'))
-    # cur.execute(sql_query)
-    cur.execute(sql_query, params)
-    ret = cur.fetchall()
+    db = get_project_db(sql_path)
+    known = db.known_fingerprints('calibration', fingerprints)
+    legacy_names = db.unfingerprinted_names('calibration')
 
-    con.close()
+    new_vids = []
+    for vid, fingerprint in zip(vid_fns, fingerprints):
+        if fingerprint is None or fingerprint in known or os.path.split(vid)[-1] in legacy_names:
+            continue
+        known.add(fingerprint)
+        new_vids.append((vid, fingerprint))
 
-    return bool(len(ret) > 0)
+    return new_vids
     
 
 
@@ -436,8 +802,27 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-s','--sql', help='SQLite3 file name or path', default=None)
     parser.add_argument('--directory',help='Project Base Directory', default=None)
-    parser.add_argument('-v','--video',help='Calibration video', default=None)
+    parser.add_argument('-v','--video', nargs='+', help='Calibration videos', default=None)
+    parser.add_argument('--manual', action='store_true', help='draw all of the boundaries by hand')
+    parser.add_argument('--headless', action='store_true', help='never open a window -- skip videos the detection isn\'t sure about')
+    parser.add_argument('--calibrate', action='store_true', help='also calibrate each view from the ChArUco board')
+    parser.add_argument('--min_confidence', type=float, help='lowest confidence to accept detected boundaries', default=0.8)
+    parser.add_argument('--metrics', help='write timing metrics to this JSON-lines file', default=None)
+    parser.add_argument('--label_videos', nargs='+', help='export a labeling set from these videos instead', default=None)
+    parser.add_argument('--label_frames', type=int, help='number of label frames to export', default=200)
+    parser.add_argument('--diverse', action='store_true', help='pick varied label frames instead of random ones')
+    parser.add_argument('--seed', type=int, help='random seed for the labeling set', default=0)
+    parser.add_argument('-j','--workers', type=int, help='number of worker processes', default=None)
 
     args = parser.parse_args()
 
-    multiview_calibration_preparation(project_dir=args.directory, input_vids=args.video, sql_path=args.sql)
\ No newline at end of file
+    if args.metrics:
+        enable_metrics(args.metrics)
+
+    if args.label_videos:
+        export_labeling_set(args.label_videos, args.directory, args.label_frames, args.sql, n_workers=args.workers,
+                            seed=args.seed, selection='diverse' if args.diverse else 'random')
+    else:
+        multiview_calibration_preparation(input_vids=args.video, sql_path=args.sql, auto=not args.manual,
+                                          min_confidence=args.min_confidence, interactive=not args.headless,
+                                          calibrate=args.calibrate)
\ No newline at end of file
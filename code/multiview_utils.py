@@ -9,20 +9,41 @@ boundaries text file from amazon or the calibration sqlite file, and
 padding the images as needed to make sure that they work with whatever
 model we're using.
 
+The views can either be written out as videos or chunked frame stores
+(video_split_sql) or streamed straight out of the original recording (iter_views).
+
 '''
 
 import os
+import re
 import json
+import time
+import queue
+import shutil
+import subprocess
+import argparse
+import threading
 import numpy as np
 import cv2
-import sqlite3
+import toml
+from bisect import bisect_right
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List
+from video_writers import load_encoder_config, open_writer
+from frame_store import concat_frame_stores
+from calibration_codec import decode as decode_calibration, BLOB_COLUMNS
+from instrumentation import get_metrics, enable_metrics, flush_metrics
+from project_db import get_project_db
 
 
 
 
 
 # split image into different views based on sql file
-def video_split_sql(sql_path: str, video_path:str, output_dir:str = None, is_calib:bool = False):
+def video_split_sql(sql_path: str, video_path:str, output_dir:str = None, is_calib:bool = False,
+                    pipelined:bool = False, queue_size:int = 32, encoder:dict = None, n_segments:int = 1,
+                    checkpoint_every:int = None, transforms:dict = None):
     '''
     video_split_sql
         splits a multiview video into images of different views, including
@@ -34,6 +55,19 @@ def video_split_sql(sql_path: str, video_path:str, output_dir:str = None, is_cal
         - video             path of video
         - output_dir        output directory. if None, creates new directory in same location as video
         - is_calib          is this a calibration video? if so, the sql query is a bit different [default = False]
+        - pipelined         decode on one thread and crop/encode each view on its own thread [default = False]
+        - queue_size        max number of frames waiting for each view writer when pipelined [default = 32]
+        - encoder           encoder settings (see video_writers). if None, uses the [encoder] section
+                            of the config.toml next to the sql file
+        - n_segments        split the video into this many frame ranges and process them in parallel,
+                            then stitch each view back together with ffmpeg [default = 1]
+        - checkpoint_every  write the views in segments of this many frames, recording progress in a
+                            checkpoint file after each one. Rerunning picks up from the last checkpoint.
+                            Can't be combined with n_segments [default = None]
+        - transforms        per-view corrections (see load_transform_config). if None, uses the [views]
+                            section of the config.toml next to the sql file
+
+    returns the number of frames split, or -1 if something went wrong
     '''
 
     # check to make sure that we can access tables in the sql file
@@ -44,9 +78,8 @@ def video_split_sql(sql_path: str, video_path:str, output_dir:str = None, is_cal
     if output_dir is None:
         output_dir = os.path.splitext(os.path.abspath(video_path))[0] + '_croppedViews'
     
-    # create it if it doesn't exist
-    if not os.path.exists(output_dir):
-        os.mkdir(output_dir)
+    # create it if it doesn't exist (workers in a batch can share it, so don't check first)
+    os.makedirs(output_dir, exist_ok=True)
 
     # does the video exist
     if not os.path.exists(video_path):
@@ -56,50 +89,648 @@ def video_split_sql(sql_path: str, video_path:str, output_dir:str = None, is_cal
 
     # get the boundaries from sql
     boundaries = bound_puller(sql_path, video_path, is_calib)
+    if boundaries == -1:
+        return -1
 
-    # open a video reader and writer for splitting
-    vid_read = cv2.VideoCapture(video_path)
+    # size and frame rate from the db if the video's been probed, otherwise open it just to get them
+    info = get_project_db(sql_path).video_info([video_path]).get(os.path.split(video_path)[-1])
+    if info is not None and info['fps']:
+        frame_shape = (info['height'], info['width'])
+        fps = info['fps']
+        frame_count = info['frame_count']
+    else:
+        vid_read = cv2.VideoCapture(video_path)
+        frame_shape = (int(vid_read.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(vid_read.get(cv2.CAP_PROP_FRAME_WIDTH)))
+        fps = vid_read.get(cv2.CAP_PROP_FPS)
+        frame_count = int(vid_read.get(cv2.CAP_PROP_FRAME_COUNT))
+        vid_read.release()
 
-    # dict of videos writers -- one for each boundary
+    # encoder and view settings from the project config if we weren't given any
+    config_path = os.path.join(os.path.dirname(os.path.abspath(sql_path)), 'config.toml')
+    if encoder is None:
+        encoder = load_encoder_config(config_path)
+    if transforms is None:
+        transforms = load_transform_config(config_path)
+
+    # output file for each view
     vid_base = os.path.splitext(os.path.split(video_path)[-1])[0]
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    # fourcc = cv2.VideoWriter_fourcc(*'h264')
-    # fourcc = cv2.VideoWriter_fourcc(*'RGBA')
-    vid_dict = {b_name:
-                cv2.VideoWriter(os.path.join(output_dir, vid_base + '_' + b_name + '.mp4'), 
-                # cv2.VideoWriter(os.path.join(output_dir, vid_base + '_' + b_name + '.avi'), 
-                                fourcc, 
-                                vid_read.get(cv2.CAP_PROP_FPS),
-                                (boundary[3]-boundary[1] if b_name.lower() in ['north','south','center'] else boundary[2]-boundary[0],
-                                 boundary[2]-boundary[0] if b_name.lower() in ['north','south','center'] else boundary[3]-boundary[1])) 
-                for b_name, boundary in boundaries.items()}
-    # vid_dict = dict(zip([bound for bound in boundaries.keys()], ))
-    
+    out_paths = {b_name:os.path.join(output_dir, vid_base + '_' + b_name + '.' + encoder['extension'])
+                 for b_name in boundaries.keys()}
+
     # loop through the frames
+    if checkpoint_every:
+        if n_segments > 1:
+            print('checkpoint_every and n_segments cannot be used together')
+            return -1
+        ckpt_path = os.path.join(output_dir, vid_base + '_checkpoint.json')
+        n_frames = _split_checkpointed(video_path, boundaries, frame_shape, transforms, out_paths, fps, encoder,
+                                       ckpt_path, checkpoint_every, pipelined, queue_size)
+    elif n_segments > 1:
+        n_frames = _split_segments(video_path, boundaries, frame_shape, transforms, frame_count, out_paths, fps, encoder,
+                                   n_segments, pipelined, queue_size)
+    else:
+        n_frames = _split_range(video_path, boundaries, frame_shape, transforms, 0, None, out_paths, fps, encoder,
+                                pipelined, queue_size)
+
+    return n_frames
+
+
+
+def _split_range(video_path:str, boundaries:dict, frame_shape:tuple, transforms:dict, start:int, stop:int, out_paths:dict,
+                 fps:float, encoder:dict, pipelined:bool = False, queue_size:int = 32):
+    '''
+    split frames [start, stop) of a video into a file for each view.
+    stop = None keeps going to the end of the video.
+
+    returns the number of frames written
+    '''
+    # open a video reader and writer for splitting
+    vid_read = _open_at(video_path, start)
+
+    # work out the crops and flips once for the whole video
+    plan = view_plan(boundaries, frame_shape, transforms)
+
+    # dict of videos writers -- one for each boundary
+    vid_dict = {b_name:open_writer(out_paths[b_name], fps, frame_size, encoder)
+                for b_name, frame_size in plan.frame_sizes().items()}
+
+    metrics = get_metrics()
+    max_frames = None if stop is None else stop - start
+    t_start = time.perf_counter()
+    try:
+        if pipelined:
+            n_frames = _split_pipelined(vid_read, plan, vid_dict, queue_size, max_frames)
+        else:
+            n_frames = _split_serial(vid_read, plan, vid_dict, max_frames)
+
+    finally:
+        # close the videos
+        vid_read.release()
+        with metrics.timer('encode_flush'):
+            for b_name, b_video in vid_dict.items():
+                b_video.release()
+
+    metrics.event('split_range', video=video_path, start=start, frames=n_frames,
+                  seconds=time.perf_counter() - t_start, **metrics.totals())
+    return n_frames
+
+
+
+def _open_at(video_path:str, start:int = 0):
+    '''
+    open a video reader sitting at frame "start"
+    '''
+    vid_read = cv2.VideoCapture(video_path)
+    if start > 0:
+        vid_read.set(cv2.CAP_PROP_POS_FRAMES, start)
+
+        # if the seek didn't land where we asked, step there the slow way
+        if int(vid_read.get(cv2.CAP_PROP_POS_FRAMES)) != start:
+            vid_read.release()
+            vid_read = cv2.VideoCapture(video_path)
+            for i_frame in range(start):
+                vid_read.grab()
+
+    return vid_read
+
+
+
+def _split_segments(video_path:str, boundaries:dict, frame_shape:tuple, transforms:dict, frame_count:int, out_paths:dict,
+                    fps:float, encoder:dict, n_segments:int, pipelined:bool = False, queue_size:int = 32):
+    '''
+    split a single video in parallel: each process seeks to the start of its
+    own range of frames and writes segment files for each view, then the
+    segments are stitched back together (without re-encoding) by ffmpeg.
+    '''
+    # frame ranges for each worker. the last one just runs to the end, in case the frame count is off
+    edges = np.linspace(0, frame_count, n_segments+1).astype(int)
+    ranges = [(edges[i_seg], edges[i_seg+1] if i_seg < n_segments-1 else None) for i_seg in range(n_segments)]
+
+    # segment file names for each view
+    seg_paths = [{b_name:'{}_part{:03d}{}'.format(*os.path.splitext(out_path)[:1], i_seg, os.path.splitext(out_path)[1])
+                  for b_name, out_path in out_paths.items()}
+                 for i_seg in range(n_segments)]
+
+    try:
+        with ProcessPoolExecutor(max_workers=n_segments) as pool:
+            futures = [pool.submit(_segment_worker, video_path, boundaries, frame_shape, transforms, start, stop, seg_paths[i_seg],
+                                   fps, encoder, pipelined, queue_size)
+                       for i_seg, (start, stop) in enumerate(ranges)]
+            seg_frames = [future.result() for future in futures]
+
+        # make sure every segment got all of its frames
+        for (start, stop), n_seg in zip(ranges, seg_frames):
+            if stop is not None and n_seg != stop - start:
+                raise RuntimeError(f'{video_path}: expected {stop-start} frames starting at {start}, got {n_seg}')
+
+        # put the segments back together for each view
+        for b_name, out_path in out_paths.items():
+            _concat_outputs([seg[b_name] for seg in seg_paths], out_path, encoder)
+
+    finally:
+        for seg in seg_paths:
+            for seg_path in seg.values():
+                _remove_output(seg_path)
+
+    return sum(seg_frames)
+
+
+def _segment_worker(*args):
+    # _split_range inside a pool worker, which has to write its own metrics summary
+    try:
+        return _split_range(*args)
+    finally:
+        flush_metrics()
+
+
+
+def _split_checkpointed(video_path:str, boundaries:dict, frame_shape:tuple, transforms:dict, out_paths:dict, fps:float,
+                        encoder:dict, ckpt_path:str, checkpoint_every:int, pipelined:bool = False, queue_size:int = 32):
+    '''
+    split a video in segments of checkpoint_every frames. After each segment
+    is closed, the frames committed for each view get written to a json
+    checkpoint next to the outputs. If a checkpoint is already there we
+    seek past everything it has and only split the rest. Once the video
+    is done the segments are stitched together and the checkpoint removed.
+    '''
+    # pick up where we left off, if we can
+    state = {'video':os.path.abspath(video_path), 'out_paths':out_paths, 'committed':{b_name:0 for b_name in out_paths}, 'segments':[]}
+    if os.path.exists(ckpt_path):
+        with open(ckpt_path, 'r') as fid:
+            prev_state = json.load(fid)
+        if prev_state['video'] == state['video'] and prev_state['out_paths'] == out_paths:
+            state = prev_state
+            print(f'Resuming {video_path} from frame {min(state["committed"].values())}')
+        else:
+            print(f'{ckpt_path} is for a different video or output, starting over')
+
+    start = min(state['committed'].values())
+    vid_read = _open_at(video_path, start)
+    plan = view_plan(boundaries, frame_shape, transforms)
+    try:
+        while True:
+            # new segment file for each view
+            i_seg = len(state['segments'])
+            seg = {b_name:'{}_part{:03d}{}'.format(os.path.splitext(out_path)[0], i_seg, os.path.splitext(out_path)[1])
+                   for b_name, out_path in out_paths.items()}
+            vid_dict = {b_name:open_writer(seg[b_name], fps, frame_size, encoder)
+                        for b_name, frame_size in plan.frame_sizes().items()}
+            try:
+                if pipelined:
+                    n_frames = _split_pipelined(vid_read, plan, vid_dict, queue_size, checkpoint_every)
+                else:
+                    n_frames = _split_serial(vid_read, plan, vid_dict, checkpoint_every)
+            finally:
+                for b_video in vid_dict.values():
+                    b_video.release()
+
+            # nothing left -- toss the empty segment
+            if n_frames == 0:
+                for seg_path in seg.values():
+                    _remove_output(seg_path)
+                break
+
+            # commit the segment
+            start += n_frames
+            state['segments'].append(seg)
+            state['committed'] = {b_name:start for b_name in out_paths}
+            with open(ckpt_path + '.tmp', 'w') as fid:
+                json.dump(state, fid)
+            os.replace(ckpt_path + '.tmp', ckpt_path) # so a crash can't leave half a checkpoint
+
+            if n_frames < checkpoint_every:
+                break
+
+    finally:
+        vid_read.release()
+
+    # stitch the segments back together and clean up
+    for b_name, out_path in out_paths.items():
+        seg_paths = [seg[b_name] for seg in state['segments']]
+        if seg_paths:
+            _concat_outputs(seg_paths, out_path, encoder)
+    for seg in state['segments']:
+        for seg_path in seg.values():
+            _remove_output(seg_path)
+    os.remove(ckpt_path)
+
+    return start
+
+
+
+def _concat_outputs(seg_paths:List[str], out_path:str, encoder:dict):
+    '''
+    join split segments into the final output for a view, whatever
+    backend wrote them
+    '''
+    if len(seg_paths) == 1 and encoder['backend'].lower() != 'npy':
+        os.replace(seg_paths[0], out_path)
+    elif encoder['backend'].lower() == 'npy':
+        concat_frame_stores(seg_paths, out_path)
+    else:
+        concat_videos(seg_paths, out_path, encoder['ffmpeg'])
+
+
+
+def _remove_output(out_path:str):
+    # delete a video file or a frame store directory
+    if os.path.isdir(out_path):
+        shutil.rmtree(out_path)
+    elif os.path.exists(out_path):
+        os.remove(out_path)
+
+
+
+def concat_videos(video_paths:List[str], out_path:str, ffmpeg:str = 'ffmpeg'):
+    '''
+    losslessly stitch videos with the same encoding together end to end
+    using ffmpeg's concat demuxer (stream copy, no re-encoding)
+    '''
+    list_path = os.path.splitext(out_path)[0] + '_concat.txt'
+    with open(list_path, 'w') as fid:
+        for video_path in video_paths:
+            fid.write("file '{}'\n".format(os.path.abspath(video_path).replace("'", "'\\''")))
+
+    command = [ffmpeg, '-y', '-loglevel', 'error', '-nostdin', '-f', 'concat', '-safe', '0', '-i', list_path,
+               '-c', 'copy', out_path]
+    try:
+        ret = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    finally:
+        os.remove(list_path)
+
+    if ret.returncode != 0:
+        raise RuntimeError(f'ffmpeg failed concatenating into {out_path}: {ret.stderr.decode(errors="replace").strip()}')
+
+
+
+def compare_videos(path_a:str, path_b:str):
+    '''
+    decode two videos side by side and count the frames that don't match.
+    Handy for making sure a parallel split gives the same output as a
+    serial one (with a lossless encoder, eg ffv1).
+
+    returns a dictionary with the frame count of each video and the number of mismatched frames
+    '''
+    vid_a = cv2.VideoCapture(path_a)
+    vid_b = cv2.VideoCapture(path_b)
+
+    counts = {'frames_a':0, 'frames_b':0, 'mismatched':0}
     while True:
+        ret_a, frame_a = vid_a.read()
+        ret_b, frame_b = vid_b.read()
+        counts['frames_a'] += ret_a
+        counts['frames_b'] += ret_b
+        if not (ret_a and ret_b):
+            if ret_a or ret_b: # one ran out before the other -- keep counting
+                continue
+            break
+        if frame_a.shape != frame_b.shape or np.any(frame_a != frame_b):
+            counts['mismatched'] += 1
+
+    vid_a.release()
+    vid_b.release()
+
+    return counts
+
+
+
+# stream the views straight out of the original video
+def iter_views(sql_path:str, video_path:str, is_calib:bool = False, batch_size:int = 1, as_array:bool = False,
+               start:int = 0, stop:int = None, copy:bool = True, transforms:dict = None):
+    '''
+    iter_views
+        generator that crops and flips the views of a multiview video the same
+        way as video_split_sql, but hands them back instead of writing videos,
+        so tracking can run without intermediate mp4s.
+
+    arguments:
+        - sql_path          sqlite file containing boundaries of views
+        - video_path        path of video
+        - is_calib          is this a calibration video? [default = False]
+        - batch_size        number of frames per yield [default = 1]
+        - as_array          stack each view's batch into an (n, height, width, 3) array,
+                            eg to hand to an inference engine [default = False]
+        - start             first frame [default = 0]
+        - stop              stop before this frame. None runs to the end [default = None]
+        - copy              if False, the yielded arrays are reused buffers that get
+                            overwritten on the next iteration [default = True]
+        - transforms        per-view corrections (see load_transform_config). if None, uses the [views]
+                            section of the config.toml next to the sql file
+
+    yields (frame_index, {view_name: views}) where frame_index is the first frame of the batch.
+    With batch_size = 1 and as_array = False each view is a single image, otherwise it's
+    a list of images (or an array if as_array)
+    '''
+    boundaries = bound_puller(sql_path, video_path, is_calib)
+    if boundaries == -1:
+        raise ValueError(f'Could not get boundaries for {video_path}')
+
+    if transforms is None:
+        transforms = load_transform_config(os.path.join(os.path.dirname(os.path.abspath(sql_path)), 'config.toml'))
+
+    vid_read = _open_at(video_path, start)
+    plan = view_plan(boundaries, (int(vid_read.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(vid_read.get(cv2.CAP_PROP_FRAME_WIDTH))),
+                     transforms)
+    max_frames = None if stop is None else stop - start
+
+    # batch buffers get filled straight from the plan
+    if as_array:
+        batches = {b_name:np.zeros((batch_size,) + buffer.shape, dtype=np.uint8) for b_name, buffer in plan.buffers.items()}
+
+    try:
+        i_batch = 0 # position within the batch
+        i_first = start # frame index of the start of the batch
+        for views in _view_frames(vid_read, plan, max_frames):
+            if as_array:
+                for b_name in plan.view_names:
+                    batches[b_name][i_batch] = views[b_name]
+            elif batch_size == 1:
+                batches = {b_name:view.copy() if copy else view for b_name, view in views.items()}
+            else:
+                if i_batch == 0:
+                    batches = {b_name:[] for b_name in plan.view_names}
+                for b_name, view in views.items():
+                    batches[b_name].append(view.copy()) # have to copy, the plan buffers get reused
+            i_batch += 1
+
+            if i_batch == batch_size:
+                yield i_first, ({b_name:batch.copy() for b_name, batch in batches.items()} if as_array and copy else batches)
+                i_first += i_batch
+                i_batch = 0
+
+        # whatever's left over
+        if i_batch > 0:
+            if as_array:
+                batches = {b_name:batch[:i_batch].copy() if copy else batch[:i_batch] for b_name, batch in batches.items()}
+            yield i_first, batches
+
+    finally:
+        vid_read.release()
+
+
+
+def _view_frames(vid_read, plan, max_frames:int = None):
+    '''
+    decode frames and crop + flip them with the plan. yields the plan's
+    buffers, so each view only stays valid until the next frame
+    '''
+    metrics = get_metrics()
+    n_frames = 0
+    frame = None
+    while max_frames is None or n_frames < max_frames:
 
-        # grab a frame
-        ret,frame = vid_read.read()
+        # grab a frame -- decoding into the same array each time
+        with metrics.timer('decode'):
+            ret,frame = vid_read.read(frame)
         if not ret: # if we're out of frames hop out
             break
 
-        # iterate through each boundary
-        for b_name,bound in boundaries.items():
-            temp_frame = frame[bound[0]:bound[2],bound[1]:bound[3],:].astype(np.uint8) # create a temp frame
+        # crop and flip each view into its buffer
+        with metrics.timer('crop'):
+            views = plan.apply(frame)
+        yield views
 
-            # manipulate it appropriately -- so far this will need to be hard coded
-            temp_frame = view_flipper(temp_frame, b_name)
+        n_frames += 1
+        metrics.progress('frames')
 
-            # gamma correction
-            # temp_frame = ((temp_frame/255)**.6 * 255).astype(np.uint8)
 
-            # save it
-            vid_dict[b_name].write(temp_frame)
 
-        
-    # close the videos
-    for b_name, b_video in vid_dict.items():
-        b_video.release()
+def read_frames_at(vid_read, frame_indices:List[int], seek_gap:int = 250):
+    '''
+    decode only the frames we ask for, in order. Short gaps get skipped with
+    grab() (no conversion to BGR), longer ones with a seek. If a seek doesn't
+    land where we asked we fall back to grabbing our way there.
+
+    arguments:
+        - vid_read          cv2.VideoCapture
+        - frame_indices     frames to read. duplicates get dropped
+        - seek_gap          gaps longer than this many frames get a seek instead of grabs [default = 250]
+
+    yields (frame_index, frame). the frame array gets reused, so copy it to keep it
+    '''
+    metrics = get_metrics()
+    position = int(vid_read.get(cv2.CAP_PROP_POS_FRAMES))
+    frame = None
+    for i_frame in sorted(set(int(i) for i in frame_indices)):
+
+        # get to the frame
+        with metrics.timer('seek'):
+            if i_frame < position or i_frame - position > seek_gap:
+                vid_read.set(cv2.CAP_PROP_POS_FRAMES, i_frame)
+                position = int(vid_read.get(cv2.CAP_PROP_POS_FRAMES))
+                if position > i_frame: # overshot, so start over from the top
+                    vid_read.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    position = 0
+
+            ret = True
+            while ret and position < i_frame:
+                ret = vid_read.grab()
+                position += 1
+        if not ret: # ran out of frames
+            break
+
+        # and only decode that one
+        with metrics.timer('decode'):
+            ret, frame = vid_read.read(frame)
+        if not ret:
+            break
+        position += 1
+
+        yield i_frame, frame
+        metrics.progress('frames')
+
+
+
+def _split_serial(vid_read, plan, vid_dict:dict, max_frames:int = None):
+    '''
+    decode, crop and write every frame one after another on this thread
+    '''
+    metrics = get_metrics()
+    n_frames = 0
+    for views in _view_frames(vid_read, plan, max_frames):
+
+        # save it
+        with metrics.timer('encode'):
+            for b_name, view in views.items():
+                vid_dict[b_name].write(view)
+
+        n_frames += 1
+
+    return n_frames
+
+
+
+def _split_pipelined(vid_read, plan, vid_dict:dict, queue_size:int = 32, max_frames:int = None):
+    '''
+    decode on one thread, and crop + write each view on its own thread.
+
+    Each view gets a bounded queue of frames, so the decoder blocks once
+    the slowest writer falls queue_size frames behind -- that keeps the
+    memory use capped. OpenCV releases the GIL while decoding and encoding
+    so the stages actually overlap.
+    '''
+    metrics = get_metrics()
+    view_queues = {b_name:queue.Queue(maxsize=queue_size) for b_name in plan.view_names}
+    errors = [] # anything that goes wrong inside of the threads
+
+    # decoder -- hand the same (read-only) frame to every view
+    def decoder(counter:list):
+        try:
+            while max_frames is None or counter[0] < max_frames:
+                if errors: # a writer failed -- no point decoding the rest of the video
+                    break
+                with metrics.timer('decode'):
+                    ret,frame = vid_read.read()
+                if not ret: # out of frames
+                    break
+                with metrics.timer('queue_wait'): # time spent blocked on the slowest writer
+                    for view_queue in view_queues.values():
+                        view_queue.put(frame)
+                counter[0] += 1
+                metrics.progress('frames')
+        except Exception as e:
+            errors.append(e)
+        finally:
+            for view_queue in view_queues.values(): # let the writers know we're done
+                view_queue.put(None)
+
+    # writers -- one per view. each view's buffer in the plan only gets touched by its own writer
+    def writer(b_name:str):
+        view_queue = view_queues[b_name]
+        while True:
+            frame = view_queue.get()
+            if frame is None:
+                break
+            if errors: # keep draining so the decoder doesn't block forever
+                continue
+            try:
+                with metrics.timer('crop'):
+                    view = plan.apply_view(frame, b_name)
+                with metrics.timer('encode'):
+                    vid_dict[b_name].write(view)
+            except Exception as e:
+                errors.append(e)
+
+    counter = [0]
+    threads = [threading.Thread(target=decoder, args=(counter,), name='decoder')]
+    threads += [threading.Thread(target=writer, args=(b_name,), name=f'writer_{b_name}') for b_name in plan.view_names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return counter[0]
+
+
+
+# split a whole list of videos across a pool of processes
+def video_split_batch(sql_path:str, video_paths:List[str], output_dir:str = None, is_calib:bool = False,
+                      n_workers:int = None, **split_kwargs):
+    '''
+    video_split_batch
+        runs video_split_sql on a list of videos (or directories of videos) using
+        a pool of processes. Each worker does its own sql lookups, so they each
+        have their own connection to the db. A video that fails is reported
+        and the rest of the batch keeps going.
+
+    arguments:
+        - sql_path          sqlite file containing boundaries of views
+        - video_paths       list of videos and/or directories to search for videos
+        - output_dir        output directory. if None, each video gets its own "_croppedViews" directory
+        - is_calib          are these calibration videos? [default = False]
+        - n_workers         number of processes. if None, uses the number of cpus
+        - split_kwargs      any other keyword arguments are passed on to video_split_sql
+
+    returns a list of per-video status dictionaries
+    '''
+
+    # check to make sure that we can access tables in the sql file
+    if check_sql(sql_path) == -1:
+        return -1
+
+    video_list = find_videos(video_paths)
+
+    # longest videos first (if they've been probed) so the pool doesn't end up waiting on one big one
+    info = get_project_db(sql_path).video_info(video_list)
+    frame_counts = {video:info.get(os.path.split(video)[-1], {}).get('frame_count') for video in video_list}
+    video_list = sorted(video_list, key=lambda video: -(frame_counts[video] or 0))
+    total_frames = sum([count for count in frame_counts.values() if count])
+    print(f'Splitting {len(video_list)} videos' + (f' ({total_frames} frames)' if total_frames else ''))
+
+    statuses = []
+    frames_done = 0
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(_split_worker, sql_path, video, output_dir, is_calib, split_kwargs) for video in video_list]
+
+        for future in as_completed(futures):
+            try:
+                status = future.result()
+            except Exception as e: # the worker itself died
+                status = {'video':video_list[futures.index(future)], 'status':'failed', 'error':repr(e),
+                          'frames':0, 'seconds':0, 'fps':0}
+
+            frames_done += frame_counts.get(status['video']) or 0
+            progress = f' -- {frames_done/total_frames:.0%} of frames done' if total_frames else ''
+            if status['status'] == 'ok':
+                print(f"[{len(statuses)+1}/{len(video_list)}] {status['video']}: "
+                      f"{status['frames']} frames in {status['seconds']:.1f}s ({status['fps']:.1f} fps){progress}")
+            else:
+                print(f"[{len(statuses)+1}/{len(video_list)}] {status['video']}: FAILED -- {status['error']}")
+            statuses.append(status)
+            get_metrics().event('video_split', **status)
+
+    n_failed = sum([status['status'] != 'ok' for status in statuses])
+    print(f'Split {len(statuses)-n_failed} of {len(statuses)} videos; {n_failed} failed')
+
+    return statuses
+
+
+
+def _split_worker(sql_path:str, video_path:str, output_dir:str, is_calib:bool, split_kwargs:dict):
+    '''
+    runs a single video_split_sql inside a pool worker, and turns
+    the result into a status dictionary instead of raising
+    '''
+    status = {'video':video_path, 'status':'ok', 'error':None, 'frames':0, 'seconds':0, 'fps':0}
+
+    t_start = time.perf_counter()
+    try:
+        ret = video_split_sql(sql_path, video_path, output_dir=output_dir, is_calib=is_calib, **split_kwargs)
+    except Exception as e:
+        ret = -1
+        status['error'] = repr(e)
+    status['seconds'] = time.perf_counter() - t_start
+
+    if ret == -1:
+        status['status'] = 'failed'
+        status['error'] = status['error'] or 'video_split_sql returned -1'
+    else:
+        status['frames'] = ret
+        status['fps'] = ret / status['seconds'] if status['seconds'] > 0 else 0
+
+    flush_metrics() # pool workers exit without running atexit
+    return status
+
+
+
+def find_videos(video_paths:List[str], extensions:List[str] = ['.mp4','.avi']):
+    '''
+    expand a list of video files and directories into a list of video files.
+    directories are walked recursively, skipping any "_croppedViews" outputs
+    '''
+    video_list = []
+    for video_path in video_paths:
+        if os.path.isdir(video_path):
+            for root,dirs,files in os.walk(video_path):
+                dirs[:] = sorted([d for d in dirs if not d.endswith('_croppedViews')])
+                video_list += [os.path.join(root, file) for file in sorted(files) if os.path.splitext(file)[-1] in extensions]
+        else:
+            video_list.append(video_path)
+
+    return video_list
 
     
 
@@ -110,39 +741,355 @@ def bound_puller(sql_filename, vid_filename, is_calib:bool = False):
 
     if is_calib == True, this video is a calibration video and just
     pull its bounding boxes directly
+
+    lookups go through a calibration_index that's built once per process,
+    so splitting a big batch of videos only reads the db once
     '''
     if not os.path.exists(sql_filename):
         return -1
     
-    conn = sqlite3.connect(sql_filename) # create connector
-    cur = conn.cursor()
-
-    vid_short = os.path.split(vid_filename)[-1]
-
-    if not is_calib:
-        # get the date of the video
-        sql_query = "SELECT DATE(s.time), v.relative_path FROM session as s, videos as v WHERE v.relative_path LIKE ? AND s.rowid=v.session_id ;"
-        response_video = np.array(cur.execute(sql_query,('%'+vid_short,)).fetchall())
-        # print(vid_short)
-        video_date = response_video[0,0].astype(np.datetime64) # convert to datetime for math
-        # video_date = response_video[0].astype(np.datetime64) # convert to datetime for math
-    
-        # get all of the dates of the calibration videos
-        sql_query = "SELECT DATE(c.date), c.boundary FROM calibration as c;"
-        response_calibration = np.array(cur.execute(sql_query).fetchall())
-        calib_date = response_calibration[:,0].astype(np.datetime64) # convert to datetime for math
-
-        # find the associated calibration date
-        date_diffs = (video_date-calib_date).astype(np.int8) # how long has passed since the calibration?
-        calib_i = np.where(date_diffs < 0, np.inf, date_diffs).argmin() # find the most recent calibration (but not recorded after video)
-        
-        return eval(response_calibration[calib_i,1]) # return the bounding boxes as a dictionary
-    
-    elif is_calib:
-        sql_query = "SELECT c.boundary FROM calibration as c WHERE c.relative_path LIKE ? ;"
-        response_calibration = cur.execute(sql_query, ('%'+vid_short,)).fetchall()[0][0]
+    with get_metrics().timer('bound_puller'):
+        index = get_calibration_index(sql_filename)
+
+        if not is_calib:
+            calib_id = index.for_video(vid_filename)
+        elif is_calib:
+            calib_id = index.for_calibration(vid_filename)
+
+    if calib_id is None:
+        print(f'Could not find a calibration for {vid_filename}')
+        return -1
+
+    return index.boundary(calib_id) # return the bounding boxes as a dictionary
+
+
+
+def calibration_puller(sql_filename, vid_filename, is_calib:bool = False):
+    '''
+    same lookup as bound_puller, but returns the whole calibration:
+    {'boundary':..., 'intrinsic':..., 'extrinsic':...}. intrinsic and
+    extrinsic are None if the calibration video hasn't been calibrated yet
+    '''
+    if not os.path.exists(sql_filename):
+        return -1
+
+    index = get_calibration_index(sql_filename)
+    calib_id = index.for_calibration(vid_filename) if is_calib else index.for_video(vid_filename)
+    if calib_id is None:
+        print(f'Could not find a calibration for {vid_filename}')
+        return -1
+
+    return {'boundary':index.boundary(calib_id), 'intrinsic':index.intrinsic(calib_id), 'extrinsic':index.extrinsic(calib_id)}
+
+
+
+# all of the calibration indices we've built in this process, by sql file
+_calibration_indices = {}
+
+def get_calibration_index(sql_path:str, refresh:bool = False):
+    '''
+    get the calibration_index for a sql file, building it the first time
+    it's needed (or if refresh == True). It gets reloaded if anything in this
+    process has written to the db (eg a new calibration) since it was built
+    '''
+    key = os.path.abspath(sql_path)
+    if refresh or key not in _calibration_indices:
+        _calibration_indices[key] = calibration_index(sql_path)
+    elif _calibration_indices[key].stale():
+        _calibration_indices[key].load()
+
+    return _calibration_indices[key]
+
+
+
+class calibration_index():
+    '''
+    In-memory copy of the calibration table (plus the recording date of each
+    video) sorted by date, so "most recent calibration on or before date D"
+    is a binary search instead of a db query. The blobs stay encoded until
+    they're asked for (see calibration_codec), and decoded ones are kept in an
+    LRU cache keyed by calibration rowid and column.
+
+    The first time a video or calibration isn't in the index we reload it
+    from the db, in case it was added by another process after the index was
+    built. Misses after that don't reload (so a batch full of videos with no
+    calibration doesn't re-read the table for each one) until
+    get_calibration_index(refresh=True), or a write from this process.
+    '''
+    def __init__(self, sql_path:str, cache_size:int = 256):
+        self.sql_path = sql_path
+        self._decoded = lru_cache(maxsize=cache_size)(self._decode)
+        self.reloaded = False # have we already reloaded for a miss?
+        self.load()
+
+    def load(self):
+        # pull everything we need out of the db in one go
+        get_metrics().count('calibration_index_loads')
+        db = get_project_db(self.sql_path)
+        self.generation = db.generation # before reading, so a write while we do counts as new
+
+        # calibrations -- the date comes from the time column, or the _YYYYmmdd_ in the name if that's empty
+        calibrations = []
+        self.calib_names = {} # name -> rowid
+        self.blobs = {} # rowid -> encoded (boundary, intrinsic, extrinsic)
+        for rowid, name, calib_time, *blobs in db.calibrations():
+            self.calib_names[os.path.split(name)[-1]] = rowid
+            self.blobs[rowid] = dict(zip(BLOB_COLUMNS, blobs))
+            calib_date = calib_time[:10] if calib_time else date_from_name(name)
+            if calib_date is not None:
+                calibrations.append((calib_date, rowid))
+
+        calibrations.sort()
+        self.dates = [calib[0] for calib in calibrations]
+        self.rowids = [calib[1] for calib in calibrations]
+
+        # recording date of every video
+        self.video_dates = db.video_dates()
+
+        self._decoded.cache_clear()
+
+    def stale(self):
+        # has something written to the db through its ProjectDB since we loaded?
+        return get_project_db(self.sql_path).generation != self.generation
+
+    def lookup(self, date:str):
+        # rowid of the most recent calibration on or before the date (YYYY-mm-dd), or None
+        i_calib = bisect_right(self.dates, date[:10]) - 1
+        return self.rowids[i_calib] if i_calib >= 0 else None
+
+    def for_video(self, vid_filename:str):
+        # rowid of the calibration to use for a session video
+        vid_short = os.path.split(vid_filename)[-1]
+        if vid_short not in self.video_dates:
+            self._reload_once()
+        video_date = self.video_dates.get(vid_short)
+        return None if video_date is None else self.lookup(video_date)
 
-        return eval(response_calibration)
+    def for_calibration(self, vid_filename:str):
+        # rowid of a calibration video's own row
+        vid_short = os.path.split(vid_filename)[-1]
+        if vid_short not in self.calib_names:
+            self._reload_once()
+        return self.calib_names.get(vid_short)
+
+    def _reload_once(self):
+        # reload for a miss, but only the first one
+        if not self.reloaded:
+            self.reloaded = True
+            self.load()
+
+    def boundary(self, rowid:int):
+        # {view: [top, left, bottom, right]}
+        return self._decoded(rowid, 'boundary')
+
+    def intrinsic(self, rowid:int):
+        # {view: camera matrix, distortion etc} or None if it hasn't been calibrated
+        return self._decoded(rowid, 'intrinsic')
+
+    def extrinsic(self, rowid:int):
+        # {view: pose relative to Center} or None if it hasn't been calibrated
+        return self._decoded(rowid, 'extrinsic')
+
+    def _decode(self, rowid:int, column:str):
+        # turn a stored blob back into a dictionary
+        return decode_calibration(self.blobs[rowid][column])
+
+
+
+def date_from_name(filename:str):
+    '''
+    pull the _YYYYmmdd_ date out of a filename, as YYYY-mm-dd. None if there isn't one
+    '''
+    match = re.search(r'_(\d{4})(\d{2})(\d{2})_', os.path.split(filename)[-1])
+    if match is None:
+        return None
+    return '-'.join(match.groups())
+
+
+
+# compiled crops and flips for each view of a video
+class view_plan():
+    '''
+    Works out the crop, flip and corrections for each view once per video,
+    and keeps a preallocated contiguous buffer for each view. Each frame is
+    then cut into the views with a single copy per view, with any gamma/CLAHE
+    corrections done in place, so the frame loop doesn't allocate anything.
+
+    Unless the transforms say otherwise, the flips match view_flipper. If a
+    view gets padded, the image sits in the top left of a black buffer.
+    '''
+    def __init__(self, boundaries:dict, frame_shape:tuple = None, transforms:dict = None):
+        self.view_names = list(boundaries.keys())
+        self.crops = {} # (rows, columns) slice of the original frame for each view
+        self.flips = {} # function copying the crop into the buffer
+        self.buffers = {} # output image for each view (including any padding)
+        self.images = {} # the part of each buffer that isn't padding
+        self.chains = {} # in-place corrections for each view
+
+        for b_name, bound in boundaries.items():
+            bound = [int(b) for b in np.array(bound).flatten()] # [top, left, bottom, right]
+            if frame_shape is not None: # make sure we stay inside of the frame
+                bound = [max(bound[0],0), max(bound[1],0), min(bound[2],frame_shape[0]), min(bound[3],frame_shape[1])]
+            height, width = bound[2]-bound[0], bound[3]-bound[1]
+
+            settings = view_transforms(transforms, b_name)
+            orientation = settings['orientation'] or _default_orientations.get(b_name.lower(), 'none')
+            self.crops[b_name] = (slice(bound[0],bound[2]), slice(bound[1],bound[3]))
+            self.flips[b_name], transposed = _orientations[orientation]
+
+            # some orientations swap width and height
+            if transposed:
+                height, width = width, height
+
+            # pad up to a multiple of pad_multiple for the model
+            pad = int(settings['pad_multiple'])
+            self.buffers[b_name] = np.zeros((-(-height//pad)*pad, -(-width//pad)*pad, 3), dtype=np.uint8)
+            self.images[b_name] = self.buffers[b_name][:height, :width]
+            self.chains[b_name] = transform_chain((height, width), settings)
+
+    def frame_sizes(self):
+        # (width, height) of each view, the way cv2.VideoWriter wants it
+        return {b_name:(buffer.shape[1], buffer.shape[0]) for b_name, buffer in self.buffers.items()}
+
+    def apply_view(self, frame:np.array, b_name:str, dst:np.array = None):
+        # crop, flip and correct a single view into dst (or its buffer)
+        if dst is None:
+            dst = self.buffers[b_name]
+            image = self.images[b_name]
+        else:
+            image = dst[:self.images[b_name].shape[0], :self.images[b_name].shape[1]]
+        rows, cols = self.crops[b_name]
+        self.flips[b_name](frame[rows, cols, :], image)
+        self.chains[b_name].apply(image)
+        return dst
+
+    def apply(self, frame:np.array, out:dict = None):
+        # crop and flip all views. buffers get overwritten on the next call
+        if out is None:
+            out = self.buffers
+        for b_name in self.view_names:
+            self.apply_view(frame, b_name, out[b_name])
+        return out
+
+
+
+class transform_chain():
+    '''
+    in-place corrections for a single view (gamma through a lookup table,
+    CLAHE), with any scratch buffers allocated up front
+    '''
+    def __init__(self, shape:tuple, settings:dict):
+        self.steps = []
+
+        if float(settings['gamma']) != 1.0:
+            self.lut = gamma_lut(float(settings['gamma']))
+            self.steps.append(self._gamma)
+
+        if settings['clahe']: # equalize the lightness channel
+            self.clahe = cv2.createCLAHE(clipLimit=float(settings['clahe_clip']),
+                                         tileGridSize=(int(settings['clahe_grid']), int(settings['clahe_grid'])))
+            self.lab = np.empty(tuple(shape) + (3,), dtype=np.uint8)
+            self.lightness = np.empty(tuple(shape), dtype=np.uint8)
+            self.steps.append(self._clahe)
+
+    def apply(self, image:np.array):
+        for step in self.steps:
+            step(image)
+        return image
+
+    def _gamma(self, image:np.array):
+        cv2.LUT(image, self.lut, dst=image)
+
+    def _clahe(self, image:np.array):
+        cv2.cvtColor(image, cv2.COLOR_BGR2LAB, dst=self.lab)
+        cv2.extractChannel(self.lab, 0, dst=self.lightness)
+        self.clahe.apply(self.lightness, dst=self.lightness)
+        cv2.insertChannel(self.lightness, self.lab, 0)
+        cv2.cvtColor(self.lab, cv2.COLOR_LAB2BGR, dst=image)
+
+
+
+@lru_cache(maxsize=None)
+def gamma_lut(gamma:float):
+    '''
+    256 entry lookup table for gamma correction -- same values as
+    ((image/255)**gamma * 255).astype(np.uint8)
+    '''
+    return ((np.arange(256)/255)**gamma * 255).astype(np.uint8)
+
+
+
+# what the views get if config.toml doesn't say otherwise
+DEFAULT_TRANSFORMS = {
+    'orientation': None,    # None uses the usual mirror flip for the view name (see view_flipper)
+    'gamma': 1.0,           # 1.0 skips gamma correction
+    'splice_gamma': 0.6,    # gamma for the spliced label frames (see splice_plan). 1.0 skips it
+    'clahe': False,         # contrast limited histogram equalization on the lightness channel
+    'clahe_clip': 2.0,
+    'clahe_grid': 8,
+    'pad_multiple': 1,      # pad the width and height up to a multiple of this. 1 skips padding
+}
+
+
+def load_transform_config(config_path:str = None):
+    '''
+    read the [views] section of a config.toml. Settings at the top of the
+    section apply to every view, and [views.North] etc override them for
+    a single view.
+
+    returns {'default': settings, 'north': settings, ...}
+    '''
+    section = {}
+    if config_path is not None and os.path.exists(config_path):
+        section = toml.load(config_path).get('views', {})
+
+    transforms = {'default':dict(DEFAULT_TRANSFORMS, **{key:value for key, value in section.items() if not isinstance(value, dict)})}
+    for key, value in section.items():
+        if isinstance(value, dict):
+            transforms[key.lower()] = dict(transforms['default'], **value)
+
+    return transforms
+
+
+def view_transforms(transforms:dict, view_name:str):
+    # settings for a single view
+    if transforms is None:
+        return DEFAULT_TRANSFORMS
+    return transforms.get(view_name.lower(), transforms.get('default', DEFAULT_TRANSFORMS))
+
+
+def _copy_view(src:np.array, dst:np.array):
+    np.copyto(dst, src)
+
+def _flip_lr(src:np.array, dst:np.array):
+    cv2.flip(src, 1, dst=dst)
+
+def _flip_ud(src:np.array, dst:np.array):
+    cv2.flip(src, 0, dst=dst)
+
+def _transpose(src:np.array, dst:np.array):
+    cv2.transpose(src, dst=dst)
+
+def _anti_transpose(src:np.array, dst:np.array):
+    cv2.transpose(src, dst=dst)
+    cv2.flip(dst, -1, dst=dst)
+
+def _rotate_90(src:np.array, dst:np.array):
+    cv2.rotate(src, cv2.ROTATE_90_CLOCKWISE, dst=dst)
+
+def _rotate_180(src:np.array, dst:np.array):
+    cv2.rotate(src, cv2.ROTATE_180, dst=dst)
+
+def _rotate_270(src:np.array, dst:np.array):
+    cv2.rotate(src, cv2.ROTATE_90_COUNTERCLOCKWISE, dst=dst)
+
+# orientation name -> (function copying the crop into the buffer, does it swap width and height)
+_orientations = {'none':(_copy_view, False), 'flip_lr':(_flip_lr, False), 'flip_ud':(_flip_ud, False),
+                 'transpose':(_transpose, True), 'anti_transpose':(_anti_transpose, True),
+                 'rotate_90':(_rotate_90, True), 'rotate_180':(_rotate_180, False), 'rotate_270':(_rotate_270, True)}
+
+# same flips as view_flipper
+_default_orientations = {'south':'flip_lr', 'north':'flip_ud', 'east':'transpose', 'west':'anti_transpose'}
 
 
 
@@ -171,15 +1118,39 @@ def check_sql(sql_path):
         return -1
 
     # can we open the file?
-    conn = sqlite3.connect(sql_path)
-    cur = conn.cursor()
-
-    cur.execute('SELECT name FROM sqlite_schema;')
-    if len(cur.fetchall()) == 0:
+    with get_metrics().timer('check_sql'):
+        n_tables = len(get_project_db(sql_path).table_names())
+    if n_tables == 0:
         print(f'Did not find any tables in {sql_path}')
         return -1
     
-    # close it all, return the file path
-    cur.close()
-    conn.close()
     return 1
+
+
+
+if __name__ == '__main__':
+    description = '''
+                Splits multiview videos into each of their views using the boundaries
+                in the project sqlite file. Videos (or whole directories of videos)
+                are spread across a pool of processes.
+                '''
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('sql_path', help='SQLite3 file name or path')
+    parser.add_argument('videos', nargs='+', help='videos and/or directories of videos to split')
+    parser.add_argument('-o','--output_dir', help='output directory [default = next to each video]', default=None)
+    parser.add_argument('-j','--workers', help='number of worker processes [default = number of cpus]', type=int, default=None)
+    parser.add_argument('--calib', help='these are calibration videos', action='store_true')
+    parser.add_argument('--pipelined', help='run decoding and each view writer on separate threads', action='store_true')
+    parser.add_argument('--segments', help='split each video into this many frame ranges in parallel', type=int, default=1)
+    parser.add_argument('--checkpoint', help='checkpoint every N frames so an interrupted split can resume', type=int, default=None)
+    parser.add_argument('--metrics', help='write timing metrics to this JSON-lines file', default=None)
+    parser.add_argument('--config', help='config.toml with the [encoder] settings [default = next to the sql file]', default=None)
+    args = parser.parse_args()
+
+    if args.metrics:
+        enable_metrics(args.metrics)
+
+    encoder = load_encoder_config(args.config) if args.config else None
+    video_split_batch(args.sql_path, args.videos, output_dir=args.output_dir, is_calib=args.calib, n_workers=args.workers,
+                      pipelined=args.pipelined, encoder=encoder, n_segments=args.segments,
+                      checkpoint_every=args.checkpoint)
@@ -0,0 +1,580 @@
+#! /usr/bin/env python
+
+# project_db
+'''
+Shared helpers for the project sqlite file.
+
+    - connect opens the database in WAL mode with a few pragmas, and
+      ensure_schema runs the versioned migrations an older
+      project_tracking.sqlite3 is missing (columns, tables and indexes), so
+      existing projects get upgraded in place
+    - file_fingerprint gives a cheap content fingerprint for a video: its size
+      plus a blake2b hash of a few byte ranges spread through the file. Copies
+      and renamed files get the same fingerprint, and reading a few hundred KB
+      is cheap even on a network share
+    - known_fingerprints checks a whole batch of fingerprints against a table
+      with a handful of indexed IN queries
+    - scan_tree lists a directory tree with os.scandir, a directory per task in
+      a thread pool, so the metadata round trips on a network share overlap.
+      The scan_index table remembers the size and mtime of every file we've
+      dealt with (and which videos row it went into), and changed_files uses
+      it to skip anything we've already seen
+    - ProjectDB wraps all of that around one connection per thread (and per
+      process), with typed queries for the mice, sessions, videos and
+      calibrations. get_project_db hands out one per sql file, so code that
+      loops over thousands of videos doesn't reconnect for each one
+'''
+
+import os
+import hashlib
+import sqlite3
+import threading
+import toml
+from typing import List
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+FINGERPRINT_TABLES = ['videos', 'calibration']
+
+# what video_probe finds out about each video, and the column type it's stored as
+VIDEO_INFO_COLUMNS = {'fps': 'real',
+                      'frame_count': 'integer',
+                      'width': 'integer',
+                      'height': 'integer',
+                      'codec': 'text',
+                      'duration': 'real',
+                      'keyframe_interval': 'integer'}
+
+SAMPLE_COUNT = 4            # byte ranges hashed per file
+SAMPLE_SIZE = 64*1024       # bytes per range
+QUERY_BATCH = 500           # fingerprints per IN (...) query, well under sqlite's variable limit
+INSERT_BATCH = 1000         # rows per insert transaction
+STATEMENT_CACHE = 256       # compiled statements kept per connection
+READ_CACHE = 1024           # query results kept by ProjectDB
+
+# the [database] section of config.toml
+DEFAULT_DATABASE = {'wal': True}    # set to false for a project on a network share
+
+PRAGMAS = {'synchronous': 'NORMAL',     # safe with WAL, and saves an fsync per transaction
+           'temp_store': 'MEMORY',
+           'cache_size': -64*1024,      # KiB
+           'busy_timeout': 30000}       # ms to wait on another process' write lock
+
+
+
+def connect(sql_path:str, wal:bool = True):
+    '''
+    open the project database with our pragmas, and bring its schema up to date.
+    WAL lets readers (eg the splitting workers) carry on while something is
+    writing. Turn it off for a database on a network share, where sqlite can't
+    share the WAL index between machines -- that also puts a database that was
+    in WAL mode back to the default rollback journal
+    '''
+    con = sqlite3.connect(sql_path, cached_statements=STATEMENT_CACHE)
+    con.execute(f'PRAGMA journal_mode={"WAL" if wal else "DELETE"};')
+    for pragma, value in PRAGMAS.items():
+        con.execute(f'PRAGMA {pragma}={value};')
+    ensure_schema(con)
+
+    return con
+
+
+def load_database_config(config_path:str = None):
+    '''
+    read the [database] section of a config.toml, filling in anything missing
+    with the defaults. If the file doesn't exist we just get the defaults
+    '''
+    settings = dict(DEFAULT_DATABASE)
+    if config_path is not None and os.path.exists(config_path):
+        settings.update(toml.load(config_path).get('database', {}))
+
+    return settings
+
+
+
+# schema migrations -- each one takes a database at the previous version to the
+# next, and has to cope with databases that were created with some of it already
+# in place. The version lives in sqlite's user_version
+def _table_columns(cur:sqlite3.Cursor, table:str):
+    return [row[1] for row in cur.execute(f'PRAGMA table_info({table});')]
+
+
+def _migrate_fingerprints(cur:sqlite3.Cursor):
+    # content fingerprints for deduplication, and the scan index for populate_videos
+    for table in FINGERPRINT_TABLES:
+        columns = _table_columns(cur, table)
+        if not columns:
+            continue
+        if 'fingerprint' not in columns:
+            cur.execute(f'ALTER TABLE {table} ADD COLUMN fingerprint text;')
+        cur.execute(f'CREATE INDEX IF NOT EXISTS {table}_fingerprint ON {table} (fingerprint);')
+    cur.execute('CREATE TABLE IF NOT EXISTS scan_index (path text PRIMARY KEY, size integer, mtime real);')
+
+
+def _migrate_video_name(cur:sqlite3.Cursor):
+    # sqlite_setup used to call the videos name column vid_name, but everything reads and writes name
+    columns = _table_columns(cur, 'videos')
+    if 'vid_name' in columns and 'name' not in columns:
+        cur.execute('ALTER TABLE videos RENAME COLUMN vid_name TO name;')
+
+
+def _migrate_lookup_indexes(cur:sqlite3.Cursor):
+    # the columns we look things up by
+    indexes = {'videos_name': ('videos', 'name'),
+               'session_mouse_time': ('session', 'mouse_id, time'),
+               'calibration_time': ('calibration', 'time'),
+               'calibration_name': ('calibration', 'name')}
+    for index, (table, columns) in indexes.items():
+        if _table_columns(cur, table):
+            cur.execute(f'CREATE INDEX IF NOT EXISTS {index} ON {table} ({columns});')
+
+
+def _migrate_video_info(cur:sqlite3.Cursor):
+    # frame rate, frame count, size etc from video_probe
+    columns = _table_columns(cur, 'videos')
+    for column, column_type in VIDEO_INFO_COLUMNS.items():
+        if column not in columns:
+            cur.execute(f'ALTER TABLE videos ADD COLUMN {column} {column_type};')
+
+
+def _migrate_scan_video(cur:sqlite3.Cursor):
+    # which videos row each scanned file went into, so a file that changes updates its row
+    if 'video_id' not in _table_columns(cur, 'scan_index'):
+        cur.execute('ALTER TABLE scan_index ADD COLUMN video_id integer;')
+
+    # files scanned before this only have their name to go on, so only link the ones that are unambiguous
+    videos, paths = {}, {}
+    for rowid, name in cur.execute('SELECT rowid, name FROM videos;').fetchall():
+        videos.setdefault(os.path.split(name)[-1], []).append(rowid)
+    for (path,) in cur.execute('SELECT path FROM scan_index WHERE video_id IS NULL;').fetchall():
+        paths.setdefault(os.path.split(path)[-1], []).append(path)
+    cur.executemany('UPDATE scan_index SET video_id = ? WHERE path = ?;',
+                    [(videos[name][0], name_paths[0]) for name, name_paths in paths.items()
+                     if len(name_paths) == 1 and len(videos.get(name, [])) == 1])
+
+
+# every migration is safe to run again, so the rename could go in ahead of
+# the indexes that need it (databases that already had those have name anyway)
+MIGRATIONS = [_migrate_fingerprints,    # version 1
+              _migrate_video_name,      # version 2
+              _migrate_lookup_indexes,  # version 3
+              _migrate_video_info,      # version 4
+              _migrate_scan_video]      # version 5
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def ensure_schema(con:sqlite3.Connection):
+    '''
+    run any migrations an older project database hasn't had yet. Does nothing
+    if it's already up to date
+    '''
+    cur = con.cursor()
+    version = cur.execute('PRAGMA user_version;').fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        cur.close()
+        return
+
+    if version == 0 and not _table_columns(cur, 'videos'):
+        # not set up yet (sqlite_setup calls this again once the tables are there)
+        cur.close()
+        return
+
+    # all or nothing (sqlite's DDL is transactional, but python won't open a transaction for it on its own)
+    cur.execute('BEGIN;')
+    try:
+        for i_version in range(version, SCHEMA_VERSION):
+            MIGRATIONS[i_version](cur)
+        cur.execute(f'PRAGMA user_version={SCHEMA_VERSION};')
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    cur.close()
+
+
+
+def file_fingerprint(path:str, n_samples:int = SAMPLE_COUNT, sample_size:int = SAMPLE_SIZE):
+    '''
+    "<size in hex>-<blake2b of the sampled ranges>". The ranges are the start,
+    the end and evenly spaced points in between; small files get hashed whole
+    '''
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(size.to_bytes(8, 'little'))
+    with open(path, 'rb') as fid:
+        if size <= n_samples*sample_size:
+            digest.update(fid.read())
+        else:
+            for i_sample in range(n_samples):
+                fid.seek((size - sample_size)*i_sample // (n_samples - 1))
+                digest.update(fid.read(sample_size))
+
+    return f'{size:x}-{digest.hexdigest()}'
+
+
+def fingerprint_files(paths:List[str], n_workers:int = 16):
+    '''
+    fingerprints for a list of files, read in a thread pool so the reads on a
+    network share overlap. Files we can't read get None
+    '''
+    def _fingerprint(path):
+        try:
+            return file_fingerprint(path)
+        except OSError as e:
+            print(f'Unable to read {path}: {e}')
+            return None
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        return list(pool.map(_fingerprint, paths))
+
+
+
+def known_fingerprints(con:sqlite3.Connection, table:str, fingerprints:List[str]):
+    '''
+    which of the fingerprints are already in the table
+    '''
+    fingerprints = list(set([fp for fp in fingerprints if fp is not None]))
+    known = set()
+    cur = con.cursor()
+    for i_start in range(0, len(fingerprints), QUERY_BATCH):
+        batch = fingerprints[i_start:i_start + QUERY_BATCH]
+        sql_query = f'SELECT fingerprint FROM {table} WHERE fingerprint IN ({",".join("?"*len(batch))});'
+        known.update([row[0] for row in cur.execute(sql_query, batch)])
+    cur.close()
+
+    return known
+
+
+def unfingerprinted_names(con:sqlite3.Connection, table:str):
+    '''
+    names of rows added before we had fingerprints -- the best we can do for
+    those is match on the name
+    '''
+    cur = con.cursor()
+    names = set([os.path.split(row[0])[-1] for row in cur.execute(f'SELECT name FROM {table} WHERE fingerprint IS NULL;')])
+    cur.close()
+
+    return names
+
+
+
+def scan_tree(root:str, extensions:List[str] = None, n_workers:int = 16):
+    '''
+    [(path, size, mtime)] for every file under root (optionally only the ones
+    with one of the extensions). Directories we can't read get skipped, like os.walk
+    '''
+    files = []
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        pending = {pool.submit(_scan_dir, root, extensions)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_files, sub_dirs = future.result()
+                files += dir_files
+                pending.update([pool.submit(_scan_dir, sub_dir, extensions) for sub_dir in sub_dirs])
+
+    return sorted(files)
+
+
+def _scan_dir(directory:str, extensions:List[str] = None):
+    # files and subdirectories of a single directory
+    dir_files, sub_dirs = [], []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    sub_dirs.append(entry.path)
+                elif extensions is None or os.path.splitext(entry.name)[-1] in extensions:
+                    stat = entry.stat()
+                    dir_files.append((entry.path, stat.st_size, stat.st_mtime))
+    except OSError as e:
+        print(f'Unable to scan {directory}: {e}')
+
+    return dir_files, sub_dirs
+
+
+
+def changed_files(con:sqlite3.Connection, files:List[tuple], root:str):
+    '''
+    the (path, size, mtime) entries from scan_tree that are new, or whose size or
+    mtime changed since they went into the scan index. Paths in the index are
+    relative to root, so the project can be moved or mounted somewhere else
+    '''
+    cur = con.cursor()
+    indexed = {row[0]:(row[1], row[2]) for row in cur.execute('SELECT path, size, mtime FROM scan_index;')}
+    cur.close()
+
+    return [(path, size, mtime) for path, size, mtime in files
+            if indexed.get(os.path.relpath(path, root)) != (size, mtime)]
+
+
+def indexed_videos(con:sqlite3.Connection, paths:List[str], root:str):
+    '''
+    {path: videos rowid} for the paths that are in the scan index with a video
+    that's still in the table
+    '''
+    relpaths = {os.path.relpath(path, root):path for path in paths}
+    keys = list(relpaths)
+    video_ids = {}
+    cur = con.cursor()
+    for i_start in range(0, len(keys), QUERY_BATCH):
+        batch = keys[i_start:i_start + QUERY_BATCH]
+        sql_query = ('SELECT s.path, s.video_id FROM scan_index as s, videos as v '
+                     f'WHERE v.rowid = s.video_id AND s.path IN ({",".join("?"*len(batch))});')
+        video_ids.update([(relpaths[path], video_id) for path, video_id in cur.execute(sql_query, batch)])
+    cur.close()
+
+    return video_ids
+
+
+def insert_videos(con:sqlite3.Connection, rows:List[tuple]):
+    '''
+    add a session and its video for each (mouse_id, time, task, enclosure, name, fingerprint, info)
+    row, with one executemany per table. info is a dictionary from video_probe (or None).
+    Returns the rowids of the new videos. Run it inside a transaction; doesn't commit
+    '''
+    if not rows:
+        return []
+    # new rowids are always above the current max, and come out in order
+    last_session = con.execute('SELECT IFNULL(MAX(rowid), 0) FROM session;').fetchone()[0]
+    con.executemany('INSERT INTO session (mouse_id, time, task, enclosure) VALUES (?, ?, ?, ?);',
+                    [row[:4] for row in rows])
+    session_ids = [row[0] for row in con.execute('SELECT rowid FROM session WHERE rowid > ? ORDER BY rowid;', (last_session,))]
+    if len(session_ids) != len(rows):
+        raise RuntimeError(f'Expected {len(rows)} new sessions, found {len(session_ids)}')
+
+    last_video = con.execute('SELECT IFNULL(MAX(rowid), 0) FROM videos;').fetchone()[0]
+    columns = ['name', 'session_id', 'fingerprint'] + list(VIDEO_INFO_COLUMNS)
+    con.executemany(f'INSERT INTO videos ({", ".join(columns)}) VALUES ({", ".join("?"*len(columns))});',
+                    [(row[4], session_id, row[5]) + tuple((row[6] or {}).get(column) for column in VIDEO_INFO_COLUMNS)
+                     for row, session_id in zip(rows, session_ids)])
+
+    return [row[0] for row in con.execute('SELECT rowid FROM videos WHERE rowid > ? ORDER BY rowid;', (last_video,))]
+
+
+def update_videos(con:sqlite3.Connection, updates:List[tuple]):
+    '''
+    new fingerprint and video_probe info for each (video rowid, fingerprint, info)
+    of videos whose file has changed. Doesn't commit
+    '''
+    columns = ['fingerprint'] + list(VIDEO_INFO_COLUMNS)
+    con.executemany(f'UPDATE videos SET {", ".join([column + " = ?" for column in columns])} WHERE rowid = ?;',
+                    [(fingerprint,) + tuple((info or {}).get(column) for column in VIDEO_INFO_COLUMNS) + (video_id,)
+                     for video_id, fingerprint, info in updates])
+
+
+def update_scan_index(con:sqlite3.Connection, files:List[tuple], root:str, video_ids:List[int] = None):
+    '''
+    record (path, size, mtime) entries as dealt with, along with the videos
+    rowid each one went into (None for files that didn't get a row). Doesn't commit
+    '''
+    if video_ids is None:
+        video_ids = [None]*len(files)
+    con.executemany('INSERT OR REPLACE INTO scan_index (path, size, mtime, video_id) VALUES (?, ?, ?, ?);',
+                    [(os.path.relpath(path, root), size, mtime, video_id)
+                     for (path, size, mtime), video_id in zip(files, video_ids)])
+
+
+
+
+# all of the ProjectDBs in this process, by sql file, and the [database] settings for each sql file
+_project_dbs = {}
+_database_configs = {}
+_project_dbs_lock = threading.Lock()
+
+def get_project_db(sql_path:str, wal:bool = None):
+    '''
+    the ProjectDB for a sql file, made the first time it's asked for. If wal
+    is None, it comes from the [database] section of the config.toml next to
+    the sql file (read the first time, since this gets called for every video)
+    '''
+    abs_path = os.path.abspath(sql_path)
+    with _project_dbs_lock:
+        if wal is None:
+            if abs_path not in _database_configs:
+                _database_configs[abs_path] = load_database_config(os.path.join(os.path.dirname(abs_path), 'config.toml'))
+            wal = _database_configs[abs_path]['wal']
+
+        key = (abs_path, wal)
+        if key not in _project_dbs:
+            _project_dbs[key] = ProjectDB(sql_path, wal=wal)
+
+        return _project_dbs[key]
+
+
+
+class ProjectDB():
+    '''
+    The project database. Each thread gets its own connection, opened the first
+    time it's needed and kept after that (a process forked from this one opens
+    its own rather than sharing the parent's). The queries are fixed strings, so
+    sqlite's statement cache compiles each one once per connection.
+
+    Results of the lookups that get repeated a lot (mouse ids, sessions and
+    calibration names) are kept in a small LRU cache, which is cleared by any write
+    through this object. Writes from somewhere else won't show up in it until
+    clear_cache() is called. generation counts the writes through this object,
+    so copies of the tables kept elsewhere (eg the calibration_index) can tell
+    when they're out of date
+    '''
+    def __init__(self, sql_path:str, wal:bool = True, cache_size:int = READ_CACHE):
+        self.sql_path = sql_path
+        self.wal = wal
+        self.cache_size = cache_size
+        self._local = threading.local()
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.generation = 0
+
+    @property
+    def connection(self):
+        # this thread's connection
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.connection = connect(self.sql_path, wal=self.wal)
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def close(self):
+        # close this thread's connection (the next query opens a new one)
+        if getattr(self._local, 'pid', None) == os.getpid():
+            self._local.connection.close()
+        self._local.pid = None
+
+    @contextmanager
+    def transaction(self):
+        '''
+        with db.transaction(): ... commits everything at the end, or nothing if it raises
+        '''
+        with self.connection as con:
+            yield con
+        self.clear_cache()
+        with self._cache_lock:
+            self.generation += 1
+
+
+    # reads
+    def query(self, sql:str, params:tuple = (), cached:bool = False):
+        '''
+        all of the rows for a query, optionally through the read cache
+        '''
+        if not cached:
+            return self.connection.execute(sql, params).fetchall()
+
+        key = (sql, tuple(params))
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        rows = self.connection.execute(sql, params).fetchall()
+        with self._cache_lock:
+            self._cache[key] = rows
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return rows
+
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+
+    def table_names(self):
+        return [row[0] for row in self.query("SELECT name FROM sqlite_schema WHERE type = 'table';")]
+
+    def mouse_ids(self):
+        return [row[0] for row in self.query('SELECT id FROM mouse;', cached=True)]
+
+    def sessions(self, mouse_id:str):
+        # (rowid, time, task, enclosure) for each of a mouse's sessions, in order
+        return self.query('SELECT rowid, time, task, enclosure FROM session WHERE mouse_id = ? ORDER BY time;',
+                          (mouse_id,), cached=True)
+
+    def video_dates(self):
+        # {video name: recording date (YYYY-mm-dd)}
+        sql_query = 'SELECT v.name, DATE(s.time) FROM videos as v, session as s WHERE s.rowid=v.session_id ;'
+        return {os.path.split(name)[-1]:video_date for name, video_date in self.query(sql_query)}
+
+    def video_info(self, names:List[str]):
+        '''
+        {video name: {fps, frame_count, width, height, ...}} for the videos that
+        have been probed (see video_probe)
+        '''
+        names = list(set([os.path.split(name)[-1] for name in names]))
+        columns = list(VIDEO_INFO_COLUMNS)
+        info = {}
+        for i_start in range(0, len(names), QUERY_BATCH):
+            batch = names[i_start:i_start + QUERY_BATCH]
+            sql_query = (f'SELECT name, {", ".join(columns)} FROM videos '
+                         f'WHERE frame_count IS NOT NULL AND name IN ({",".join("?"*len(batch))});')
+            for name, *values in self.query(sql_query, batch):
+                info[name] = dict(zip(columns, values))
+
+        return info
+
+    def calibrations(self):
+        # (rowid, name, time, boundary, intrinsic, extrinsic) for every calibration video
+        return self.query('SELECT rowid, name, time, boundary, intrinsic, extrinsic FROM calibration;')
+
+    def calibration_blobs(self, columns:List[str]):
+        # (rowid, blob for each column) for every calibration video
+        return self.query(f'SELECT rowid, {", ".join(columns)} FROM calibration;')
+
+    def calibration_exists(self, name:str):
+        return len(self.query('SELECT 1 FROM calibration WHERE name = ? LIMIT 1;', (os.path.split(name)[-1],), cached=True)) > 0
+
+    def known_fingerprints(self, table:str, fingerprints:List[str]):
+        return known_fingerprints(self.connection, table, fingerprints)
+
+    def unfingerprinted_names(self, table:str):
+        return unfingerprinted_names(self.connection, table)
+
+    def changed_files(self, files:List[tuple], root:str):
+        return changed_files(self.connection, files, root)
+
+    def indexed_videos(self, paths:List[str], root:str):
+        return indexed_videos(self.connection, paths, root)
+
+
+    # writes
+    def add_mice(self, mice:List[dict]):
+        # mice are dictionaries of column -> value, all with the same columns
+        if not mice:
+            return
+        columns = list(mice[0].keys())
+        with self.transaction() as con:
+            con.executemany(f'INSERT INTO mouse ({", ".join(columns)}) VALUES ({", ".join("?"*len(columns))});',
+                            [tuple(mouse[column] for column in columns) for mouse in mice])
+
+    def add_videos(self, entries:List[tuple], root:str):
+        '''
+        (scan entry, row, video_id) entries, all in one transaction. row is
+        (mouse_id, time, task, enclosure, name, fingerprint, info), and goes in as
+        a new video if video_id is None, or updates the fingerprint and info of
+        that video if not. Entries with no row (duplicates) only go into the scan index
+        '''
+        inserts = [i_entry for i_entry, (vid_entry, row, video_id) in enumerate(entries)
+                   if row is not None and video_id is None]
+        video_ids = [video_id for vid_entry, row, video_id in entries]
+        with self.transaction() as con:
+            for i_entry, video_id in zip(inserts, insert_videos(con, [entries[i_entry][1] for i_entry in inserts])):
+                video_ids[i_entry] = video_id
+            update_videos(con, [(video_id, row[5], row[6]) for vid_entry, row, video_id in entries
+                                if row is not None and video_id is not None])
+            update_scan_index(con, [vid_entry for vid_entry, row, video_id in entries], root, video_ids)
+
+    def add_calibration(self, name:str, time:str, boundary:bytes, fingerprint:str):
+        with self.transaction() as con:
+            con.execute('INSERT INTO calibration (name, time, boundary, fingerprint) VALUES (?, ?, ?, ?) ;',
+                        (os.path.split(name)[-1], time, boundary, fingerprint))
+
+    def set_calibration_blobs(self, updates:List[tuple]):
+        # (column, blob, rowid) for each blob to rewrite, all in one transaction
+        with self.transaction() as con:
+            for column, blob, rowid in updates:
+                con.execute(f'UPDATE calibration SET {column} = ? WHERE rowid = ?;', (blob, rowid))
+
+    def set_calibration(self, name:str, intrinsic:bytes, extrinsic:bytes):
+        with self.transaction() as con:
+            con.execute('UPDATE calibration SET intrinsic = ?, extrinsic = ? WHERE name = ?',
+                        (intrinsic, extrinsic, os.path.split(name)[-1]))
@@ -4,12 +4,22 @@
 # plus chops up the videos into subviews based on the views.
 
 import os, re, glob
-import sqlite3
 import argparse
 import pandas as pd
+from typing import List
 from multiview_calibration_preparation import multiview_calibration_preparation
+from instrumentation import get_metrics, enable_metrics
+from project_db import get_project_db, fingerprint_files, scan_tree, INSERT_BATCH
+from video_probe import probe_videos
 
-def project_populate(project_dir:str):
+
+# the parts of a video's path we pull the session info out of
+DATE_PATTERN = re.compile(r'(202[3-5]\d{4})')
+TIME_PATTERN = re.compile(r'_([0-2]\d[0-5]\d[0-5]\d)_')
+TASK_PATTERN = re.compile('(chochip|openfield|sticker|food)')
+SUMMARY_LENGTH = 20 # how many skipped videos to list before just giving a count
+
+def project_populate(project_dir:str, dry_run:bool = False, headless:bool = False):
     '''
     Populates all of the necessary folders and SQL tables
     for the project.
@@ -18,6 +28,13 @@ def project_populate(project_dir:str):
     each day.
     
     Run this each time you add more videos or mice to the project.
+
+    With dry_run on, nothing gets added -- it only reports which videos would
+    be inserted (matching against the mice in the database and mouse_list.csv)
+
+    With headless on, no windows get opened: calibration videos whose
+    boundaries can't be found automatically are skipped (and listed) instead
+    of asking for them to be drawn, so it can run on a machine without a display
     '''
     # all of our files we're expecting
     sqlite_file = os.path.join(project_dir, 'project_tracking.sqlite3')
@@ -46,19 +63,31 @@ def project_populate(project_dir:str):
         return -1
 
 
+    metrics = get_metrics()
+
+    if dry_run:
+        # the mice populate_mice would add, without adding them
+        with metrics.timer('populate_mice'):
+            csv_mice = pd.read_csv(csv_file)['id'].dropna().tolist() if os.path.exists(csv_file) else []
+        with metrics.timer('populate_videos'):
+            return populate_videos(videos_dir=video_dir, sql_file=sqlite_file, dry_run=True, extra_mice=csv_mice)
+
     # populate the mouse table with data from the csv
-    ret = populate_mice(sql_file=sqlite_file, csv_file=csv_file)
+    with metrics.timer('populate_mice'):
+        ret = populate_mice(sql_file=sqlite_file, csv_file=csv_file)
     if ret == -1:
         return -1
 
 
     # populate the calibration videos table, plus get all of the bounding boxes
-    ret = populate_calib(calib_dir=calib_dir, sql_fn=sqlite_file)
+    with metrics.timer('populate_calib'):
+        ret = populate_calib(calib_dir=calib_dir, sql_fn=sqlite_file, interactive=not headless)
     if ret == -1:
         return -1
 
 
-    ret = populate_videos(videos_dir=video_dir, sql_file = sqlite_file)
+    with metrics.timer('populate_videos'):
+        ret = populate_videos(videos_dir=video_dir, sql_file = sqlite_file)
     if ret == -1:
         return -1
 
@@ -73,119 +102,226 @@ def populate_mice(sql_file:str, csv_file:str):
             print(f'{fn} does not exist')
             return -1
         
-    # connect to the db
-    con = sqlite3.connect(sql_file)
+    db = get_project_db(sql_file)
 
     # pull in the csv
     mouse_df = pd.read_csv(csv_file)
     full_len = len(mouse_df) # how many mice are in the CSV?
 
     # remove any mice  that are already in the database
-    exist_df = pd.read_sql('SELECT id FROM MOUSE;', con=con)
-    mouse_df = mouse_df.loc[~mouse_df['id'].isin(exist_df['id'])]
+    mouse_df = mouse_df.loc[~mouse_df['id'].isin(db.mouse_ids())]
     insert_len = len(mouse_df) # how many aren't already in the sql?
 
-    # populate the sql file
-    mouse_df.to_sql('mouse', con=con, if_exists='append', index=False,
-                    dtype={'id': 'text PRIMARY KEY',
-                           'mouse_type': 'TEXT',
-                           'sex': 'text',
-                           'experiment_start': 'text'})
+    # populate the sql file (empty cells go in as NULL)
+    db.add_mice(mouse_df.astype(object).where(mouse_df.notna(), None).to_dict('records'))
 
     # how many did we insert?
     print(f'{full_len-insert_len} entries from CSV already in Mouse table;'
-          'inserted {insert_len} new entries')
-    con.close()
+          f'inserted {insert_len} new entries')
     return 0
 
 
-def populate_videos(videos_dir:str, sql_file:str):
-    vid_counter = 0 # keep track of the number of videos added to the 
-    # for root,dir,files in os.walk(videos_dir):
+def populate_videos(videos_dir:str, sql_file:str, dry_run:bool = False, n_workers:int = 16, probe_workers:int = None,
+                    extra_mice:List[str] = []):
+    '''
+    Adds any new videos under videos_dir to the session and videos tables.
+    Each new video gets probed once (in probe_workers processes) and its frame
+    rate, frame count, size, codec etc go into the videos table with it.
+
+    Every file we've dealt with goes into the scan_index table with its size and
+    mtime, so a rerun only looks at files that are new or have changed. A file
+    that changed in place keeps its videos row, which gets the new fingerprint
+    and info. With dry_run on, nothing gets written -- it just reports what would
+    be inserted. extra_mice are matched as well as the mice in the database
+    '''
+    metrics = get_metrics()
 
-    # connect to the db
-    con = sqlite3.connect(sql_file)
-    cur = con.cursor()
+    db = get_project_db(sql_file)
 
     # get a list of the mouse IDs
-    sql_query = '''SELECT id FROM mouse;'''
-    cur.execute(sql_query)
-    mouse_list = cur.fetchall()
-
-    for root,dir,files in os.walk(videos_dir):
-        vid_files = [file for file in files if os.path.splitext(file)[-1] in ['.mp4','.avi','.tiff']]
-        
-        if not vid_files:
+    with metrics.timer('db_select'):
+        mouse_list = db.mouse_ids() + list(extra_mice)
+
+    # list everything up front (in parallel, it's mostly waiting on the file server)
+    with metrics.timer('walk'):
+        scanned = scan_tree(videos_dir, extensions=['.mp4','.avi','.tiff'], n_workers=n_workers)
+    with metrics.timer('db_select'):
+        vid_entries = db.changed_files(scanned, videos_dir)
+        indexed = db.indexed_videos([vid_entry[0] for vid_entry in vid_entries], videos_dir)
+    metrics.count('files_scanned', len(scanned))
+    print(f'{len(scanned) - len(vid_entries)} of {len(scanned)} videos unchanged since the last scan')
+
+    # one regex for all of the mice, built once
+    matcher = mouse_matcher(mouse_list)
+
+    # parse everything first, then check the whole batch against the db at once
+    candidates = []
+    unmatched, ambiguous = [], []
+    for vid_entry in vid_entries:
+        full_path = vid_entry[0]
+        vid_file = os.path.split(full_path)[-1]
+
+        # find a valid mouse ID in the file path (below videos_dir)
+        mouse_ids = matcher.matches(os.path.relpath(full_path, videos_dir))
+        if len(mouse_ids) == 0:
+            unmatched.append(full_path)
+            continue
+        elif len(mouse_ids) > 1:
+            ambiguous.append((full_path, mouse_ids))
+            continue
+        else:
+            mouse_id = mouse_ids[0]
+
+        # find the date
+        match = DATE_PATTERN.search(vid_file)
+        if match:
+            rec_date = match.group(1)
+            rec_date = f'{rec_date[0:4]}-{rec_date[4:6]}-{rec_date[6:8]}'
+        else:
+            print(f'Cannot parse recording date for {vid_file}')
             continue
         
-        for vid_file in vid_files:
-            full_path = os.path.join(root, vid_file)
-
-            # find a valid mouse ID in the file path
-            mouse_id = [id[0] for id in mouse_list if id[0] in full_path]
-            if len(mouse_id) != 1:
-                print(f'Cannot parse mouse ID for {vid_file}')
-                continue
-            else:
-                mouse_id = mouse_id[0]
-
-            # find the date
-            match = re.search('(202[3-5]\d{4})', vid_file)
-            if match:
-                rec_date = match.group(1)
-                rec_date = f'{rec_date[0:4]}-{rec_date[4:6]}-{rec_date[6:8]}'
-            
-            # find the time (if available)
-            match = re.search('_([0-2]\d[0-5]\d[0-5]\d)_')
-            if match:
-                rec_time = match.group(1)
-                rec_date = rec_date + f'T{rec_time[0:2]}:{rec_time[2:4]}:{rec_time[4:6]}'
-            else:
-                rec_date = rec_date + 'T00:00:00'
-            
-            # find the task type and enclosure
-            match = re.search('(chochip|openfield|sticker|food)')
-            if match:
-                task_id = match.group(1)
-                # enclosure depends on task type
-                enclosure = 'openfield' if task_id == 'openfield' else 'small_multiview'
-            else:
-                task_id = 'unknown'
-                enclosure = 'unknown'
-
-            # insert the session info into the db
-            rec_query = f'''
-                        INSERT INTO session (mouse_id, time, task, enclosure) VALUES (?, ?, ?, ?)
-            '''
-            cur.execute(rec_query, (mouse_id, rec_date, task_id, enclosure))
-            session_id = cur.lastrowid
-
-
-            #insert vid
-            vid_query = f'''
-                        INSERT INTO videos (name, session_id) VALUES (?, ?)
-                        '''
-            cur.execute(vid_query, (vid_file, session_id))
-            vid_id = cur.fetchone()
-
-            # let us know if it was inserted
-            if vid_id and session_id:
-                print(f'Inserted {vid_file}')
-            
-    con.commit()
-    con.close()
-
-
-
-
-def populate_calib(calib_dir:str, sql_fn:str):
+        # find the time (if available)
+        match = TIME_PATTERN.search(vid_file)
+        if match:
+            rec_time = match.group(1)
+            rec_date = rec_date + f'T{rec_time[0:2]}:{rec_time[2:4]}:{rec_time[4:6]}'
+        else:
+            rec_date = rec_date + 'T00:00:00'
+        
+        # find the task type and enclosure
+        match = TASK_PATTERN.search(full_path)
+        if match:
+            task_id = match.group(1)
+            # enclosure depends on task type
+            enclosure = 'openfield' if task_id == 'openfield' else 'small_multiview'
+        else:
+            task_id = 'unknown'
+            enclosure = 'unknown'
+
+        candidates.append((vid_entry, vid_file, mouse_id, rec_date, task_id, enclosure))
+
+    metrics.count('videos_unmatched', len(unmatched))
+    metrics.count('videos_ambiguous', len(ambiguous))
+    mouse_summary(unmatched, ambiguous)
+
+    # content fingerprints, so copies and renamed files are caught too
+    with metrics.timer('fingerprint'):
+        fingerprints = fingerprint_files([candidate[0][0] for candidate in candidates], n_workers=n_workers)
+    with metrics.timer('db_select'):
+        known = db.known_fingerprints('videos', fingerprints)
+        legacy_names = db.unfingerprinted_names('videos')
+
+    # files that didn't parse stay out of the scan index, so they get another go next time
+    dealt_with = [] # (scan entry, row or None if it's a duplicate, videos rowid if the file is already in there)
+    for candidate, fingerprint in zip(candidates, fingerprints):
+        vid_entry, vid_file, mouse_id, rec_date, task_id, enclosure = candidate
+        if fingerprint is None:
+            continue
+        # a file we've seen at this path before changed, so it's the same video
+        video_id = indexed.get(vid_entry[0])
+        if video_id is None and (fingerprint in known or vid_file in legacy_names):
+            metrics.count('videos_skipped')
+            dealt_with.append((vid_entry, None, None))
+            continue
+        known.add(fingerprint) # catch duplicates within this batch as well
+
+        if dry_run:
+            print(f'Would {"insert" if video_id is None else "update"} {vid_file} (mouse {mouse_id}, {rec_date}, {task_id})')
+        dealt_with.append((vid_entry, (mouse_id, rec_date, task_id, enclosure, vid_file, fingerprint), video_id))
+
+    if dry_run:
+        return 0
+
+    # frame rate, frame count, size etc, so nothing downstream has to open the videos to find out
+    new_paths = [vid_entry[0] for vid_entry, row, video_id in dealt_with if row is not None]
+    with metrics.timer('probe'):
+        infos = dict(zip(new_paths, probe_videos(new_paths, n_workers=probe_workers)))
+
+    # videos we can't read stay out of the scan index too (they might still be copying)
+    unreadable = [full_path for full_path, info in infos.items() if info is None]
+    dealt_with = [(vid_entry, None if row is None else row + (infos[vid_entry[0]],), video_id)
+                  for vid_entry, row, video_id in dealt_with if row is None or infos[vid_entry[0]] is not None]
+    metrics.count('videos_unreadable', len(unreadable))
+    if unreadable:
+        print(f'{len(unreadable)} videos could not be read and were skipped:')
+        for full_path in unreadable[:SUMMARY_LENGTH]:
+            print(f'    {full_path}')
+        if len(unreadable) > SUMMARY_LENGTH:
+            print(f'    ... and {len(unreadable) - SUMMARY_LENGTH} more')
+
+    # one transaction per batch, so an interrupted run keeps what it's already done
+    for i_start in range(0, len(dealt_with), INSERT_BATCH):
+        batch = dealt_with[i_start:i_start + INSERT_BATCH]
+        with metrics.timer('db_insert'):
+            db.add_videos(batch, root=videos_dir)
+
+        inserted = [row for vid_entry, row, video_id in batch if row is not None and video_id is None]
+        updated = [row for vid_entry, row, video_id in batch if row is not None and video_id is not None]
+        for row in inserted:
+            print(f'Inserted {row[4]}')
+        for row in updated:
+            print(f'Updated {row[4]}')
+        metrics.progress('videos_inserted', len(inserted))
+        metrics.count('videos_updated', len(updated))
+
+    return 0
+
+
+
+
+class mouse_matcher():
+    '''
+    Finds mouse ids in file paths. All of the ids go into one regex, so a path
+    gets scanned once no matter how many mice there are. The alternation sits
+    inside a lookahead, so the scan tries every position and ids that overlap
+    (eg "AB1" and "B12" in "AB12") both get found -- that's an ambiguous path.
+    An id that's entirely inside another match (eg "m1" in "m12") is just part
+    of the longer id, so it doesn't count
+    '''
+    def __init__(self, mouse_ids:List[str]):
+        mouse_ids = sorted(set([str(id) for id in mouse_ids if id]), key=len, reverse=True) # longest first
+        self.pattern = re.compile('(?=(' + '|'.join([re.escape(id) for id in mouse_ids]) + '))') if mouse_ids else None
+
+    def matches(self, path:str):
+        # every different mouse id in the path, in the order they show up
+        if self.pattern is None:
+            return []
+        spans = [(match.start(1), match.end(1), match.group(1)) for match in self.pattern.finditer(path)]
+        return list(dict.fromkeys([id for start, end, id in spans
+                                   if not any([(s <= start and end <= e) and (e - s > end - start) for s, e, _ in spans])]))
+
+
+def mouse_summary(unmatched:List[str], ambiguous:List[tuple]):
+    '''
+    list the videos that got skipped because we couldn't tell which mouse they're from
+    '''
+    if ambiguous:
+        print(f'{len(ambiguous)} videos match more than one mouse and were skipped:')
+        for full_path, mouse_ids in ambiguous[:SUMMARY_LENGTH]:
+            print(f'    {full_path}: {", ".join(mouse_ids)}')
+        if len(ambiguous) > SUMMARY_LENGTH:
+            print(f'    ... and {len(ambiguous) - SUMMARY_LENGTH} more')
+
+    if unmatched:
+        print(f'{len(unmatched)} videos don\'t match any mouse and were skipped:')
+        for full_path in unmatched[:SUMMARY_LENGTH]:
+            print(f'    {full_path}')
+        if len(unmatched) > SUMMARY_LENGTH:
+            print(f'    ... and {len(unmatched) - SUMMARY_LENGTH} more')
+
+
+
+def populate_calib(calib_dir:str, sql_fn:str, interactive:bool = True):
     '''
     populate the video calibration stuff. Going to just call another script
-    
+
+    With interactive off, videos that need their boundaries drawn by hand get
+    skipped, and an empty calibration_videos directory doesn't open a file picker
     '''
     calib_vids = glob.glob(os.path.join(calib_dir, '*.mp4')) # list of all mp4 calibration videos
     calib_vids += glob.glob(os.path.join(calib_dir, '*.avi')) # list of all avi calibration videos
-    multiview_calibration_preparation(input_vids = calib_vids, sql_path = sql_fn) # put them into the sql db
+    multiview_calibration_preparation(input_vids = calib_vids, sql_path = sql_fn, interactive = interactive) # put them into the sql db
 
 
 if __name__ == "__main__":
@@ -200,6 +336,12 @@ if __name__ == "__main__":
                 '''
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('project_dir',help='project directory', default='.')
+    parser.add_argument('--metrics', help='write timing metrics to this JSON-lines file', default=None)
+    parser.add_argument('--dry_run', help='only report which videos would be added', action='store_true')
+    parser.add_argument('--headless', action='store_true', help='never open a window -- skip calibration videos the detection isn\'t sure about')
     args = parser.parse_args()
 
-    project_populate(project_dir=args.project_dir)
+    if args.metrics:
+        enable_metrics(args.metrics)
+
+    project_populate(project_dir=args.project_dir, dry_run=args.dry_run, headless=args.headless)
@@ -9,6 +9,7 @@ import requests
 import zipfile
 import shutil
 import gdown
+from project_db import connect, ensure_schema, load_database_config
 
 
 
@@ -109,7 +110,7 @@ def sqlite_setup(project_dir:str):
     sqlite_file = os.path.join(project_dir, 'project_tracking.sqlite3')
     if os.path.exists(sqlite_file):
         print(f'{sqlite_file} already exists')
-    con = sqlite3.connect(sqlite_file)
+    con = connect(sqlite_file, wal=load_database_config(os.path.join(project_dir, 'config.toml'))['wal'])
     cur = con.cursor()
 
 
@@ -132,9 +133,10 @@ def sqlite_setup(project_dir:str):
     # create the videos table
     videos_creation = ''' 
                         CREATE TABLE IF NOT EXISTS videos (
-                            vid_name text, 
+                            name text, 
                             session_id text,
                             description text,
+                            fingerprint text,
                             FOREIGN KEY (session_id) REFERENCES "session" ([rowid])
                         );'''
     cur.execute(videos_creation)
@@ -146,9 +148,14 @@ def sqlite_setup(project_dir:str):
                             time text,
                             boundary blob,
                             intrinsic blob,
-                            extrinsic blob
+                            extrinsic blob,
+                            fingerprint text
                         );'''
     cur.execute(calibration_creation)
+
+    # indexes, plus anything an older project is missing
+    ensure_schema(con)
+    con.close()
    
 
 # function to download and save a zip file
@@ -0,0 +1,133 @@
+#! /usr/bin/env python
+
+# video_probe
+'''
+Pull the basic facts about a video (frame rate, frame count, size, codec,
+duration and keyframe interval) out of it once, so they can go into the
+videos table and nothing downstream has to open the file just to ask.
+
+    info = probe_video('mouse_20240101_chochip.mp4')
+    # {'fps': 30.0, 'frame_count': 18000, 'width': 2592, 'height': 1944,
+    #  'codec': 'avc1', 'duration': 600.0, 'keyframe_interval': 250}
+
+The keyframe interval comes from the packet flags reported by ffprobe (no
+decoding), and is None if ffprobe isn't around. Tiff stacks get their page
+count and size from cv2.imcount/imread, and have no frame rate. A file that
+can't be opened, or has no frames, gives None.
+'''
+
+import os
+import shutil
+import argparse
+import subprocess
+import numpy as np
+import cv2
+from typing import List
+from concurrent.futures import ProcessPoolExecutor
+
+
+KEYFRAME_SECONDS = 60   # how far into the video to look at keyframes
+
+
+
+def probe_video(video_path:str, ffprobe:str = 'ffprobe'):
+    '''
+    {column: value} for project_db.VIDEO_INFO_COLUMNS, or None if the video can't be read
+    '''
+    if os.path.splitext(video_path)[-1].lower() in ['.tif', '.tiff']:
+        return _probe_tiff(video_path)
+
+    vid_read = cv2.VideoCapture(video_path)
+    if not vid_read.isOpened():
+        return None
+    fps = vid_read.get(cv2.CAP_PROP_FPS)
+    frame_count = int(vid_read.get(cv2.CAP_PROP_FRAME_COUNT))
+    width = int(vid_read.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(vid_read.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fourcc = int(vid_read.get(cv2.CAP_PROP_FOURCC))
+    vid_read.release()
+    if frame_count <= 0 or width <= 0 or height <= 0:
+        return None
+
+    return {'fps': fps if fps > 0 else None,
+            'frame_count': frame_count,
+            'width': width,
+            'height': height,
+            'codec': fourcc.to_bytes(4, 'little').decode('ascii', errors='replace').strip('\x00 ') or None,
+            'duration': frame_count/fps if fps > 0 else None,
+            'keyframe_interval': keyframe_interval(video_path, ffprobe)}
+
+
+def _probe_tiff(video_path:str):
+    # multi-page tiff stack -- one frame per page
+    try:
+        frame_count = cv2.imcount(video_path)
+        first_page = cv2.imread(video_path, cv2.IMREAD_UNCHANGED)
+    except cv2.error:
+        return None
+    if first_page is None or frame_count <= 0:
+        return None
+
+    return {'fps': None,
+            'frame_count': frame_count,
+            'width': first_page.shape[1],
+            'height': first_page.shape[0],
+            'codec': 'tiff',
+            'duration': None,
+            'keyframe_interval': 1}
+
+
+def keyframe_interval(video_path:str, ffprobe:str = 'ffprobe'):
+    '''
+    median number of frames between keyframes over the first KEYFRAME_SECONDS
+    of the video, or None if ffprobe isn't available or didn't find two keyframes
+    '''
+    if shutil.which(ffprobe) is None:
+        return None
+
+    command = [ffprobe, '-v', 'error', '-select_streams', 'v:0', '-read_intervals', f'%+{KEYFRAME_SECONDS}',
+               '-show_entries', 'packet=flags', '-of', 'csv=p=0', video_path]
+    ret = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+    if ret.returncode != 0:
+        return None
+
+    flags = ret.stdout.decode(errors='replace').split()
+    keyframes = [i_packet for i_packet, flag in enumerate(flags) if flag.startswith('K')]
+    if len(keyframes) < 2:
+        return None
+
+    return int(np.median(np.diff(keyframes)))
+
+
+
+def probe_videos(video_paths:List[str], n_workers:int = None, ffprobe:str = 'ffprobe'):
+    '''
+    probe_video for a list of videos in a pool of processes. Returns the
+    results in the same order as video_paths
+    '''
+    if len(video_paths) == 0:
+        return []
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        return list(pool.map(_probe_worker, video_paths, [ffprobe]*len(video_paths),
+                             chunksize=max(1, len(video_paths)//(4*(n_workers or os.cpu_count() or 1)))))
+
+
+def _probe_worker(video_path:str, ffprobe:str):
+    # a video that breaks the decoder shouldn't take the whole batch with it
+    try:
+        return probe_video(video_path, ffprobe)
+    except Exception as e:
+        print(f'Unable to probe {video_path}: {e!r}')
+        return None
+
+
+
+# arg parsing to run from the command line or just call straight
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the frame rate, frame count, size, codec etc of videos')
+    parser.add_argument('videos', nargs='+', help='videos to probe')
+    parser.add_argument('-j','--workers', help='number of worker processes [default = number of cpus]', type=int, default=None)
+    args = parser.parse_args()
+
+    for video, info in zip(args.videos, probe_videos(args.videos, n_workers=args.workers)):
+        print(f'{video}: {info}')
@@ -0,0 +1,156 @@
+#! /usr/bin/env python
+
+# video_writers
+'''
+Encoder backends for writing out the split (or spliced) views.
+
+Every writer takes BGR uint8 frames with write() and gets closed with
+release(), just like cv2.VideoWriter, so they can be swapped in anywhere
+we were using that directly.
+
+    - opencv        cv2.VideoWriter with a fourcc (the original mp4v behavior)
+    - ffmpeg        pipes raw frames into an ffmpeg subprocess, so we get to pick
+                    the codec (libx264, ffv1 ...), crf, preset, threads and keyframe interval
+    - npy           chunked memory-mapped frame store (see frame_store), for fast
+                    random access. The output "file" is a directory
+
+The settings live in the [encoder] section of the project config.toml
+'''
+
+import os
+import subprocess
+import tempfile
+import numpy as np
+import cv2
+import toml
+from frame_store import frame_store_writer
+
+
+# what we use if config.toml doesn't say otherwise
+DEFAULT_ENCODER = {
+    'backend': 'opencv',    # opencv, ffmpeg or npy
+    'extension': 'mp4',     # file extension of the outputs
+    'fourcc': 'mp4v',       # opencv only
+    'ffmpeg': 'ffmpeg',     # ffmpeg executable
+    'codec': 'libx264',     # ffmpeg codec -- libx264, ffv1 etc
+    'crf': 23,              # libx264 quality. lower is better (and bigger)
+    'preset': 'veryfast',   # libx264 speed/size tradeoff
+    'pix_fmt': 'yuv420p',   # pixel format of the encoded video
+    'gop': 50,              # keyframe interval in frames. smaller makes seeks cheaper
+    'threads': 0,           # encoder threads. 0 lets ffmpeg decide
+    'extra_args': [],       # anything else to hand to ffmpeg, eg ['-tune', 'fastdecode']
+    'chunk_frames': 1000,   # npy only -- frames per chunk file
+}
+
+# pixel formats that need even widths and heights
+_SUBSAMPLED_FMTS = ['yuv420p', 'yuvj420p', 'nv12', 'yuv422p']
+
+
+
+def load_encoder_config(config_path:str = None):
+    '''
+    read the [encoder] section of a config.toml, filling in anything missing
+    with the defaults. If the file doesn't exist we just get the defaults
+    '''
+    settings = dict(DEFAULT_ENCODER)
+    if config_path is not None and os.path.exists(config_path):
+        settings.update(toml.load(config_path).get('encoder', {}))
+
+    return settings
+
+
+
+def open_writer(filename:str, fps:float, frame_size:tuple, settings:dict = None):
+    '''
+    open a writer for the backend in the settings
+
+    arguments:
+        - filename          output video path
+        - fps               frames per second
+        - frame_size        (width, height), same as cv2.VideoWriter
+        - settings          encoder settings. if None, uses the defaults
+    '''
+    if settings is None:
+        settings = DEFAULT_ENCODER
+    else:
+        settings = dict(DEFAULT_ENCODER, **settings)
+
+    backend = settings['backend'].lower()
+    if backend == 'opencv':
+        return opencv_writer(filename, fps, frame_size, settings)
+    elif backend == 'ffmpeg':
+        return ffmpeg_writer(filename, fps, frame_size, settings)
+    elif backend == 'npy':
+        return frame_store_writer(filename, fps, frame_size, settings['chunk_frames'])
+    else:
+        raise ValueError(f'Unknown encoder backend {settings["backend"]}')
+
+
+
+class opencv_writer():
+    # thin wrapper around cv2.VideoWriter
+    def __init__(self, filename:str, fps:float, frame_size:tuple, settings:dict):
+        self.filename = filename
+        fourcc = cv2.VideoWriter_fourcc(*settings['fourcc'])
+        self.writer = cv2.VideoWriter(filename, fourcc, fps, tuple(frame_size))
+
+    def write(self, frame:np.array):
+        self.writer.write(frame)
+
+    def release(self):
+        self.writer.release()
+
+
+
+class ffmpeg_writer():
+    # sends raw bgr frames to ffmpeg over a pipe
+    def __init__(self, filename:str, fps:float, frame_size:tuple, settings:dict):
+        self.filename = filename
+        self.frame_size = tuple(frame_size)
+        width, height = self.frame_size
+
+        command = [settings['ffmpeg'], '-y', '-loglevel', 'error', '-nostdin',
+                   '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps or 30),
+                   '-i', '-', '-an',
+                   '-c:v', settings['codec'], '-pix_fmt', settings['pix_fmt'],
+                   '-g', str(settings['gop']), '-threads', str(settings['threads'])]
+
+        # codec specific settings
+        if settings['codec'] in ['libx264', 'libx265']:
+            command += ['-crf', str(settings['crf']), '-preset', settings['preset']]
+        elif settings['codec'] == 'ffv1':
+            command += ['-level', '3', '-slicecrc', '1']
+
+        # 4:2:0 needs even dimensions, so pad by a pixel if we have to
+        if settings['pix_fmt'] in _SUBSAMPLED_FMTS and (width % 2 or height % 2):
+            command += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2']
+
+        command += [str(arg) for arg in settings['extra_args']] + [filename]
+
+        # errors go to a temp file so a chatty ffmpeg can't fill up a pipe and stall
+        self.log = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.log)
+
+    def write(self, frame:np.array):
+        if (frame.shape[1], frame.shape[0]) != self.frame_size:
+            raise ValueError(f'{self.filename}: expected {self.frame_size} frames, got {frame.shape[1::-1]}')
+        try:
+            self.proc.stdin.write(memoryview(np.ascontiguousarray(frame)))
+        except BrokenPipeError:
+            self.release()
+
+    def release(self):
+        if self.proc.stdin.closed:
+            return
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        ret = self.proc.wait()
+
+        # let us know if ffmpeg didn't like something
+        self.log.seek(0)
+        message = self.log.read().decode(errors='replace').strip()
+        self.log.close()
+        if ret != 0:
+            raise RuntimeError(f'ffmpeg failed writing {self.filename}: {message}')
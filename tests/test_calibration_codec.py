@@ -0,0 +1,54 @@
+import os
+import pickle
+import sqlite3
+
+import numpy as np
+import pytest
+
+from benchmark_split import make_project
+from calibration_codec import decode, encode, is_encoded, migrate_calibrations
+from project_db import get_project_db
+
+
+class _payload():
+    # anything that pickles to a global outside numpy
+    def __reduce__(self):
+        return (os.system, ('echo pwned',))
+
+
+def test_pickled_blobs_need_an_opt_in():
+    blob = pickle.dumps({'top_left': np.array([1, 2]), 'bottom_right': np.array([3, 4])})
+
+    with pytest.raises(ValueError):
+        decode(blob)
+    assert decode(blob, allow_pickle=True) == {'top_left': [1, 2], 'bottom_right': [3, 4]}
+
+
+def test_pickled_blobs_cant_run_code():
+    with pytest.raises(pickle.UnpicklingError):
+        decode(pickle.dumps({'boundary': _payload()}), allow_pickle=True)
+
+
+def test_json_and_binary_still_decode():
+    assert decode(b'{"a": [1, 2]}') == {'a': [1, 2]}
+    assert decode(encode({'a': np.arange(3)}))['a'].tolist() == [0, 1, 2]
+
+
+def test_migrate_rewrites_legacy_rows(tmp_path):
+    sql_path, video_path = make_project(str(tmp_path), 320, 240, 5)
+    con = sqlite3.connect(sql_path)
+    con.execute('INSERT INTO calibration (name, time, boundary) VALUES (?, ?, ?)',
+                ('calib_20240102_.mp4', '2024-01-02', b'{"center": [1, 2, 3, 4]}'))
+    con.execute('INSERT INTO calibration (name, time, boundary) VALUES (?, ?, ?)',
+                ('calib_20240103_.mp4', '2024-01-03', pickle.dumps({'center': np.array([5, 6, 7, 8])})))
+    con.commit()
+    con.close()
+
+    with pytest.raises(ValueError):
+        migrate_calibrations(sql_path)
+    assert migrate_calibrations(sql_path, allow_pickle=True) == 2
+    assert migrate_calibrations(sql_path) == 0
+
+    blobs = [row[1] for row in get_project_db(sql_path).calibration_blobs(['boundary'])]
+    assert all([is_encoded(blob) for blob in blobs])
+    assert decode(blobs[-1])['center'].tolist() == [5, 6, 7, 8]
@@ -0,0 +1,33 @@
+import numpy as np
+
+from benchmark_split import make_project
+from calibration_codec import encode
+from calibration_engine import write_calibration
+from multiview_utils import calibration_puller, get_calibration_index
+from project_db import get_project_db
+
+
+def test_new_calibrations_show_up_without_a_refresh(tmp_path):
+    sql_path, video_path = make_project(str(tmp_path), 320, 240, 5)
+    assert calibration_puller(sql_path, 'calib_20240101_.mp4', is_calib=True)['extrinsic'] is None
+
+    write_calibration(sql_path, 'calib_20240101_.mp4', {'center': {'k': np.eye(3)}}, {'center': {'r': np.zeros(3)}})
+    calibration = calibration_puller(sql_path, 'calib_20240101_.mp4', is_calib=True)
+    assert calibration['extrinsic']['center']['r'].tolist() == [0, 0, 0]
+
+    # a newer calibration for the same day takes over for a video that's already been looked up
+    new_bounds = {'center': np.array([1, 2, 3, 4])}
+    get_project_db(sql_path).add_calibration('calib_20240101_b.mp4', '2024-01-01', encode(new_bounds), None)
+    assert calibration_puller(sql_path, video_path)['boundary']['center'].tolist() == [1, 2, 3, 4]
+
+
+def test_misses_only_reload_once(tmp_path, monkeypatch):
+    sql_path, video_path = make_project(str(tmp_path), 320, 240, 5)
+    index = get_calibration_index(sql_path, refresh=True)
+    loads = []
+    monkeypatch.setattr(index, 'load', lambda: loads.append(1))
+
+    for i_video in range(5):
+        assert index.for_video(f'missing_{i_video}.mp4') is None
+        assert index.for_calibration(f'missing_{i_video}.mp4') is None
+    assert len(loads) == 1
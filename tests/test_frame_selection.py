@@ -0,0 +1,16 @@
+import numpy as np
+
+from frame_selection import most_diverse
+
+
+def test_most_diverse_never_picks_a_row_twice():
+    # mostly identical rows, so most of the clusters come up empty
+    features = np.zeros((12, 4))
+    features[0] = 10
+    features[1] = -10
+
+    for n_select in range(1, 12):
+        selected = most_diverse(features, n_select, seed=3)
+        assert len(selected) == n_select
+        assert len(np.unique(selected)) == n_select
+    assert {0, 1} <= set(most_diverse(features, 3, seed=3).tolist())
@@ -0,0 +1,24 @@
+import os
+import json
+
+from benchmark_split import make_project
+from instrumentation import enable_metrics, disable_metrics
+from multiview_utils import video_split_batch
+
+
+def test_pool_workers_write_a_summary(tmp_path):
+    sql_path, video_path = make_project(str(tmp_path), 320, 240, 10)
+    metrics_path = str(tmp_path / 'metrics.jsonl')
+
+    enable_metrics(metrics_path)
+    try:
+        statuses = video_split_batch(sql_path, [video_path], output_dir=str(tmp_path / 'out'), n_workers=1)
+    finally:
+        disable_metrics()
+    assert [status['status'] for status in statuses] == ['ok']
+
+    with open(metrics_path) as fid:
+        records = [json.loads(line) for line in fid]
+    worker_summaries = [record for record in records if record['event'] == 'summary' and record['pid'] != os.getpid()]
+    assert len(worker_summaries) == 1
+    assert worker_summaries[0]['timers']['decode']['calls'] >= 10
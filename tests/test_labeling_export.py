@@ -0,0 +1,27 @@
+import os
+import json
+import shutil
+
+from benchmark_split import make_project
+from multiview_calibration_preparation import export_labeling_set
+
+
+def test_videos_with_the_same_file_name_get_separate_frames(tmp_path):
+    # videos/<mouse>/<date>/... -- the same file name on different days
+    sql_path, video_path = make_project(str(tmp_path), 320, 240, 30)
+    day2 = os.path.join(os.path.dirname(video_path), 'day2')
+    os.makedirs(day2)
+    shutil.copy(video_path, day2)
+    videos = [video_path, os.path.join(day2, os.path.basename(video_path))]
+
+    label_dir = str(tmp_path / 'labels')
+    statuses = export_labeling_set(videos, label_dir, 6, sql_path, n_workers=2, seed=1)
+    assert all([status['status'] == 'ok' for status in statuses])
+
+    with open(os.path.join(label_dir, 'manifest.jsonl')) as fid:
+        records = [json.loads(line) for line in fid]
+    assert len(records) == 6
+    assert len(set([record['image'] for record in records])) == 6
+    assert set([record['video'] for record in records]) == set([os.path.abspath(video) for video in videos])
+    for record in records:
+        assert os.path.exists(os.path.join(label_dir, record['image']))
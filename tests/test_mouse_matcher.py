@@ -0,0 +1,20 @@
+from project_populate import mouse_matcher
+
+
+def test_overlapping_ids_are_ambiguous():
+    matcher = mouse_matcher(['AB1', 'B12'])
+    assert matcher.matches('videos/AB12/20240101/chochip.mp4') == ['AB1', 'B12']
+
+
+def test_id_inside_a_longer_id_is_not_a_match():
+    matcher = mouse_matcher(['m1', 'm12', '12'])
+    assert matcher.matches('videos/m12/20240101/chochip.mp4') == ['m12']
+    assert matcher.matches('videos/m1/20240101/chochip.mp4') == ['m1']
+
+
+def test_different_ids_in_one_path():
+    matcher = mouse_matcher(['m01', 'm02', 'a.b'])
+    assert matcher.matches('videos/m01/m02/v.mp4') == ['m01', 'm02']
+    assert matcher.matches('videos/axb/v.mp4') == []
+    assert matcher.matches('videos/x/v.mp4') == []
+    assert mouse_matcher([]).matches('videos/m01/v.mp4') == []
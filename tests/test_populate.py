@@ -0,0 +1,69 @@
+import os
+
+import multiview_calibration_preparation
+from benchmark_split import make_video
+from project_db import get_project_db
+from project_setup import sqlite_setup
+from project_populate import project_populate, populate_videos
+
+
+def empty_project(project_dir):
+    for directory in ['videos', 'calibration_videos']:
+        os.makedirs(os.path.join(project_dir, directory))
+    sqlite_setup(project_dir=project_dir)
+    with open(os.path.join(project_dir, 'mouse_list.csv'), 'w') as fid:
+        fid.write('id,mouse_type,sex,experiment_start\nm01,,,\n')
+    return os.path.join(project_dir, 'project_tracking.sqlite3'), os.path.join(project_dir, 'videos')
+
+
+def test_changed_video_updates_its_row(tmp_path):
+    sql_path, video_dir = empty_project(str(tmp_path))
+    db = get_project_db(sql_path)
+    db.add_mice([{'id': 'm01'}])
+    video_path = os.path.join(video_dir, 'm01_20240102_120000_chochip.mp4')
+
+    make_video(video_path, 160, 120, 10)
+    populate_videos(video_dir, sql_path)
+    before = db.query('SELECT rowid, fingerprint, frame_count FROM videos;')
+    assert len(before) == 1 and before[0][2] == 10
+
+    # same path, new contents
+    make_video(video_path, 160, 120, 20)
+    populate_videos(video_dir, sql_path)
+    after = db.query('SELECT rowid, fingerprint, frame_count FROM videos;')
+    assert len(after) == 1
+    assert after[0][0] == before[0][0] and after[0][1] != before[0][1] and after[0][2] == 20
+    assert len(db.query('SELECT rowid FROM session;')) == 1
+
+
+def test_dry_run_uses_the_mouse_list(tmp_path, capsys):
+    sql_path, video_dir = empty_project(str(tmp_path))
+    make_video(os.path.join(video_dir, 'm01_20240102_120000_chochip.mp4'), 160, 120, 10)
+
+    assert project_populate(str(tmp_path), dry_run=True) == 0
+    output = capsys.readouterr().out
+    assert 'Would insert m01_20240102_120000_chochip.mp4' in output
+    assert 'don\'t match any mouse' not in output
+    assert get_project_db(sql_path).mouse_ids() == []
+
+
+def _no_windows(*args, **kwargs):
+    raise AssertionError('opened a window in headless mode')
+
+
+def test_headless_populate_skips_uncertain_calibrations(tmp_path, monkeypatch):
+    monkeypatch.setattr(multiview_calibration_preparation, 'bound_creator', _no_windows)
+    monkeypatch.setattr(multiview_calibration_preparation, 'select_vids', _no_windows)
+    monkeypatch.setattr(multiview_calibration_preparation, 'detect_boundaries', lambda *args: ({}, 0.0))
+
+    sql_path, video_dir = empty_project(str(tmp_path))
+    make_video(os.path.join(video_dir, 'm01_20240102_120000_chochip.mp4'), 160, 120, 10)
+
+    # no calibration videos at all, then one the detection isn't sure about
+    project_populate(str(tmp_path), headless=True)
+    make_video(os.path.join(str(tmp_path), 'calibration_videos', 'calib_20240102_.mp4'), 160, 120, 10)
+    project_populate(str(tmp_path), headless=True)
+
+    db = get_project_db(sql_path)
+    assert db.calibrations() == []
+    assert len(db.query('SELECT rowid FROM videos;')) == 1
@@ -0,0 +1,79 @@
+import sqlite3
+
+import project_db
+from project_db import connect, get_project_db, SCHEMA_VERSION
+
+
+# the tables exactly as the original sqlite_setup made them
+BASELINE_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS mouse
+       (id text PRIMARY KEY, mouse_type text, sex text, experiment_start text );''',
+    '''CREATE TABLE IF NOT EXISTS session
+       (mouse_id text, time text, task text, experimenter text,
+       enclosure text, comments text,
+       FOREIGN KEY (mouse_id) REFERENCES "mouse" ([id]));''',
+    '''CREATE TABLE IF NOT EXISTS videos (
+           vid_name text,
+           session_id text,
+           description text,
+           FOREIGN KEY (session_id) REFERENCES "session" ([rowid])
+       );''',
+    '''CREATE TABLE IF NOT EXISTS calibration (
+           name text,
+           time text,
+           boundary blob,
+           intrinsic blob,
+           extrinsic blob
+       );''',
+]
+
+
+def baseline_db(path):
+    con = sqlite3.connect(path)
+    for statement in BASELINE_SCHEMA:
+        con.execute(statement)
+    con.execute("INSERT INTO mouse (id) VALUES ('m01');")
+    con.execute("INSERT INTO session (mouse_id, time) VALUES ('m01', '2024-01-02T00:00:00');")
+    con.execute("INSERT INTO videos (vid_name, session_id) VALUES ('m01_20240102_.mp4', 1);")
+    con.commit()
+    con.close()
+    return str(path)
+
+
+def test_baseline_database_upgrades_in_place(tmp_path):
+    sql_path = baseline_db(tmp_path / 'project_tracking.sqlite3')
+
+    con = connect(sql_path)
+    assert con.execute('PRAGMA user_version;').fetchone()[0] == SCHEMA_VERSION
+    columns = [row[1] for row in con.execute('PRAGMA table_info(videos);')]
+    assert 'name' in columns and 'vid_name' not in columns
+    assert 'fingerprint' in columns and 'frame_count' in columns
+    indexes = [row[0] for row in con.execute("SELECT name FROM sqlite_schema WHERE type = 'index';")]
+    assert {'videos_name', 'session_mouse_time', 'calibration_time'} <= set(indexes)
+    assert con.execute('SELECT name FROM videos;').fetchall() == [('m01_20240102_.mp4',)]
+    con.close()
+
+    # and it's fine to open again
+    con = connect(sql_path)
+    con.close()
+
+    db = get_project_db(sql_path, wal=True)
+    assert db.video_dates() == {'m01_20240102_.mp4': '2024-01-02'}
+
+
+def test_wal_can_be_turned_off(tmp_path):
+    sql_path = baseline_db(tmp_path / 'project_tracking.sqlite3')
+    connect(sql_path, wal=True).close()
+
+    (tmp_path / 'config.toml').write_text('[database]\nwal = false\n')
+    db = get_project_db(sql_path)
+    assert db.query('PRAGMA journal_mode;') == [('delete',)]
+
+
+def test_database_config_is_read_once(tmp_path, monkeypatch):
+    sql_path = baseline_db(tmp_path / 'project_tracking.sqlite3')
+    reads = []
+    monkeypatch.setattr(project_db, 'load_database_config', lambda config_path: reads.append(config_path) or {'wal': True})
+
+    assert len(set([id(get_project_db(sql_path)) for i_call in range(10)])) == 1
+    assert len(reads) == 1
@@ -0,0 +1,35 @@
+import numpy as np
+
+from benchmark_split import synthetic_bounds
+from multiview_utils import load_transform_config, gamma_lut
+from multiview_calibration_preparation import splice_plan, splice_frame
+
+
+def _splice(transforms):
+    frame = np.random.default_rng(0).integers(0, 255, (240, 320, 3), dtype=np.uint8)
+    bounds = {key.lower():value for key, value in synthetic_bounds(320, 240).items()}
+    plan = splice_plan(bounds, transforms)
+    canvas = plan.apply(frame).copy()
+
+    # the untouched crop of each view, where it landed on the canvas
+    views = {}
+    for view, (top, left, bottom, right) in plan.canvas_boundaries().items():
+        source = frame[bounds[view][0]:bounds[view][0]+bottom-top, bounds[view][1]:bounds[view][1]+right-left]
+        views[view] = (source, canvas[top:bottom, left:right])
+
+    assert np.array_equal(splice_frame(frame, bounds, plan.layout, transforms).astype(np.uint8), canvas)
+    return views
+
+
+def test_splice_uses_the_splice_gamma(tmp_path):
+    config_path = tmp_path / 'config.toml'
+    config_path.write_text('[views]\ngamma = 1.0\nsplice_gamma = 0.5\n\n[views.North]\nsplice_gamma = 1.0\n')
+
+    for view, (source, spliced) in _splice(load_transform_config(str(config_path))).items():
+        assert np.array_equal(spliced, source if view == 'north' else gamma_lut(0.5)[source])
+
+
+def test_splice_gamma_defaults_to_0_6(tmp_path):
+    # the split views aren't corrected by default, but the label frames still are
+    for source, spliced in _splice(load_transform_config(str(tmp_path / 'missing.toml'))).values():
+        assert np.array_equal(spliced, gamma_lut(0.6)[source])
@@ -0,0 +1,28 @@
+import os
+import shutil
+
+import pytest
+
+from benchmark_split import make_project
+from video_writers import load_encoder_config
+from multiview_utils import video_split_sql, compare_videos
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='segments are stitched back together with ffmpeg')
+def test_segmented_split_matches_serial(tmp_path):
+    n_frames = 40
+    sql_path, video_path = make_project(str(tmp_path), 320, 240, n_frames)
+
+    # lossless, so any difference is a real one
+    encoder = dict(load_encoder_config(None), backend='ffmpeg', codec='ffv1', pix_fmt='bgr0', extension='mkv')
+    serial_dir = str(tmp_path / 'serial')
+    segment_dir = str(tmp_path / 'segments')
+    assert video_split_sql(sql_path, video_path, output_dir=serial_dir, encoder=encoder) == n_frames
+    assert video_split_sql(sql_path, video_path, output_dir=segment_dir, encoder=encoder, n_segments=3) == n_frames
+
+    outputs = sorted(os.listdir(serial_dir))
+    assert len(outputs) == 5
+    assert sorted(os.listdir(segment_dir)) == outputs
+    for output in outputs:
+        counts = compare_videos(os.path.join(serial_dir, output), os.path.join(segment_dir, output))
+        assert counts == {'frames_a': n_frames, 'frames_b': n_frames, 'mismatched': 0}, output